@@ -11,6 +11,8 @@ document.addEventListener('DOMContentLoaded', function() {
 
     let uploadedFiles = [];
     let progressInterval;
+    let currentJobId = null;
+    let bulkPreviewId = null;
     let apiConnected = false;
     let validatingPrintify = false;
 
@@ -134,48 +136,70 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // List an uploaded file; uploadedFiles holds the ids the server gave it
+    function addUploadedFile(id, name) {
+        if (uploadedFiles.includes(id)) {
+            return;
+        }
+        const div = document.createElement('div');
+        div.textContent = name;
+        const deleteBtn = document.createElement('button');
+        deleteBtn.textContent = 'Delete';
+        deleteBtn.addEventListener('click', function() {
+            fetch('/api/delete_file', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({id: id})
+            })
+            .then(res => res.json())
+            .then(data => {
+                if (data.success) {
+                    div.remove();
+                    uploadedFiles = uploadedFiles.filter(f => f !== id);
+                } else {
+                    alert('Error deleting file: ' + data.error);
+                }
+            });
+        });
+        div.appendChild(deleteBtn);
+        fileList.appendChild(div);
+        uploadedFiles.push(id);
+    }
+
     // Handle file selection
     imageFilesInput.addEventListener('change', function() {
         const files = Array.from(this.files);
         fileList.innerHTML = '';
         uploadedFiles = [];
         const formData = new FormData();
-        files.forEach(file => {
-            formData.append('files', file);
-            const div = document.createElement('div');
-            div.textContent = file.name;
-            const deleteBtn = document.createElement('button');
-            deleteBtn.textContent = 'Delete';
-            deleteBtn.addEventListener('click', function() {
-                fetch('/api/delete_file', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({filename: file.name})
-                })
-                .then(res => res.json())
-                .then(data => {
-                    if (data.success) {
-                        div.remove();
-                        uploadedFiles = uploadedFiles.filter(f => f !== file.name);
-                    } else {
-                        alert('Error deleting file: ' + data.error);
-                    }
-                });
-            });
-            div.appendChild(deleteBtn);
-            fileList.appendChild(div);
-            uploadedFiles.push(file.name);
-        });
+        files.forEach(file => formData.append('files', file));
 
         // Upload files to backend
         fetch('/api/upload', {
             method: 'POST',
             body: formData
         }).then(res => res.json()).then(data => {
-            console.log('Uploaded:', data.uploaded);
+            (data.uploaded || []).forEach(file => addUploadedFile(file.id, file.name));
+            (data.errors || []).forEach(file => alert('Error uploading ' + file.name + ': ' + file.error));
         });
     });
 
+    // Add earlier uploads that haven't been turned into products yet, one page at a time
+    let uploadsCursor = null;
+    document.getElementById('load-uploads').addEventListener('click', function() {
+        const params = new URLSearchParams({processed: 0, limit: 100});
+        if (uploadsCursor) {
+            params.set('cursor', uploadsCursor);
+        }
+        fetch('/api/uploads?' + params)
+            .then(res => res.json())
+            .then(data => {
+                data.items.forEach(file => addUploadedFile(file.sha256, file.name));
+                uploadsCursor = data.next_cursor;
+                this.style.display = uploadsCursor ? '' : 'none';
+            });
+    });
+
     // Show/hide AI title options
     document.querySelectorAll('input[name="title-source"]').forEach(radio => {
         radio.addEventListener('change', function() {
@@ -183,6 +207,53 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     });
 
+    function batchRequest() {
+        return {
+            images: uploadedFiles,
+            placement_mode: document.querySelector('input[name="placement"]:checked').value,
+            store_id: storeSelect.value,
+            product_id: productSelect.value,
+            api_key: apiKeyInput.value,
+            openai_key: document.getElementById('openai-key').value,
+            gemini_key: document.getElementById('gemini-key').value,
+            rules: collectRules()
+        };
+    }
+
+    // Pre-flight report: batch problems first, then each image with errors or warnings
+    function showValidation(report) {
+        const resultsDiv = document.getElementById('validation-results');
+        resultsDiv.innerHTML = '';
+        if (!report) {
+            return;
+        }
+        const summary = document.createElement('p');
+        summary.textContent = `Checked ${report.checked} images in ${report.seconds}s: ` +
+            (report.ok ? 'ready to create' : `${report.failed} images with errors`);
+        resultsDiv.appendChild(summary);
+        const list = document.createElement('ul');
+        const addLine = (text, isError) => {
+            const line = document.createElement('li');
+            line.textContent = (isError ? 'Error: ' : 'Warning: ') + text;
+            list.appendChild(line);
+        };
+        report.errors.forEach(text => addLine(text, true));
+        report.warnings.forEach(text => addLine(text, false));
+        report.images.forEach(image => {
+            image.errors.forEach(text => addLine(`${image.name}: ${text}`, true));
+            image.warnings.forEach(text => addLine(`${image.name}: ${text}`, false));
+        });
+        resultsDiv.appendChild(list);
+    }
+
+    document.getElementById('validate-batch').addEventListener('click', function() {
+        fetch('/api/validate', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(batchRequest())
+        }).then(res => res.json()).then(showValidation);
+    });
+
     // Create products
     createProductsBtn.addEventListener('click', function() {
         if (uploadedFiles.length === 0) {
@@ -202,53 +273,256 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
 
-        const provider = document.getElementById('ai-provider').value;
-        const data = {
-            images: uploadedFiles,
-            placement_mode: document.querySelector('input[name="placement"]:checked').value,
-            store_id: storeSelect.value,
-            product_id: productSelect.value,
-            api_key: apiKeyInput.value,
-            openai_key: provider === 'openai' ? document.getElementById('openai-key').value : '',
-            gemini_key: provider === 'gemini' ? document.getElementById('gemini-key').value : '',
-            rules: {
-                ai_provider: provider,
-                ollama_model: document.getElementById('ollama-model').value,
-                title_source: document.querySelector('input[name="title-source"]:checked').value,
-                ai_title_mode: document.querySelector('input[name="ai-title-mode"]:checked')?.value,
-                compound_segments: document.getElementById('compound-segments').value,
-                custom_title_text: document.getElementById('custom-title-text').value,
-                title_template: document.getElementById('title-template').value,
-                desc_source: document.querySelector('input[name="desc-source"]:checked').value,
-                desc_paragraphs: document.getElementById('desc-paragraphs').value,
-                influencer_phrases: document.getElementById('influencer-phrases').value,
-                custom_html: document.getElementById('custom-html').value,
-                tag_source: document.querySelector('input[name="tag-source"]:checked').value,
-                max_ai_tags: document.getElementById('max-ai-tags').value,
-                evergreen_tags: document.getElementById('evergreen-tags').value
-            }
-        };
+        const data = batchRequest();
+        data.preview_id = bulkPreviewId;
 
         fetch('/api/create_products', {
             method: 'POST',
             headers: {'Content-Type': 'application/json'},
             body: JSON.stringify(data)
-        }).then(res => res.json()).then(() => {
+        }).then(res => res.json()).then(result => {
+            showValidation(result.validation);
+            if (result.error) {
+                progressStatus.textContent = 'Status: error';
+                progressMessage.textContent = result.error;
+                return;
+            }
+            currentJobId = result.job_id;
             // Start polling progress
             progressInterval = setInterval(updateProgress, 1000);
         });
     });
 
+    // Earlier runs, newest first, a page at a time; each links to its full results export
+    let historyCursor = null;
+    function loadHistory(reset) {
+        const historyList = document.getElementById('history-list');
+        if (reset) {
+            historyList.innerHTML = '';
+            historyCursor = null;
+        }
+        const params = new URLSearchParams({limit: 20});
+        if (historyCursor) {
+            params.set('cursor', historyCursor);
+        }
+        fetch('/api/history?' + params)
+            .then(res => res.json())
+            .then(data => {
+                data.items.forEach(run => {
+                    const div = document.createElement('div');
+                    const started = new Date(run.started * 1000).toLocaleString();
+                    div.textContent = `${started} (${run.source}, ${run.status}): ${run.created} created, ${run.failed} failed `;
+                    ['csv', 'jsonl'].forEach(format => {
+                        const link = document.createElement('a');
+                        link.href = `/api/history/${run.job_id}/export?format=${format}`;
+                        link.textContent = format.toUpperCase();
+                        div.appendChild(link);
+                        div.appendChild(document.createTextNode(' '));
+                    });
+                    historyList.appendChild(div);
+                });
+                historyCursor = data.next_cursor;
+                document.getElementById('more-history').style.display = historyCursor ? '' : 'none';
+            });
+    }
+    document.getElementById('load-history').addEventListener('click', () => loadHistory(true));
+    document.getElementById('more-history').addEventListener('click', () => loadHistory(false));
+
+    // Preview the copy for every selected image; results arrive one JSON line per image
+    document.getElementById('bulk-preview').addEventListener('click', function() {
+        if (uploadedFiles.length === 0) {
+            alert('Please select at least one image file.');
+            return;
+        }
+        const resultsDiv = document.getElementById('bulk-preview-results');
+        resultsDiv.innerHTML = '';
+        bulkPreviewId = null;
+        fetch('/api/bulk_preview', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                images: uploadedFiles,
+                store_id: storeSelect.value,
+                product_id: productSelect.value,
+                api_key: apiKeyInput.value,
+                openai_key: document.getElementById('openai-key').value,
+                gemini_key: document.getElementById('gemini-key').value,
+                rules: collectRules()
+            })
+        }).then(res => {
+            const reader = res.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            function read() {
+                return reader.read().then(({done, value}) => {
+                    buffer += decoder.decode(value || new Uint8Array(), {stream: !done});
+                    const lines = buffer.split('\n');
+                    buffer = done ? '' : lines.pop();
+                    lines.filter(line => line.trim()).forEach(line => showPreviewRecord(JSON.parse(line)));
+                    if (!done) {
+                        return read();
+                    }
+                });
+            }
+            return read();
+        });
+    });
+
+    function showPreviewRecord(record) {
+        const resultsDiv = document.getElementById('bulk-preview-results');
+        if (record.preview_id) {
+            bulkPreviewId = record.preview_id;
+            return;
+        }
+        if (record.error && !record.image) {
+            resultsDiv.textContent = record.error;
+            return;
+        }
+        const item = document.createElement('div');
+        item.className = 'preview-item';
+        const name = document.createElement('strong');
+        name.textContent = record.name || record.image;
+        item.appendChild(name);
+        const text = document.createElement('p');
+        text.textContent = record.error ? 'Error: ' + record.error : `${record.title} | ${(record.tags || []).join(', ')}`;
+        item.appendChild(text);
+        if (record.description) {
+            item.appendChild(sanitizedDescription(record.description));
+        }
+        resultsDiv.appendChild(item);
+    }
+
+    // Model output is untrusted: keep only the formatting tags a product description uses
+    const DESCRIPTION_TAGS = ['P', 'BR', 'STRONG', 'B', 'EM', 'I', 'U', 'UL', 'OL', 'LI'];
+
+    function sanitizedDescription(html) {
+        const parsed = new DOMParser().parseFromString(html, 'text/html');  // inert: nothing runs or loads
+        const container = document.createElement('div');
+        (function copyInto(source, target) {
+            source.childNodes.forEach(node => {
+                if (node.nodeType === Node.TEXT_NODE) {
+                    target.appendChild(document.createTextNode(node.textContent));
+                } else if (node.nodeType === Node.ELEMENT_NODE && DESCRIPTION_TAGS.includes(node.tagName)) {
+                    copyInto(node, target.appendChild(document.createElement(node.tagName)));
+                } else if (node.nodeType === Node.ELEMENT_NODE && !['SCRIPT', 'STYLE'].includes(node.tagName)) {
+                    copyInto(node, target);  // drop the tag and its attributes, keep its text
+                }
+            });
+        })(parsed.body, container);
+        return container;
+    }
+
+    // Publish again the products whose publish failed, without re-creating them
+    document.getElementById('retry-publish').addEventListener('click', function() {
+        fetch('/api/publish', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({store_id: storeSelect.value, api_key: apiKeyInput.value, job_id: currentJobId})
+        }).then(res => res.json()).then(result => {
+            progressMessage.textContent = result.message;
+            if (result.count) {
+                // Queued jobs report the retry under their job id; in-process progress ignores it
+                progressInterval = setInterval(updateProgress, 1000);
+            }
+        });
+    });
+
+    // Regenerate copy for the store's existing products
+    const updateProductsBtn = document.getElementById('update-products');
+    updateProductsBtn.addEventListener('click', function() {
+        if (!storeSelect.value) {
+            alert('Please select a store.');
+            return;
+        }
+        const dryRun = document.getElementById('update-dry-run').checked;
+        if (!dryRun && !confirm('Are you sure you want to overwrite the AI-generated fields of every product in this store?')) {
+            return;
+        }
+        document.getElementById('update-diff').innerHTML = '';
+
+        fetch('/api/update_products', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                store_id: storeSelect.value,
+                dry_run: dryRun,
+                api_key: apiKeyInput.value,
+                openai_key: document.getElementById('openai-key').value,
+                gemini_key: document.getElementById('gemini-key').value,
+                rules: collectRules()
+            })
+        }).then(res => res.json()).then(result => {
+            currentJobId = result.job_id;
+            cancelBtn.disabled = false;
+            progressInterval = setInterval(updateProgress, 1000);
+        });
+    });
+
+    function showUpdateDiff() {
+        fetch('/api/update_diff?limit=100')
+            .then(res => res.json())
+            .then(data => {
+                const diffDiv = document.getElementById('update-diff');
+                diffDiv.innerHTML = `<p>${data.total} product(s) with changes${data.total > data.items.length ? ` (showing first ${data.items.length})` : ''}:</p>`;
+                data.items.forEach(item => {
+                    const div = document.createElement('div');
+                    const changes = Object.entries(item.changes)
+                        .map(([field, change]) => `${field}: ${JSON.stringify(change.old)} → ${JSON.stringify(change.new)}`)
+                        .join('; ');
+                    div.textContent = `${item.product_id} [${item.status}] ${item.error || changes}`;
+                    diffDiv.appendChild(div);
+                });
+            });
+    }
+
+    function collectRules() {
+        const provider = document.getElementById('ai-provider').value;
+        return {
+            ai_provider: provider,
+            fallback_provider: document.getElementById('fallback-provider').value,
+            ollama_model: document.getElementById('ollama-model').value,
+            title_source: document.querySelector('input[name="title-source"]:checked').value,
+            ai_title_mode: document.querySelector('input[name="ai-title-mode"]:checked')?.value,
+            compound_segments: document.getElementById('compound-segments').value,
+            custom_title_text: document.getElementById('custom-title-text').value,
+            title_template: document.getElementById('title-template').value,
+            desc_source: document.querySelector('input[name="desc-source"]:checked').value,
+            desc_paragraphs: document.getElementById('desc-paragraphs').value,
+            influencer_phrases: document.getElementById('influencer-phrases').value,
+            custom_html: document.getElementById('custom-html').value,
+            tag_source: document.querySelector('input[name="tag-source"]:checked').value,
+            max_ai_tags: document.getElementById('max-ai-tags').value,
+            evergreen_tags: document.getElementById('evergreen-tags').value,
+            group_similar: document.getElementById('group-similar').checked,
+            similarity_threshold: document.getElementById('similarity-threshold').value,
+            budget: document.getElementById('ai-budget').value,
+            budget_route: document.getElementById('budget-route').value,
+            publish: document.getElementById('publish-products').checked
+        };
+    }
+
     function updateProgress() {
-        fetch('/api/progress')
+        fetch('/api/progress' + (currentJobId ? `?job_id=${currentJobId}` : ''))
             .then(res => res.json())
             .then(data => {
                 progressStatus.textContent = `Status: ${data.status}`;
                 document.getElementById('progress-text').textContent = `Progress: ${data.current}/${data.total}`;
                 progressMessage.textContent = data.message;
+                if (data.published !== null && data.published !== undefined) {
+                    document.getElementById('progress-text').textContent += ` | Published: ${data.published}` +
+                        (data.publish_failed ? `, ${data.publish_failed} failed` : '');
+                    document.getElementById('retry-publish').style.display = data.publish_failed ? 'inline-block' : 'none';
+                }
+                if (data.ai_usage) {
+                    const usage = data.ai_usage.total;
+                    document.getElementById('progress-text').textContent += ` | AI: ${usage.calls} calls, ${usage.prompt_tokens + usage.completion_tokens} tokens, ~$${usage.cost.toFixed(2)}`;
+                }
                 if (data.status === 'completed' || data.status === 'cancelled' || data.status === 'error') {
                     clearInterval(progressInterval);
                     cancelBtn.disabled = true;
+                    if (data.mode === 'update') {
+                        showUpdateDiff();
+                    }
                 }
             });
     }
@@ -256,7 +530,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // Cancel
     cancelBtn.addEventListener('click', function() {
         fetch('/api/cancel', {
-            method: 'POST'
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({job_id: currentJobId})
         }).then(res => res.json()).then(() => {
             clearInterval(progressInterval);
             progressStatus.textContent = 'Status: Cancelled';
@@ -341,6 +617,26 @@ function validatePrintifyKey() {
     });
 }
 
+// Preview routes answer with a task id; wait for the task and resolve with its result
+function requestPreview(url, body) {
+    return fetch(url, {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(body)
+    })
+    .then(res => res.json())
+    .then(task => task.task_id ? pollPreview(task.task_id) : task);
+}
+
+// Poll with short waits so a pending preview never holds a server worker for long
+function pollPreview(taskId) {
+    return fetch(`/api/preview/${taskId}?wait=1`)
+        .then(res => res.json())
+        .then(data => data.status === 'pending'
+            ? new Promise(resolve => setTimeout(resolve, 500)).then(() => pollPreview(taskId))
+            : data);
+}
+
 function validateOpenAIKey() {
     const openaiKey = document.getElementById('openai-key').value;
     const statusDiv = document.getElementById('openai-status');
@@ -350,12 +646,7 @@ function validateOpenAIKey() {
     }
     statusDiv.textContent = 'Validating OpenAI API Key...';
     statusDiv.style.color = 'orange';
-    fetch('/api/generate_title', {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({provider: 'openai', openai_key: openaiKey, mode: 'simple'})
-    })
-    .then(res => res.json())
+    requestPreview('/api/generate_title', {provider: 'openai', openai_key: openaiKey, mode: 'simple'})
     .then(data => {
         if (data.error) {
             statusDiv.textContent = 'Invalid OpenAI API Key: ' + data.error;
@@ -380,12 +671,7 @@ function validateGeminiKey() {
     }
     statusDiv.textContent = 'Validating Gemini API Key...';
     statusDiv.style.color = 'orange';
-    fetch('/api/generate_title', {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({provider: 'gemini', gemini_key: geminiKey, mode: 'simple'})
-    })
-    .then(res => res.json())
+    requestPreview('/api/generate_title', {provider: 'gemini', gemini_key: geminiKey, mode: 'simple'})
     .then(data => {
         if (data.error) {
             statusDiv.textContent = 'Invalid Gemini API Key: ' + data.error;
@@ -405,12 +691,7 @@ function validateOllama() {
     const statusDiv = document.getElementById('api-status'); // Use general status since no specific Ollama status div
     statusDiv.textContent = 'Checking Ollama connection...';
     statusDiv.style.color = 'orange';
-    fetch('/api/generate_title', {
-        method: 'POST',
-        headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({provider: 'ollama', mode: 'simple'})
-    })
-    .then(res => res.json())
+    requestPreview('/api/generate_title', {provider: 'ollama', mode: 'simple'})
     .then(data => {
         if (data.error) {
             statusDiv.textContent = 'Ollama not available: ' + data.error;
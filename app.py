@@ -5,12 +5,26 @@ import json
 from werkzeug.utils import secure_filename
 import threading
 import time
-import google.generativeai as genai
 import base64
 from PIL import Image
 import io
 import logging
 import re
+import collections
+import copy
+import functools
+import importlib
+import hashlib
+import hmac
+import itertools
+import math
+import uuid
+from urllib.parse import quote, urlsplit
+import artifacts
+import jobqueue
+import resultstore
+import uploadstore
+from concurrent.futures import Future, ThreadPoolExecutor, wait, as_completed, TimeoutError as FuturesTimeoutError
 
 # Suppress Google Generative AI warnings
 logging.getLogger('absl').setLevel(logging.ERROR)
@@ -51,7 +65,8 @@ app = Flask(__name__)
 logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
 logging.getLogger('grpc').setLevel(logging.CRITICAL)  # Suppress gRPC warnings
 app.logger.disabled = True
-app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your_secret_key_here')
+DEFAULT_SECRET_KEY = 'your_secret_key_here'
+app.secret_key = os.environ.get('FLASK_SECRET_KEY', DEFAULT_SECRET_KEY)
 
 # Persistent storage for API keys
 KEYS_FILE = 'api_keys.json'
@@ -86,14 +101,110 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+upload_store = uploadstore.UploadStore(UPLOAD_FOLDER)
+
+# With ARTIFACT_BASE_URL set, stored uploads are registered with Printify by URL instead
+# of as base64 in the request body. Printify fetches them from /artifacts/ through signed
+# links that expire after ARTIFACT_URL_TTL seconds, served by artifacts.py on a public host
+# (or by this app behind a proxy that forwards only /artifacts/). Requests reaching this
+# app under the ARTIFACT_BASE_URL host are limited to /artifacts/, and URL mode is refused
+# while links would be signed with the default secret key.
+ARTIFACT_BASE_URL = os.environ.get('ARTIFACT_BASE_URL', '').rstrip('/')
+ARTIFACT_URL_TTL = int(os.environ.get('ARTIFACT_URL_TTL', 900))
+ARTIFACT_SECRET = artifacts.ARTIFACT_SECRET
+if ARTIFACT_BASE_URL and ARTIFACT_SECRET in (None, DEFAULT_SECRET_KEY):
+    print('ARTIFACT_BASE_URL ignored: set ARTIFACT_SECRET (or FLASK_SECRET_KEY) to a private value to upload by URL')
+    ARTIFACT_BASE_URL = ''
+ARTIFACT_HOST = urlsplit(ARTIFACT_BASE_URL).netloc.lower()
+
+@app.before_request
+def restrict_artifact_host():
+    if ARTIFACT_HOST and request.host.lower() == ARTIFACT_HOST and not request.path.startswith('/artifacts/'):
+        return jsonify({'error': 'Not found'}), 404
 
 # Global variables for progress
 progress = {'status': 'idle', 'current': 0, 'total': 0, 'message': ''}
 cancel_operation = False
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 16))
+update_diffs = []  # per-product changes of the last catalogue update job
+# With JOB_DB set, create jobs go through the durable queue in jobqueue.py and are
+# processed by separate worker processes; otherwise they run in this process.
+JOB_DB = os.environ.get('JOB_DB')
+job_queue = jobqueue.JobQueue(JOB_DB) if JOB_DB else None
+# Every image of every create run is recorded here for history and export (see resultstore.py)
+result_store = resultstore.ResultStore(os.environ.get('RESULTS_DB', 'results.db'))
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Printify API calls made by background jobs share one session (connection
+# reuse) and a token bucket per API key, so concurrent workers stay under
+# Printify's request rate limit. With JOB_DB the bucket lives in the database
+# and is shared by every process. 429 responses are retried after Retry-After.
+PRINTIFY_API = os.environ.get('PRINTIFY_API', 'https://api.printify.com/v1').rstrip('/')  # printify_stub.py for local testing
+PRINTIFY_RATE_LIMIT = float(os.environ.get('PRINTIFY_RATE_LIMIT', 600))  # requests per minute
+printify_session = requests.Session()
+printify_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=BATCH_WORKERS))
+printify_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=BATCH_WORKERS))
+
+class RateLimiter:
+    """Token bucket allowing rate_per_minute requests with bursts of up to burst."""
+
+    def __init__(self, rate_per_minute, burst=10):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+class SharedRateLimiter:
+    """Token bucket kept in the job database, so all web and worker processes share one rate."""
+
+    def __init__(self, queue, name, rate_per_minute, burst=10):
+        self.queue = queue
+        self.name = name
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+
+    def wait(self):
+        while True:
+            delay = self.queue.take_token(self.name, self.rate, self.burst)
+            if not delay:
+                return
+            time.sleep(delay)
+
+printify_limiters = {}
+printify_limiters_lock = threading.Lock()
+
+def printify_request(method, path, api_key, retries=3, **kwargs):
+    """Rate-limited request to the Printify API; returns the final response."""
+    with printify_limiters_lock:
+        if api_key not in printify_limiters:
+            printify_limiters[api_key] = (SharedRateLimiter(job_queue, 'printify' + key_fingerprint(api_key), PRINTIFY_RATE_LIMIT)
+                                          if job_queue else RateLimiter(PRINTIFY_RATE_LIMIT))
+        limiter = printify_limiters[api_key]
+    kwargs.setdefault('timeout', 120)
+    headers = {'Authorization': f'Bearer {api_key}'}
+    for attempt in range(retries + 1):
+        limiter.wait()
+        response = printify_session.request(method, f'{PRINTIFY_API}/{path}', headers=headers, **kwargs)
+        if response.status_code != 429 or attempt == retries:
+            return response
+        time.sleep(float(response.headers.get('Retry-After') or 2 ** attempt))
+    return response
+
 @app.route('/')
 def index():
     return send_from_directory('.', 'index.html')  
@@ -115,7 +226,7 @@ def get_stores():
     # Fetch from Printify
     headers = {'Authorization': f'Bearer {api_key}'}
     try:
-        response = requests.get('https://api.printify.com/v1/shops.json', headers=headers)
+        response = requests.get(f'{PRINTIFY_API}/shops.json', headers=headers)
         if response.status_code == 200:
             shops = response.json()
             return jsonify([{'id': shop['id'], 'name': shop['title']} for shop in shops])
@@ -134,7 +245,7 @@ def get_products():
     # Fetch from Printify
     headers = {'Authorization': f'Bearer {api_key}'}
     try:
-        response = requests.get(f'https://api.printify.com/v1/shops/{store_id}/products.json', headers=headers)
+        response = requests.get(f'{PRINTIFY_API}/shops/{store_id}/products.json', headers=headers)
         if response.status_code == 200:
             products = response.json()['data']
             return jsonify([{'id': prod['id'], 'title': prod['title']} for prod in products])
@@ -149,22 +260,51 @@ def upload_files():
         return jsonify({'error': 'No files'}), 400
     files = request.files.getlist('files')
     uploaded = []
+    errors = []
     for file in files:
         if file and allowed_file(file.filename):
-            filename = secure_filename(str(file.filename))
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-            uploaded.append(filename)
-    return jsonify({'uploaded': uploaded})
+            # Files are stored by content; the returned id is what the other routes take as an image
+            try:
+                record = upload_store.save(file.stream, secure_filename(str(file.filename)))
+            except (OSError, ValueError) as e:
+                errors.append({'name': file.filename, 'error': str(e)})
+                continue
+            uploaded.append({'id': record['sha256'], 'name': record['name'], 'width': record['width'],
+                             'height': record['height'], 'duplicate': record['duplicate']})
+    return jsonify({'uploaded': uploaded, 'errors': errors})
+
+@app.route('/api/uploads', methods=['GET'])
+def list_uploads():
+    """Stored uploads, newest first: ?limit=, ?cursor= (next_cursor of the previous page), ?processed=0|1."""
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    processed = request.args.get('processed', type=int)
+    return jsonify(upload_store.listing(limit, request.args.get('cursor'), processed))
+
+def artifact_url(img):
+    """Signed, expiring URL Printify can fetch a stored upload from, or None to send it inline."""
+    if not ARTIFACT_BASE_URL or not upload_store.is_id(img):
+        return None
+    expires = int(time.time()) + ARTIFACT_URL_TTL
+    name = quote(secure_filename(image_name(img)) or 'image')
+    return f'{ARTIFACT_BASE_URL}/artifacts/{img}/{name}?expires={expires}&signature={artifacts.signature(ARTIFACT_SECRET, img, expires)}'
+
+@app.route('/artifacts/<file_id>/<name>', methods=['GET'])
+def serve_artifact(file_id, name):
+    """A stored upload behind a link from artifact_url(), for setups proxying /artifacts/ to this app."""
+    return artifacts.serve(upload_store, ARTIFACT_SECRET if ARTIFACT_BASE_URL else None, file_id)
 
 @app.route('/api/delete_file', methods=['POST'])
 def delete_file():
     data = request.json
-    filename = data.get('filename')
+    filename = data.get('id') or data.get('filename')
     if not filename:
         return jsonify({'error': 'Filename not provided'}), 400
 
     try:
+        if upload_store.is_id(filename):
+            if upload_store.delete(filename):
+                return jsonify({'success': True, 'message': 'File deleted.'})
+            return jsonify({'error': 'File not found'}), 404
         secure_name = secure_filename(str(filename))
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_name)
         if os.path.exists(file_path):
@@ -179,7 +319,7 @@ def delete_file():
 def create_products():
     data = request.json
     # Extract data: images, placement_mode, store_id, product_id, rules
-    images = data['images']
+    images = [secure_filename(str(img)) for img in data['images']]
     placement_mode = data['placement_mode']
     store_id = data['store_id']
     product_id = data['product_id']
@@ -188,854 +328,1946 @@ def create_products():
     rules['api_key'] = data.get('api_key')
     rules['openai_key'] = data.get('openai_key')
     rules['gemini_key'] = data.get('gemini_key')
+    rules['job_id'] = uuid.uuid4().hex[:12]
+    if data.get('preview_id'):
+        # Reuse the AI copy reviewed in a bulk preview instead of generating it again;
+        # filename and template fields are always built fresh from this request's rules
+        rules['copy_overrides'] = {img: ai_fields(copy, rules) for img, copy in load_bulk_preview(data['preview_id']).items()}
+
+    # Nothing is uploaded or generated unless the whole batch passes the pre-flight checks
+    report, example_product = validate_batch(images, store_id, product_id, rules)
+    if not report['ok']:
+        return jsonify({'error': 'Batch failed validation', 'validation': report}), 400
+
+    result_store.start_run(rules['job_id'], 'queue' if job_queue else 'web', store_id, product_id, len(images))
+    if job_queue:
+        # Worker processes pick up the images; the template fetched above goes with the job
+        apply_example_product(rules, example_product)
+        job_queue.create_job(rules['job_id'], store_id, example_product, rules, images)
+        return jsonify({'message': 'Creation queued', 'job_id': rules['job_id'], 'validation': report})
 
     # Start background thread for creation
-    threading.Thread(target=create_products_background, args=(images, placement_mode, store_id, product_id, rules)).start()
-    return jsonify({'message': 'Creation started'})
+    threading.Thread(target=run_create_job, args=(images, placement_mode, store_id, product_id, rules, example_product)).start()
+    return jsonify({'message': 'Creation started', 'job_id': rules['job_id'], 'validation': report})
+
+@app.route('/api/validate', methods=['POST'])
+def validate_products():
+    """Pre-flight report for a batch, taking the same body as /api/create_products."""
+    data = request.json
+    images = [secure_filename(str(img)) for img in data['images']]
+    rules = data['rules']
+    rules['api_key'] = data.get('api_key')
+    rules['openai_key'] = data.get('openai_key')
+    rules['gemini_key'] = data.get('gemini_key')
+    report, _ = validate_batch(images, data.get('store_id'), data.get('product_id'), rules)
+    return jsonify(report)
+
+# Bulk previews: copy for a whole batch, streamed as NDJSON while it is
+# generated and kept so /api/create_products can publish exactly what was reviewed.
+BULK_PREVIEW_TTL = 24 * 3600
+bulk_previews = {}  # preview id -> (created, {image: copy})
+bulk_previews_lock = threading.Lock()
+
+def ai_fields(copy, rules):
+    """The fields of copy whose source in rules is the AI provider."""
+    return {field: value for field, value in copy.items() if field in SOURCE_RULES and rules.get(SOURCE_RULES[field]) == 'ai'}
+
+def save_bulk_preview(preview_id, img, copy):
+    if job_queue:
+        job_queue.save_preview(preview_id, img, copy)
+        return
+    with bulk_previews_lock:
+        now = time.time()
+        for stale in [pid for pid, (created, _) in bulk_previews.items() if now - created > BULK_PREVIEW_TTL]:
+            del bulk_previews[stale]
+        bulk_previews.setdefault(preview_id, (now, {}))[1][img] = copy
+
+def load_bulk_preview(preview_id):
+    if job_queue:
+        return job_queue.load_preview(preview_id)
+    with bulk_previews_lock:
+        return dict(bulk_previews.get(preview_id, (0, {}))[1])
+
+@app.route('/api/bulk_preview', methods=['POST'])
+def bulk_preview():
+    """Generate copy for every image concurrently, streaming one JSON line per image as it finishes.
+
+    The first line carries the preview_id to pass to /api/create_products, which
+    reuses the AI-generated fields. Images whose generation failed are reported with
+    an error and generated again at creation. Status messages go into each line's
+    messages rather than the batch progress.
+    """
+    data = request.json
+    images = [secure_filename(str(img)) for img in data['images']]
+    rules = data['rules']
+    rules['custom_html'] = data.get('custom_html', rules.get('custom_html', ''))
+    rules['api_key'] = data.get('api_key')
+    rules['openai_key'] = data.get('openai_key')
+    rules['gemini_key'] = data.get('gemini_key')
+    rules['raise_ai_errors'] = True  # report failures instead of storing placeholder copy
+    preview_id = rules['job_id'] = uuid.uuid4().hex[:12]
+    if data.get('store_id') and data.get('product_id') and rules['api_key']:
+        try:
+            apply_example_product(rules, fetch_example_product(data['store_id'], data['product_id'], rules['api_key']))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    messages = []
+    clusters = call_logged(messages, copy_clusters, images, rules)
+
+    def stream():
+        yield json.dumps({'preview_id': preview_id, 'total': len(images), 'messages': messages}) + '\n'
+        pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+        try:
+            futures = {}
+            for img in images:
+                record = {'image': img, 'name': image_name(img), 'messages': []}
+                futures[pool.submit(call_logged, record['messages'], generate_copy, img, rules, None, clusters)] = record
+            for future in as_completed(futures):
+                record = futures[future]
+                try:
+                    copy = future.result()
+                    save_bulk_preview(preview_id, record['image'], ai_fields(copy, rules))
+                    record.update(copy)
+                except Exception as e:
+                    record['error'] = str(e)
+                yield json.dumps(record) + '\n'
+        finally:
+            # The client may disconnect mid-stream; drop the work it no longer wants
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    return app.response_class(stream(), mimetype='application/x-ndjson')
+
+@app.route('/api/history', methods=['GET'])
+def get_history():
+    """Create runs, newest first, with created/failed counts: ?limit=, ?cursor= (next_cursor of the previous page)."""
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    return jsonify(result_store.runs(limit, request.args.get('cursor')))
+
+@app.route('/api/history/<job_id>', methods=['GET'])
+def get_run_results(job_id):
+    """A run and one page of its results: ?limit=, ?after= (next_after of the previous page), ?status=created|failed."""
+    run = result_store.run(job_id)
+    if run is None:
+        return jsonify({'error': 'Run not found'}), 404
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    return jsonify({'run': run, **result_store.results(job_id, limit, request.args.get('after', 0, type=int), request.args.get('status'))})
+
+@app.route('/api/history/<job_id>/export', methods=['GET'])
+def export_run(job_id):
+    """Stream every result of a run as ?format=csv or jsonl (default), optionally only ?status=created|failed."""
+    export_format = request.args.get('format', 'jsonl')
+    if export_format not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+    if result_store.run(job_id) is None:
+        return jsonify({'error': 'Run not found'}), 404
+    return app.response_class(result_store.export(job_id, export_format, request.args.get('status')),
+                              mimetype='text/csv' if export_format == 'csv' else 'application/x-ndjson',
+                              headers={'Content-Disposition': f'attachment; filename=results-{job_id}.{export_format}'})
+
+@app.route('/api/update_products', methods=['POST'])
+def update_products():
+    data = request.json
+    # Extract data: store_id, product_ids (empty for the whole store), rules, dry_run, image_source
+    store_id = data['store_id']
+    product_ids = data.get('product_ids') or []
+    dry_run = data.get('dry_run', True)
+    image_source = data.get('image_source', 'mockup')
+    rules = data['rules']
+    rules['custom_html'] = data.get('custom_html', rules.get('custom_html', ''))
+    rules['api_key'] = data.get('api_key')
+    rules['openai_key'] = data.get('openai_key')
+    rules['gemini_key'] = data.get('gemini_key')
+    rules['job_id'] = uuid.uuid4().hex[:12]
+
+    threading.Thread(target=update_products_background, args=(store_id, product_ids, rules, dry_run, image_source)).start()
+    return jsonify({'message': 'Update started', 'job_id': rules['job_id']})
+
+@app.route('/api/update_diff', methods=['GET'])
+def get_update_diff():
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    return jsonify({'total': len(update_diffs), 'items': update_diffs[offset:offset + limit]})
+
+# Bulk previews share the copy generation code with batches but must not overwrite
+# the running batch's status; their threads log into the preview's own records.
+preview_log = threading.local()
 
 def log_message(message, log_type='info'):
     global progress
+    messages = getattr(preview_log, 'messages', None)
+    if messages is not None:
+        messages.append(message)
+        return
     progress['message'] = message
 
-def create_products_background(images, placement_mode, store_id, product_id, rules):
+def call_logged(messages, function, *args):
+    """Call function with this thread's log_message calls appended to messages instead of the progress."""
+    preview_log.messages = messages
+    try:
+        return function(*args)
+    finally:
+        preview_log.messages = None
+
+def run_create_job(images, placement_mode, store_id, product_id, rules, example_product=None):
+    """Run create_products_background and record how the run ended in the results store."""
+    try:
+        create_products_background(images, placement_mode, store_id, product_id, rules, example_product)
+    finally:
+        result_store.finish_run(rules['job_id'], progress['status'] if progress['status'] != 'working' else 'error')
+
+def create_products_background(images, placement_mode, store_id, product_id, rules, example_product=None):
     global progress, cancel_operation
     progress['status'] = 'working'
     progress['total'] = len(images)
     progress['current'] = 0
+    progress['job_id'] = rules.get('job_id')
+    progress['started'] = time.time()
+    progress['mode'] = 'create'
+    progress['groups'] = None
+    progress['published'] = progress['publish_failed'] = None
     cancel_operation = False
 
     api_key = rules.get('api_key')
-    gemini_key = rules.get('gemini_key')
 
     if not api_key:
         progress['status'] = 'error'
         log_message('Printify API key required', 'error')
         return
 
-    headers = {'Authorization': f'Bearer {api_key}'}
     log_message(f'Using API key: {api_key[:10]}...')
 
-    log_message(f'Fetching example product (ID: {product_id}) from store {store_id}...')
-    response = requests.get(f'https://api.printify.com/v1/shops/{store_id}/products/{product_id}.json', headers=headers)
-    
-    if response.status_code != 200:
-        progress['status'] = 'error'
-        log_message(f'Failed to fetch example product: {response.text}', 'error')
-        return
-        
-    example_product = response.json()
-    rules['example_title'] = example_product.get('title', '')
-    rules['example_desc'] = example_product.get('description', '')
-    rules['example_tags'] = example_product.get('tags', [])
+    if example_product is None:
+        log_message(f'Fetching example product (ID: {product_id}) from store {store_id}...')
+        try:
+            example_product = fetch_example_product(store_id, product_id, api_key)
+        except ValueError as e:
+            progress['status'] = 'error'
+            log_message(str(e), 'error')
+            return
+    apply_example_product(rules, example_product)
     log_message(f'Example product fetched: {example_product.get("title", "Unknown")}')
 
-    for i, img in enumerate(images):
-        if cancel_operation:
-            progress['status'] = 'cancelled'
-            log_message('Operation cancelled by user', 'info')
-            return
-            
-        progress['current'] = i + 1
-        log_message(f'Processing image {i+1}/{len(images)}: {img}')
+    clusters = copy_clusters(images, rules)
+    if clusters:
+        progress['groups'] = len(set(clusters.leaders.values()))
 
-        secure_img = secure_filename(str(img))
-        img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
+    # Images are processed concurrently; the AI limiters decide how many
+    # provider calls are actually in flight. The first failure stops the batch.
+    failed = threading.Event()
+    progress_lock = threading.Lock()
+    # Products are published while the rest of the batch is still being created
+    publisher = PublishStage(store_id, api_key) if rules.get('publish') else None
 
-        if not os.path.exists(img_path):
-            progress['status'] = 'error'
-            log_message(f"File not found: {secure_img}", 'error')
+    def worker(img):
+        if cancel_operation or failed.is_set():
+            return
+        result = create_single_product(img, example_product, store_id, api_key, rules, rules.get('copy_overrides', {}).get(img), clusters)
+        result_store.add(rules['job_id'], result, image_name(img))
+        if result.get('error'):
+            if not failed.is_set():
+                failed.set()
+                progress['status'] = 'error'
+                log_message(result['error'], 'error')
             return
+        with progress_lock:
+            progress['current'] += 1
+        if publisher:
+            publisher.submit(result['product_id'], img)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(images)))) as pool:
+        list(pool.map(worker, images))
+    if publisher:
+        log_message('Waiting for products to finish publishing...')
+        published, publish_failed = publisher.wait()
+        log_message(f'Published {published} products, {publish_failed} failed', 'error' if publish_failed else 'info')
+
+    if failed.is_set():
+        return
+    if cancel_operation:
+        progress['status'] = 'cancelled'
+        log_message('Operation cancelled by user', 'info')
+        return
 
-        log_message(f'Uploading {secure_img} to Printify...')
-        with open(img_path, 'rb') as f:
-            file_contents = base64.b64encode(f.read()).decode('utf-8')
-        
+    progress['status'] = 'completed'
+    if publisher and publish_failed:
+        log_message(f'All products created; {publish_failed} failed to publish and can be retried', 'info')
+        return
+    log_message('All products created successfully!', 'info')
+
+# Publishing pushes created products to the shop's sales channel. Publishes
+# run alongside creation on their own pool, share the Printify rate limiter,
+# and a failed publish can be retried later without re-creating the product.
+PUBLISH_RETRIES = 3
+PUBLISH_FIELDS = {'title': True, 'description': True, 'images': True, 'variants': True, 'tags': True,
+                  'keyFeatures': True, 'shipping_template': True}
+publish_results = {}  # product id -> latest publish record
+publish_lock = threading.Lock()
+
+def publish_product(store_id, product_id, api_key, retries=PUBLISH_RETRIES):
+    """Publish one product, retrying network and server errors. Returns (published, error, attempts)."""
+    error = None
+    for attempt in range(1, retries + 1):
         try:
-            upload_response = requests.post('https://api.printify.com/v1/uploads/images.json', headers=headers, json={'file_name': secure_img, 'contents': file_contents})
-            upload_response.raise_for_status()
-            image_id = upload_response.json()['id']
-            log_message(f'Uploaded image ID: {image_id}')
+            response = printify_request('POST', f'shops/{store_id}/products/{product_id}/publish.json', api_key, json=PUBLISH_FIELDS)
+            if response.status_code < 400:
+                return True, None, attempt
+            error = f'Publish failed ({response.status_code}): {response.text[:200]}'
+            if response.status_code < 500:
+                break  # the request itself is wrong; retrying won't help
         except requests.exceptions.RequestException as e:
-            progress['status'] = 'error'
-            log_message(f"Failed to upload {img}: {e}", 'error')
-            return
+            error = f'Publish failed: {e}'
+        if attempt < retries:
+            time.sleep(2 ** attempt)
+    return False, error, attempt
+
+class PublishStage:
+    """Publishes products concurrently, tracking each one in publish_results and progress.
+
+    With job_id of a queued job, each outcome is also written back to the job database.
+    """
+
+    def __init__(self, store_id, api_key, job_id=None):
+        self.store_id = store_id
+        self.api_key = api_key
+        self.job_id = job_id if job_queue else None
+        self.pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='publish')
+        self.futures = []
+        progress['published'] = 0
+        progress['publish_failed'] = 0
+
+    def submit(self, product_id, img=None):
+        record = {'product_id': product_id, 'image': img, 'status': 'pending', 'error': None, 'attempts': 0}
+        with publish_lock:
+            record['attempts'] = publish_results.get(product_id, record)['attempts']
+            publish_results[product_id] = record
+        if self.job_id:
+            job_queue.set_published(self.job_id, product_id, 'pending')
+        self.futures.append(self.pool.submit(self.publish, record))
+
+    def publish(self, record):
+        published, error, attempts = publish_product(self.store_id, record['product_id'], self.api_key)
+        with publish_lock:
+            record.update(status='published' if published else 'failed', error=error, attempts=record['attempts'] + attempts)
+            progress['published' if published else 'publish_failed'] += 1
+        if self.job_id:
+            job_queue.set_published(self.job_id, record['product_id'], published, error, attempts)
+        result_store.mark_published(record['product_id'], published, error)
+        if error:
+            log_message(f"{error} (product {record['product_id']})", 'error')
+
+    def wait(self):
+        """Block until every submitted publish has finished; returns (published, failed)."""
+        wait(self.futures)
+        self.pool.shutdown()
+        return progress['published'], progress['publish_failed']
+
+def publish_products_background(store_id, product_ids, api_key, job_id=None):
+    """Publish (or retry publishing) already created products, of the queued job job_id if given."""
+    global progress
+    progress.update({'status': 'working', 'current': 0, 'total': len(product_ids), 'job_id': None,
+                     'started': time.time(), 'mode': 'publish'})
+    log_message(f'Publishing {len(product_ids)} products...')
+    publisher = PublishStage(store_id, api_key, job_id)
+    for product_id in product_ids:
+        publisher.submit(product_id, publish_results.get(product_id, {}).get('image'))
+    published, failed = publisher.wait()
+    progress['current'] = published
+    progress['status'] = 'completed'
+    log_message(f'Published {published} products, {failed} failed', 'info')
+
+@app.route('/api/publish', methods=['POST'])
+def publish_products():
+    """Publish products by id; without product_ids, retry every failed publish (of job_id when queued)."""
+    data = request.json
+    store_id = data['store_id']
+    product_ids = data.get('product_ids')
+    job_id = data.get('job_id') if job_queue else None
+    if not product_ids and job_id:
+        product_ids = job_queue.unpublished(job_id)
+    if not product_ids:
+        with publish_lock:
+            product_ids = [record['product_id'] for record in publish_results.values() if record['status'] == 'failed']
+    if not product_ids:
+        return jsonify({'message': 'Nothing to publish', 'count': 0})
+    threading.Thread(target=publish_products_background, args=(store_id, product_ids, data.get('api_key'), job_id)).start()
+    return jsonify({'message': 'Publishing started', 'count': len(product_ids)})
+
+@app.route('/api/publish_status', methods=['GET'])
+def get_publish_status():
+    """Per-product publish records, optionally ?status=; ?job_id= reads a queued job's from the job database."""
+    status = request.args.get('status')
+    if job_queue and request.args.get('job_id'):
+        records = job_queue.publish_records(request.args['job_id'])
+    else:
+        with publish_lock:
+            records = [dict(record) for record in publish_results.values()]
+    counts = collections.Counter(record['status'] for record in records)
+    return jsonify({'counts': counts, 'items': [record for record in records if not status or record['status'] == status]})
+
+def fetch_example_product(store_id, product_id, api_key):
+    """Fetch the template product new products are copied from. Raises ValueError on failure."""
+    response = printify_request('GET', f'shops/{store_id}/products/{product_id}.json', api_key)
+    if response.status_code != 200:
+        raise ValueError(f'Failed to fetch example product: {response.text}')
+    return response.json()
 
+def apply_example_product(rules, example_product):
+    rules['example_title'] = example_product.get('title', '')
+    rules['example_desc'] = example_product.get('description', '')
+    rules['example_tags'] = example_product.get('tags', [])
+
+# Pre-flight validation: keys, the template and every image are checked before a
+# batch starts, so a bad file stops it before any upload or AI call is paid for.
+PRINT_DPI = 300  # Printify's placeholder sizes are the pixels needed at this resolution
+MIN_PRINT_DPI = int(os.environ.get('MIN_PRINT_DPI', 150))
+TEMPLATE_FIELDS = ('variants', 'print_areas', 'blueprint_id', 'print_provider_id')
+
+def inspect_image(img):
+    """Validation record for one image: whether it exists and decodes, and its size."""
+    record = {'image': img, 'name': image_name(img), 'errors': [], 'warnings': []}
+    path = resolve_image_path(img)
+    if not os.path.exists(path):
+        record['errors'].append('File not found')
+        return record
+    try:
+        with Image.open(path) as image:
+            image.verify()  # checks the file's integrity without decoding every pixel
+        with Image.open(path) as image:
+            record.update(width=image.width, height=image.height, format=image.format)
+            if image.info.get('dpi'):
+                record['dpi'] = [round(float(value)) for value in image.info['dpi']]
+    except Exception as e:
+        record['errors'].append(f'Not a readable image: {e}')
+    return record
+
+def template_placeholders(example_product, api_key):
+    """Pixel size of each print area the template uses, from the Printify catalog.
+
+    The largest size among the template's enabled variants is used, as that is what
+    one image has to cover.
+    """
+    response = printify_request('GET', f"catalog/blueprints/{example_product['blueprint_id']}/print_providers/"
+                                f"{example_product['print_provider_id']}/variants.json", api_key)
+    response.raise_for_status()
+    enabled = {variant['id'] for variant in example_product['variants'] if variant.get('is_enabled', True)}
+    positions = {placeholder['position'] for area in example_product['print_areas'] for placeholder in area.get('placeholders', [])}
+    sizes = {}
+    for variant in response.json().get('variants', []):
+        if variant['id'] not in enabled:
+            continue
+        for placeholder in variant.get('placeholders', []):
+            if placeholder['position'] in positions:
+                width, height = sizes.get(placeholder['position'], (0, 0))
+                sizes[placeholder['position']] = (max(width, placeholder['width']), max(height, placeholder['height']))
+    return sizes
+
+def check_print_areas(record, placeholders):
+    """Warn when an image would print below MIN_PRINT_DPI or has a different shape than a print area."""
+    for position, (width, height) in placeholders.items():
+        dpi = round(PRINT_DPI * min(record['width'] / width, record['height'] / height))
+        if dpi < MIN_PRINT_DPI:
+            record['warnings'].append(f'{position}: prints at about {dpi} DPI ({width}x{height} px needed for {PRINT_DPI} DPI)')
+        if abs(math.log((record['width'] / record['height']) / (width / height))) > 0.1:
+            record['warnings'].append(f'{position}: aspect ratio differs from the print area ({width}x{height})')
+
+def validate_batch(images, store_id, product_id, rules):
+    """Check a batch before it starts: keys, the template and every image, in parallel.
+
+    Returns (report, example_product). report['ok'] is False if anything would make
+    the batch fail; warnings don't. Only images with errors or warnings are listed.
+    example_product is None if the template couldn't be fetched.
+    """
+    started = time.monotonic()
+    errors, warnings = [], []
+    api_key = rules.get('api_key')
+    if not images:
+        errors.append('No images selected')
+    if not api_key:
+        errors.append('Printify API key required')
+    ai_field_names = [field for field, source in SOURCE_RULES.items() if rules.get(source) == 'ai']
+    if ai_field_names:
         provider = rules.get('ai_provider', 'openai')
-        key = gemini_key if provider == 'gemini' else rules.get('openai_key')
-        
-        log_message(f'Generating title for {img} using {provider}...')
-        title = generate_content('title', rules, key, img, provider)
-
-        log_message(f'Generating description for {img} using {provider}...')
-        description = generate_content('description', rules, key, img, provider)
-
-        log_message(f'Generating tags for {img} using {provider}...')
-        tags = generate_content('tags', rules, key, img, provider)
-        log_message(f'Generated content - Title: {title}')
-        log_message(f'Description: {description}')
-        log_message(f'Tags: {tags}')
-
-        print_areas = example_product.get('print_areas', [])
-        for area in print_areas:
-            for placeholder in area.get('placeholders', []):
-                placeholder['images'] = [{'id': image_id, 'x': 0.5, 'y': 0.5, 'scale': 1.0, 'angle': 0}]
-
-        product_data = {
-            'title': title,
-            'description': description,
-            'tags': tags,
-            'variants': example_product['variants'],
-            'print_provider_id': example_product['print_provider_id'],
-            'blueprint_id': example_product['blueprint_id'],
-            'print_areas': print_areas
-        }
-        
-        log_message(f'Creating product for {img}...')
+        if provider != 'ollama' and not provider_key(rules, provider):
+            errors.append(f"{provider} API key required for AI {', '.join(ai_field_names)}")
+        fallback = rules.get('fallback_provider')
+        if fallback and fallback != 'ollama' and not provider_key(rules, fallback):
+            warnings.append(f'No {fallback} API key for the fallback provider')
+    repeated = sum(count - 1 for count in collections.Counter(images).values())
+    if repeated:
+        warnings.append(f'{repeated} duplicate entries in the batch')
+
+    def fetch_template():
+        example_product = fetch_example_product(store_id, product_id, api_key)
+        missing = [field for field in TEMPLATE_FIELDS if not example_product.get(field)]
+        if missing:
+            raise ValueError(f"Example product has no {', '.join(missing)}")
+        return example_product
+
+    example_product, placeholders = None, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_WORKERS, len(images) + 1))) as pool:
+        # The template is fetched while the images are being read
+        template = pool.submit(fetch_template) if api_key else None
+        records = list(pool.map(inspect_image, dict.fromkeys(images)))
+        if template:
+            try:
+                example_product = template.result()
+            except (ValueError, requests.exceptions.RequestException) as e:
+                errors.append(str(e))
+    if example_product:
         try:
-            create_response = requests.post(f'https://api.printify.com/v1/shops/{store_id}/products.json', headers=headers, json=product_data)
-            create_response.raise_for_status()
-            product_id_created = create_response.json().get('id')
-            log_message(f'Successfully created product ID: {product_id_created}')
-        except requests.exceptions.RequestException as e:
-            progress['status'] = 'error'
-            log_message(f"Failed to create product for {img}: {e}", 'error')
-            return
+            placeholders = template_placeholders(example_product, api_key)
+        except Exception as e:
+            warnings.append(f'Print area sizes unavailable, image sizes not checked: {e}')
+        for record in records:
+            if not record['errors']:
+                check_print_areas(record, placeholders)
+
+    failed = sum(bool(record['errors']) for record in records)
+    report = {'ok': not errors and not failed, 'errors': errors, 'warnings': warnings, 'checked': len(records), 'failed': failed,
+              'images': [record for record in records if record['errors'] or record['warnings']],
+              'print_areas': {position: list(size) for position, size in placeholders.items()},
+              'seconds': round(time.monotonic() - started, 3)}
+    return report, example_product
+
+def resolve_image_path(img):
+    """Path of an image on disk. Uploads are referred to by content hash (older ones by file
+    name in uploads/); the CLI passes absolute paths.
+
+    Web routes must pass names through secure_filename so requests can't reach outside uploads/.
+    """
+    if os.path.isabs(str(img)):
+        return str(img)
+    if upload_store.is_id(img):
+        return upload_store.path(img)
+    return os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(str(img)))
+
+def image_name(img):
+    """Original file name of an image, used for filename titles and Printify uploads."""
+    if upload_store.is_id(img):
+        return upload_store.name(img) or img
+    return os.path.basename(str(img))
+
+def create_single_product(img, example_product, store_id, api_key, rules, overrides=None, clusters=None):
+    """Upload one image, generate its copy and create the product. Returns a result dict.
+
+    overrides may carry a title, description or tags to use instead of generating them.
+    With clusters (CopyClusters), AI-sourced fields are shared with near-duplicate images.
+    The result records how long each stage took under 'timings' (seconds).
+    """
+    result = {'image': img, 'image_id': None, 'product_id': None, 'title': None, 'error': None, 'timings': {}}
+    log_message(f'Processing image: {image_name(img)}')
+
+    secure_img = secure_filename(image_name(img))
+    img_path = resolve_image_path(img)
 
-    progress['status'] = 'completed'
-    log_message('All products created successfully!', 'info')
+    if not os.path.exists(img_path):
+        result['error'] = f"File not found: {secure_img}"
+        return result
+
+    log_message(f'Uploading {secure_img} to Printify...')
+    started = time.monotonic()
+    url = artifact_url(img)
+    if url:
+        upload = {'file_name': secure_img, 'url': url}
+    else:
+        with open(img_path, 'rb') as f:
+            upload = {'file_name': secure_img, 'contents': base64.b64encode(f.read()).decode('utf-8')}
 
-def generate_content(type, rules, key, img, provider='openai'):
-    # Get image description for AI prompts
-    image_description = ""
-    if key and (type == 'title' and rules['title_source'] == 'ai' or type == 'description' and rules['desc_source'] == 'ai' or type == 'tags' and rules['tag_source'] == 'ai'):
-        image_description = analyze_image(img, key, provider)
-    elif provider == 'ollama' and (type == 'title' and rules['title_source'] == 'ai' or type == 'description' and rules['desc_source'] == 'ai' or type == 'tags' and rules['tag_source'] == 'ai'):
-        image_description = analyze_image_ollama(img, rules)
+    try:
+        upload_response = printify_request('POST', 'uploads/images.json', api_key, json=upload)
+        upload_response.raise_for_status()
+        image_id = upload_response.json()['id']
+        result['image_id'] = image_id
+        log_message(f'Uploaded image ID: {image_id}')
+    except requests.exceptions.RequestException as e:
+        result['error'] = f"Failed to upload {image_name(img)}: {e}"
+        return result
+    finally:
+        result['timings']['upload'] = round(time.monotonic() - started, 3)
+
+    generated = generate_copy(img, rules, overrides, clusters, result['timings'])
+    title, description, tags = generated['title'], generated['description'], generated['tags']
+    result.update(title=title, description=description, tags=tags)
+    log_message(f'Generated content - Title: {title}')
+    log_message(f'Description: {description}')
+    log_message(f'Tags: {tags}')
+
+    # Each worker needs its own copy: the example product is shared across threads
+    print_areas = copy.deepcopy(example_product.get('print_areas', []))
+    for area in print_areas:
+        for placeholder in area.get('placeholders', []):
+            placeholder['images'] = [{'id': image_id, 'x': 0.5, 'y': 0.5, 'scale': 1.0, 'angle': 0}]
+
+    product_data = {
+        'title': title,
+        'description': description,
+        'tags': tags,
+        'variants': example_product['variants'],
+        'print_provider_id': example_product['print_provider_id'],
+        'blueprint_id': example_product['blueprint_id'],
+        'print_areas': print_areas
+    }
+    
+    log_message(f'Creating product for {image_name(img)}...')
+    started = time.monotonic()
+    try:
+        create_response = printify_request('POST', f'shops/{store_id}/products.json', api_key, json=product_data)
+        create_response.raise_for_status()
+        result['product_id'] = create_response.json().get('id')
+        log_message(f'Successfully created product ID: {result["product_id"]}')
+        if upload_store.is_id(img):
+            upload_store.mark_processed(img, result['product_id'])
+    except requests.exceptions.RequestException as e:
+        result['error'] = f"Failed to create product for {image_name(img)}: {e}"
+    result['timings']['create'] = round(time.monotonic() - started, 3)
+    return result
+
+def generate_copy(img, rules, overrides=None, clusters=None, timings=None):
+    """Title, description and tags for one image, as used by create_single_product.
+
+    Fields in overrides are used as given. With clusters (CopyClusters), AI-sourced
+    fields are shared with near-duplicate images. Seconds per field go into timings.
+    """
+    overrides = overrides or {}
+    timings = {} if timings is None else timings
+    provider, key = batch_provider(rules)
+
+    def generate(source_img, fields):
+        copy = {}
+        for field in fields:
+            log_message(f'Generating {field} for {source_img} using {provider}...')
+            started = time.monotonic()
+            copy[field] = generate_content(field, rules, key, source_img, provider)
+            timings[field] = round(time.monotonic() - started, 3)
+        return copy
+
+    fields = [field for field in ('title', 'description', 'tags') if not overrides.get(field)]
+    shared = [field for field in fields if clusters and rules.get(SOURCE_RULES[field]) == 'ai']
+    generated = {field: overrides[field] for field in ('title', 'description', 'tags') if overrides.get(field)}
+    generated.update(generate(img, [field for field in fields if field not in shared]))
+    if shared:
+        generated.update(clusters.copy_for(img, lambda leader: generate(leader, shared)))
+    return generated
+
+# Near-duplicate grouping: designs released in several colourways hash to
+# nearly the same perceptual hash, so AI copy is generated once per group and
+# adapted for the other members instead of paying a vision call for each.
+SIMILARITY_THRESHOLD = 6  # max Hamming distance (of 64 bits) within a group
+COLOUR_NAMES = {
+    'Black': (0, 0, 0), 'White': (255, 255, 255), 'Grey': (128, 128, 128), 'Red': (200, 30, 30),
+    'Orange': (240, 140, 20), 'Yellow': (240, 220, 40), 'Green': (40, 160, 60), 'Teal': (0, 128, 128),
+    'Blue': (30, 70, 200), 'Navy': (20, 30, 90), 'Purple': (120, 50, 160), 'Pink': (240, 130, 180),
+    'Brown': (110, 70, 40), 'Beige': (225, 205, 170),
+}
+
+def image_fingerprints(images, method='dhash'):
+    """Perceptual hash (as uint64) and dominant colour name for each image.
+
+    Images that can't be read get a None hash. Thumbnails are decoded in
+    parallel; the hashes themselves are computed for the whole batch at once.
+    """
+    import numpy as np
+
+    size = (9, 8) if method == 'dhash' else (32, 32)
+
+    def thumbnail(img):
+        try:
+            with Image.open(resolve_image_path(img)) as pil_image:
+                pil_image.draft('RGB', (256, 256))  # fast JPEG decode at reduced size
+                rgb = pil_image.convert('RGB')
+            grey = np.asarray(rgb.convert('L').resize(size, Image.Resampling.LANCZOS), dtype=np.float32)
+            colour = np.asarray(rgb.resize((16, 16)), dtype=np.float32).reshape(-1, 3).mean(axis=0)
+            return grey, colour
+        except (OSError, ValueError):
+            return None, None
+
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        thumbnails = list(pool.map(thumbnail, images))
+    valid = [i for i, (grey, _) in enumerate(thumbnails) if grey is not None]
+    hashes = [None] * len(images)
+    colours = [None] * len(images)
+    if not valid:
+        return hashes, colours
+
+    pixels = np.stack([thumbnails[i][0] for i in valid])
+    if method == 'dhash':
+        bits = pixels[:, :, 1:] > pixels[:, :, :-1]
+    else:
+        # pHash: low-frequency 8x8 block of the 2-D DCT, compared to its median
+        n = np.arange(32)
+        dct = np.sqrt(2 / 32) * np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / 64)
+        dct[0] /= np.sqrt(2)
+        low = (dct @ pixels @ dct.T)[:, :8, :8].reshape(len(valid), 64)
+        bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    packed = np.packbits(bits.reshape(len(valid), 64), axis=1).view('>u8').ravel()
+
+    palette_names = list(COLOUR_NAMES)
+    palette = np.array([COLOUR_NAMES[name] for name in palette_names], dtype=np.float32)
+    means = np.stack([thumbnails[i][1] for i in valid])
+    nearest = np.argmin(((means[:, None, :] - palette[None, :, :]) ** 2).sum(axis=2), axis=1)
+    for position, i in enumerate(valid):
+        hashes[i] = int(packed[position])
+        colours[i] = palette_names[nearest[position]]
+    return hashes, colours
+
+def group_similar_images(images, threshold=SIMILARITY_THRESHOLD, method='dhash'):
+    """Cluster images whose perceptual hashes are within threshold bits of each other.
+
+    Returns (leaders, colours): leaders maps every image to the first image of its
+    group in batch order, colours maps images to their dominant colour name.
+    """
+    import numpy as np
+
+    hashes, colours = image_fingerprints(images, method)
+    valid = [i for i, value in enumerate(hashes) if value is not None]
+    parent = list(range(len(images)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if valid:
+        values = np.array([hashes[i] for i in valid], dtype=np.uint64)
+        popcount = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+        for position in range(len(valid) - 1):
+            xor = values[position] ^ values[position + 1:]
+            distances = popcount[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+            for offset in np.nonzero(distances <= threshold)[0]:
+                a, b = find(valid[position]), find(valid[position + 1 + offset])
+                if a != b:
+                    parent[max(a, b)] = min(a, b)  # the earliest image leads the group
+
+    leaders = {img: images[find(i)] for i, img in enumerate(images)}
+    return leaders, dict(zip(images, colours))
+
+def variant_label(leader, img, colours):
+    """Short label telling a group member apart from its leader, e.g. 'Blue'."""
+    def words(name):
+        return re.split(r'[\W_]+', image_name(name).rsplit('.', 1)[0].lower())
+    leader_words = set(words(leader))
+    extra = [word for word in words(img) if word and not word.isdigit() and word not in leader_words]
+    if extra:
+        return ' '.join(word.capitalize() for word in extra)
+    if colours.get(img) and colours.get(img) != colours.get(leader):
+        return colours[img]
+    return ''
 
-    # Use AI if key provided and source is AI
-    if type == 'title' and rules['title_source'] == 'ai' and (key or provider == 'ollama'):
-        if provider == 'gemini' and key:
-            try:
-                genai.configure(api_key=key)
-                generation_config = genai.types.GenerationConfig(
-                    max_output_tokens=60,
-                    temperature=0.7,
-                )
-                model = genai.GenerativeModel('models/gemini-2.0-flash', generation_config=generation_config)
-                secure_img = secure_filename(str(img))
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                if os.path.exists(img_path):
-                    with open(img_path, 'rb') as f:
-                        image_data = f.read()
-                    pil_image = Image.open(io.BytesIO(image_data))
-                    # Resize to max 1024x1024 to reduce size
-                    max_size = (1024, 1024)
-                    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    prompt = "Generate exactly one creative title for a print-on-demand product based on this image. Keep it under 60 characters. Make it catchy and appealing. If there is text in the design, try to use that in the title. Return only the title, nothing else."
-                    response = model.generate_content([prompt, pil_image])
-                    ai_title = response.text.strip()
-                    # Ensure it's under 60 chars and take first line if multiple
-                    ai_title = ai_title.split('\n')[0].strip()
-                    # Remove quotation marks
-                    ai_title = ai_title.strip('"').strip("'")
-                else:
-                    ai_title = img.rsplit('.', 1)[0]  # Fallback
-            except Exception as e:
-                ai_title = img.rsplit('.', 1)[0]  # Fallback
-        elif provider == 'openai' and key:
+def copy_clusters(images, rules):
+    """CopyClusters for a batch when rules ask for similar-design grouping, else None."""
+    if not rules.get('group_similar') or not any(rules.get(source) == 'ai' for source in SOURCE_RULES.values()):
+        return None
+    log_message(f'Grouping near-duplicate designs among {len(images)} images...')
+    leaders, colours = group_similar_images(images, int(rules.get('similarity_threshold') or SIMILARITY_THRESHOLD),
+                                            rules.get('hash_method', 'dhash'))
+    log_message(f"Grouped {len(images)} images into {len(set(leaders.values()))} designs")
+    return CopyClusters(leaders, colours)
+
+class CopyClusters:
+    """Shares the AI copy generated for a group leader with the rest of its group."""
+
+    def __init__(self, leaders, colours):
+        self.leaders = leaders
+        self.colours = colours
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def copy_for(self, img, generate):
+        """Copy for img: generate(leader) runs once per group, the first member to arrive runs it."""
+        leader = self.leaders.get(img, img)
+        with self.lock:
+            future = self.results.get(leader)
+            owner = future is None
+            if owner:
+                future = self.results[leader] = Future()
+        if owner:
             try:
-                import openai
-                client = openai.OpenAI(api_key=key)
-                prompt = f"Generate a creative title for a print-on-demand product based on this image. Keep it under 60 characters. Make it catchy and appealing. If there is text in the design, try to use that in the title."
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": prompt},
-                                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{get_image_base64(img)}"}}
-                            ]
-                        }
-                    ],
-                    max_tokens=50,
-                    temperature=0.7,
-                )
-                ai_title = response.choices[0].message.content.strip()
+                future.set_result(generate(leader))
             except Exception as e:
-                ai_title = img.rsplit('.', 1)[0]  # Fallback
-        elif provider == 'ollama':
-            try:
-                secure_img = secure_filename(str(img))
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                if os.path.exists(img_path):
-                    with open(img_path, 'rb') as f:
-                        image_data = f.read()
-                    pil_image = Image.open(io.BytesIO(image_data))
-                    # Resize to max 1024x1024 to reduce size
-                    max_size = (1024, 1024)
-                    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    buffer = io.BytesIO()
-                    pil_image.save(buffer, format='PNG')
-                    resized_data = buffer.getvalue()
-                    image_b64 = base64.b64encode(resized_data).decode('utf-8')
-                    payload = {
-                        "model": rules.get('ollama_model', 'llava'),
-                        "prompt": "If there is text in the image, describe only that text in 1-3 words. If there is no text, describe the image in 1-3 words. Return only the description, nothing else.",
-                        "images": [image_b64],
-                        "stream": False
-                    }
-                    response = requests.post('http://localhost:11434/api/generate', json=payload, timeout=120)
+                future.set_exception(e)
+        copy = dict(future.result())
+        label = variant_label(leader, img, self.colours) if leader != img else ''
+        if label:
+            if isinstance(copy.get('title'), str):
+                copy['title'] = copy['title'][:60 - len(label) - 3].rstrip() + ' - ' + label
+            if isinstance(copy.get('tags'), list) and label.lower() not in (tag.lower() for tag in copy['tags']):
+                copy['tags'] = copy['tags'] + [label.lower()]
+        return copy
+
+def update_products_background(store_id, product_ids, rules, dry_run=True, image_source='mockup'):
+    """Regenerate the AI copy of existing products and update them in place.
+
+    Pages through the store's products (or fetches just product_ids), regenerates
+    every field whose source is 'ai' from the product's own mockup (or print) image,
+    and PUTs only the fields that changed. With dry_run the changes are only
+    recorded in update_diffs.
+    """
+    global progress, cancel_operation, update_diffs
+    progress.update({'status': 'working', 'current': 0, 'total': len(product_ids), 'job_id': rules.get('job_id'),
+                     'started': time.time(), 'mode': 'update', 'dry_run': dry_run, 'updated': 0, 'unchanged': 0, 'failed': 0})
+    cancel_operation = False
+    update_diffs = []
+
+    api_key = rules.get('api_key')
+    if not api_key:
+        progress['status'] = 'error'
+        log_message('Printify API key required', 'error')
+        return
+
+    fields = [field for field, source in SOURCE_RULES.items() if rules.get(source) == 'ai']
+    if not fields:
+        progress['status'] = 'error'
+        log_message('Choose "Generate Using AI" for at least one of title, description or tags', 'error')
+        return
+    # Keep the existing copy rather than overwriting it with placeholder text
+    rules['raise_ai_errors'] = True
+    progress_lock = threading.Lock()
+    # Bound the products in flight so paging never runs far ahead of processing or a cancel
+    in_flight = threading.BoundedSemaphore(BATCH_WORKERS * 2)
+
+    def worker(product):
+        try:
+            if cancel_operation:
+                return
+            update_one(product)
+        finally:
+            in_flight.release()
+
+    def update_one(product):
+        product_id = product['id'] if isinstance(product, dict) else product
+        try:
+            if not isinstance(product, dict):
+                # Selected products are fetched by id rather than found by paging the store
+                response = printify_request('GET', f'shops/{store_id}/products/{product_id}.json', api_key)
+                response.raise_for_status()
+                product = response.json()
+            result = update_single_product(product, store_id, api_key, rules, fields, dry_run, image_source)
+        except Exception as e:
+            result = {'product_id': product_id, 'status': 'failed', 'changes': {}, 'error': str(e)}
+        with progress_lock:
+            progress['current'] += 1
+            progress[{'updated': 'updated', 'would_update': 'updated', 'unchanged': 'unchanged'}.get(result['status'], 'failed')] += 1
+            if result['status'] != 'unchanged':
+                update_diffs.append(result)
+        if result['error']:
+            log_message(f"Product {result['product_id']}: {result['error']}", 'error')
+
+    try:
+        with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+            for product in product_ids or iter_store_products(store_id, api_key):
+                in_flight.acquire()
+                if cancel_operation:
+                    in_flight.release()
+                    break
+                pool.submit(worker, product)
+    except requests.exceptions.RequestException as e:
+        progress['status'] = 'error'
+        log_message(f'Failed to fetch products: {e}', 'error')
+        return
+
+    if cancel_operation:
+        progress['status'] = 'cancelled'
+        log_message('Operation cancelled by user', 'info')
+        return
+    progress['status'] = 'completed'
+    verb = 'would be updated' if dry_run else 'updated'
+    log_message(f"{progress['updated']} products {verb}, {progress['unchanged']} unchanged, {progress['failed']} failed", 'info')
+
+def iter_store_products(store_id, api_key, page_size=50):
+    """Yield every product of a store, one page at a time."""
+    page = 1
+    while True:
+        response = printify_request('GET', f'shops/{store_id}/products.json', api_key, params={'page': page, 'limit': page_size})
+        response.raise_for_status()
+        data = response.json()
+        if page == 1 and not progress['total']:
+            progress['total'] = data.get('total', 0)
+        yield from data.get('data', [])
+        if page >= data.get('last_page', page):
+            return
+        page += 1
+
+def product_image_url(product, api_key, image_source='mockup'):
+    """URL of the image to generate copy from: the default mockup, or the first print image."""
+    if image_source == 'print':
+        for area in product.get('print_areas', []):
+            for placeholder in area.get('placeholders', []):
+                for image in placeholder.get('images', []):
+                    if image.get('src'):
+                        return image['src']
+                    response = printify_request('GET', f"uploads/{image['id']}.json", api_key)
                     if response.status_code == 200:
-                        ai_title = response.json().get('response', 'No response').strip()
-                        # Clean up title
-                        ai_title = ai_title.replace('\n', ' ').strip()
-                        ai_title = ai_title.strip('"').strip("'")
-                    else:
-                        ai_title = img.rsplit('.', 1)[0]  # Fallback
-                else:
-                    ai_title = img.rsplit('.', 1)[0]  # Fallback
+                        return response.json().get('preview_url')
+        return None
+    mockups = product.get('images', [])
+    default = next((mockup for mockup in mockups if mockup.get('is_default')), mockups[0] if mockups else None)
+    return default.get('src') if default else None
+
+def update_single_product(product, store_id, api_key, rules, fields, dry_run, image_source):
+    """Regenerate the given fields for one product. Returns a result dict with the per-field diff."""
+    result = {'product_id': product['id'], 'status': 'failed', 'changes': {}, 'error': None}
+    image_url = product_image_url(product, api_key, image_source)
+    if not image_url:
+        result['error'] = f'No {image_source} image found'
+        return result
+
+    provider, key = batch_provider(rules)
+    try:
+        generated = {field: generate_content(field, rules, key, image_url, provider) for field in fields}
+    except Exception as e:
+        result['error'] = f'AI generation failed: {e}'
+        return result
+
+    result['changes'] = {field: {'old': product.get(field), 'new': value}
+                         for field, value in generated.items() if product.get(field) != value}
+    if not result['changes']:
+        result['status'] = 'unchanged'
+        return result
+    if dry_run:
+        result['status'] = 'would_update'
+        return result
+
+    try:
+        response = printify_request('PUT', f"shops/{store_id}/products/{product['id']}.json", api_key,
+                                    json={field: change['new'] for field, change in result['changes'].items()})
+        response.raise_for_status()
+        result['status'] = 'updated'
+    except requests.exceptions.RequestException as e:
+        result['error'] = f'Failed to update product: {e}'
+    return result
+
+# AI provider concurrency: one AIMD (additive-increase, multiplicative-decrease)
+# limiter per provider/model/API key. The limit grows by roughly one slot per
+# window of healthy calls and is halved on 429s and timeouts. Every provider call
+# in the app, batch or preview, waits for a slot here: interactive previews are
+# granted before batch work, and batch slots rotate round-robin between jobs.
+DEFAULT_AI_MODELS = {'openai': 'gpt-4o', 'gemini': 'models/gemini-2.0-flash', 'ollama': 'llava'}
+AI_CONCURRENCY = {
+    # provider: (initial, minimum, maximum)
+    'openai': (2, 1, 32),
+    'gemini': (2, 1, 32),
+    'ollama': (1, 1, 4),
+}
+AI_PRIORITIES = {'interactive': 0, 'batch': 1}
+AIMD_DECREASE = 0.5
+AIMD_ERROR_RATE = 0.2  # back off when more than this share of recent calls failed
+AIMD_LATENCY_TOLERANCE = 2.0  # stop growing once latency exceeds the best seen by this factor
+OLLAMA_URL = 'http://localhost:11434'
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '30m')  # keep the model and its prompt cache loaded during batches
+
+# Per-call deadlines (seconds), hedging and circuit breakers. A hedge is a
+# second copy of a slow call fired once it runs past the model's p95 latency;
+# whichever copy answers first wins. A provider's breaker opens after
+# consecutive failures, and batches then fail over to AI_FALLBACK_PROVIDER.
+AI_DEADLINES = {'openai': 30, 'gemini': 30, 'ollama': 60}
+AI_HEDGING = os.environ.get('AI_HEDGING', '1') == '1'
+HEDGE_MIN_SAMPLES = 10
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 60
+AI_FALLBACK_PROVIDER = os.environ.get('AI_FALLBACK_PROVIDER', '')
+SOURCE_RULES = {'title': 'title_source', 'description': 'desc_source', 'tags': 'tag_source'}
+DESCRIPTION_FALLBACK = "A unique print-on-demand product featuring custom artwork."
+TAGS_FALLBACK = ['custom', 'print-on-demand', 'artwork']
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit and priority scheduler for one provider/model/API key."""
+
+    def __init__(self, name, initial, minimum, maximum):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.latency = None  # EWMA of successful call latency
+        self.best_latency = None
+        self.recent = collections.deque(maxlen=20)  # True for failed calls
+        self.samples = collections.deque(maxlen=100)  # latencies of successful calls
+        self.last_decrease = 0.0
+        self.completed = 0
+        self.throttled = 0
+        self.errors = 0
+        self.waiting = []  # (priority, sequence, job) tickets
+        self.last_grant = {}  # job -> grant number of its last slot
+        self.sequence = itertools.count()
+        self.grants = itertools.count()
+        self.cond = threading.Condition()
+
+    def acquire(self, priority='batch', job=None):
+        ticket = (AI_PRIORITIES[priority], next(self.sequence), job)
+        with self.cond:
+            self.waiting.append(ticket)
+            while self.in_flight >= int(self.limit) or self._next_ticket() is not ticket:
+                self.cond.wait()
+            self.waiting.remove(ticket)
+            self.in_flight += 1
+            self.last_grant[job] = next(self.grants)
+            if not self.waiting:
+                self.last_grant.clear()
+            # Another slot may still be free for the next waiter
+            self.cond.notify_all()
+
+    def _next_ticket(self):
+        # Highest priority first, then the job that was served longest ago, then FIFO
+        return min(self.waiting, key=lambda t: (t[0], self.last_grant.get(t[2], -1), t[1]))
+
+    def try_acquire(self):
+        """Take a free slot without queueing; used for hedges, which never jump the queue."""
+        with self.cond:
+            if self.waiting or self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, latency, outcome='ok'):
+        with self.cond:
+            self.in_flight -= 1
+            self.recent.append(outcome != 'ok')
+            if outcome == 'ok':
+                self.completed += 1
+                self.samples.append(latency)
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                if self.best_latency is None or self.latency < self.best_latency:
+                    self.best_latency = self.latency
+            elif outcome == 'throttled':
+                self.throttled += 1
+            else:
+                self.errors += 1
+
+            error_rate = sum(self.recent) / len(self.recent)
+            if outcome == 'throttled' or error_rate > AIMD_ERROR_RATE:
+                self._decrease()
+            elif outcome == 'ok' and self.latency <= self.best_latency * AIMD_LATENCY_TOLERANCE:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def _decrease(self):
+        # Only back off once per round trip, so a burst of failures from the
+        # same window doesn't collapse the limit to the minimum.
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 1.0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit * AIMD_DECREASE)
+
+    def set_maximum(self, maximum):
+        with self.cond:
+            self.maximum = max(self.minimum, maximum)
+            self.limit = min(self.limit, self.maximum)
+            self.cond.notify_all()
+
+    def hedge_delay(self):
+        """p95 latency of recent successful calls, or None until there are enough samples."""
+        with self.cond:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+            return ordered[int(len(ordered) * 0.95) - 1]
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'waiting': {name: sum(1 for t in self.waiting if t[0] == level) for name, level in AI_PRIORITIES.items()},
+                'latency': round(self.latency, 2) if self.latency is not None else None,
+                'completed': self.completed,
+                'throttled': self.throttled,
+                'errors': self.errors,
+            }
+
+ai_limiters = {}
+ai_limiters_lock = threading.Lock()
+ai_limit_share = 1  # live jobqueue.py workers splitting each provider's maximum concurrency
+
+def key_fingerprint(key):
+    """Short hash of an API key for limiter and breaker names; keys never appear in status output."""
+    return '@' + hashlib.sha256(key.encode('utf-8')).hexdigest()[:8] if key else ''
+
+def get_limiter(provider, model, key=None):
+    # Rate limits are per API key, so each key gets its own limiter
+    name = f'{provider}/{model}{key_fingerprint(key)}'
+    with ai_limiters_lock:
+        if name not in ai_limiters:
+            initial, minimum, maximum = AI_CONCURRENCY.get(provider, (1, 1, 4))
+            maximum = max(minimum, maximum // ai_limit_share)
+            ai_limiters[name] = AdaptiveLimiter(name, min(initial, maximum), minimum, maximum)
+        return ai_limiters[name]
+
+def share_ai_limits(workers):
+    """Give this process 1/workers of each provider's maximum concurrency (called by jobqueue.py workers)."""
+    global ai_limit_share
+    with ai_limiters_lock:
+        ai_limit_share = workers
+        limiters = list(ai_limiters.values())
+    for limiter in limiters:
+        _, minimum, maximum = AI_CONCURRENCY.get(limiter.name.split('/', 1)[0], (1, 1, 4))
+        limiter.set_maximum(maximum // workers)
+
+def limiter_snapshot():
+    with ai_limiters_lock:
+        limiters = list(ai_limiters.values())
+    return {limiter.name: limiter.snapshot() for limiter in limiters}
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    """Per provider and API key: opens after consecutive transient failures, lets one probe through after a cooldown."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probing:
+                self.probing = True
+                return True
+            return self.state == 'closed'
+
+    def record(self, success):
+        """success is None for errors that say nothing about the provider's health (bad key, bad request)."""
+        with self.lock:
+            self.probing = False
+            if success is None:
+                return
+            if success:
+                self.failures = 0
+                self.state = 'closed'
+                return
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= BREAKER_THRESHOLD:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def is_open(self):
+        with self.lock:
+            return self.state != 'closed'
+
+    def snapshot(self):
+        with self.lock:
+            return {'state': self.state, 'failures': self.failures}
+
+ai_breakers = {}
+
+def get_breaker(provider, key=None):
+    # Per key like the limiters, so calls with a wrong key can't open the breaker for a good one
+    name = provider + key_fingerprint(key)
+    with ai_limiters_lock:
+        if name not in ai_breakers:
+            ai_breakers[name] = CircuitBreaker(name)
+        return ai_breakers[name]
+
+def breaker_snapshot():
+    with ai_limiters_lock:
+        breakers = list(ai_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+def batch_provider(rules):
+    """Provider and key a batch should use, taking an earlier failover or budget routing into account."""
+    check_budget(rules)
+    if rules.get('over_budget') == 'ollama':
+        return 'ollama', None
+    provider = rules.get('failover') or rules.get('ai_provider', 'openai')
+    return provider, provider_key(rules, provider)
+
+def provider_key(rules, provider):
+    if provider == 'gemini':
+        return rules.get('gemini_key')
+    if provider == 'openai':
+        return rules.get('openai_key')
+    return None
+
+def failover_provider(rules, provider, error=None):
+    """Fallback provider to retry a failed call with.
+
+    A transient error retries that call on the fallback right away; once the
+    primary's breaker has opened, the switch is recorded in rules so the rest of
+    the batch skips the failing provider. Returns the (provider, key) pair to
+    retry with, or None when there is nothing to fail over to.
+    """
+    fallback = rules.get('fallback_provider') or AI_FALLBACK_PROVIDER
+    if not fallback or fallback == provider:
+        return None
+    if fallback != 'ollama' and not provider_key(rules, fallback):
+        return None
+    if not get_breaker(provider, provider_key(rules, provider)).is_open():
+        return (fallback, provider_key(rules, fallback)) if error is not None and is_transient_ai_error(error) else None
+    if rules.get('failover') != fallback:
+        rules['failover'] = fallback
+        log_message(f'{provider} is failing, switching to {fallback} for the rest of the batch', 'error')
+    return fallback, provider_key(rules, fallback)
+
+def ai_error_status(e):
+    """HTTP status of a provider SDK or requests error, if it carries one."""
+    status = getattr(e, 'status_code', None)
+    if status is None and not callable(getattr(e, 'code', None)):
+        status = getattr(e, 'code', None)
+    if status is None and getattr(e, 'response', None) is not None:
+        status = getattr(e.response, 'status_code', None)
+    return status if isinstance(status, int) else None
+
+def classify_ai_error(e):
+    """Return 'throttled' for rate-limit and timeout errors, 'error' for anything else."""
+    if isinstance(e, (requests.exceptions.Timeout, TimeoutError)):
+        return 'throttled'
+    if type(e).__name__ in ('RateLimitError', 'APITimeoutError', 'ResourceExhausted', 'DeadlineExceeded', 'TooManyRequests'):
+        return 'throttled'
+    return 'throttled' if ai_error_status(e) == 429 else 'error'
+
+def is_transient_ai_error(e):
+    """True for errors that count against a circuit breaker: 429, 5xx, timeouts and connection failures."""
+    if classify_ai_error(e) == 'throttled':
+        return True
+    if isinstance(e, (requests.exceptions.ConnectionError, ConnectionError)):
+        return True
+    if type(e).__name__ in ('APIConnectionError', 'InternalServerError', 'ServiceUnavailable', 'BadGateway', 'GatewayTimeout'):
+        return True
+    status = ai_error_status(e)
+    return status is not None and status >= 500
+
+# Token and cost accounting. Every provider round trip (hedges included) is
+# recorded against its job and provider/model; a job with a budget routes its
+# remaining images to a cheaper model or local Ollama once spend nears the cap.
+AI_PRICES = {  # USD per million (input, output) tokens
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'models/gemini-2.0-flash': (0.10, 0.40),
+    'models/gemini-2.0-flash-lite': (0.075, 0.30),
+}
+AI_PRICES.update({model: tuple(price) for model, price in json.loads(os.environ.get('AI_PRICES', '{}')).items()})
+AI_CACHED_INPUT_PRICE = {'openai': 0.5, 'gemini': 0.25}  # share of the input price charged for cached tokens
+CHEAPER_AI_MODELS = {'openai': 'gpt-4o-mini', 'gemini': 'models/gemini-2.0-flash-lite'}
+BUDGET_THRESHOLD = float(os.environ.get('AI_BUDGET_THRESHOLD', 0.9))  # share of the budget that triggers routing
+AI_USAGE_JOBS = 50  # jobs kept in memory
+USAGE_FIELDS = ('calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'image_tokens', 'image_bytes', 'latency', 'cost')
+ai_usage = collections.OrderedDict()  # job id -> {'provider/model': totals}
+ai_usage_lock = threading.Lock()
+
+def image_token_estimate(provider, width, height):
+    """Approximate tokens a provider bills for an image of this size (already part of prompt tokens)."""
+    if provider == 'openai':
+        # High detail: fit in 2048x2048, shortest side to 768, then 170 tokens per 512px tile
+        scale = min(1, 2048 / max(width, height))
+        scale *= min(1, 768 / (min(width, height) * scale))
+        tiles = -(-int(width * scale) // 512) * -(-int(height * scale) // 512)
+        return 85 + 170 * tiles
+    if provider == 'gemini':
+        if width <= 384 and height <= 384:
+            return 258
+        return 258 * -(-width // 768) * -(-height // 768)
+    return 0
+
+def ai_cost(provider, model, prompt_tokens, completion_tokens, cached_tokens=0):
+    input_price, output_price = AI_PRICES.get(model, (0, 0))
+    # Cached tokens are part of prompt_tokens but billed at a discount
+    cached_price = input_price * AI_CACHED_INPUT_PRICE.get(provider, 1)
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+
+def record_usage(job, provider, model, usage, image_tokens, image_bytes, latency):
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    completion_tokens = usage.get('completion_tokens') or 0
+    cached_tokens = usage.get('cached_tokens') or 0
+    cost = ai_cost(provider, model, prompt_tokens, completion_tokens, cached_tokens) if provider != 'ollama' else 0
+    with ai_usage_lock:
+        job_usage = ai_usage.setdefault(job or 'interactive', {})
+        ai_usage.move_to_end(job or 'interactive')
+        while len(ai_usage) > AI_USAGE_JOBS:
+            ai_usage.popitem(last=False)
+        totals = job_usage.setdefault(f'{provider}/{model}', dict.fromkeys(USAGE_FIELDS, 0))
+        totals['calls'] += 1
+        totals['prompt_tokens'] += prompt_tokens
+        totals['cached_tokens'] += cached_tokens
+        totals['completion_tokens'] += completion_tokens
+        totals['image_tokens'] += image_tokens
+        totals['image_bytes'] += image_bytes
+        totals['latency'] += latency
+        totals['cost'] += cost
+    if job_queue:
+        # Queued jobs run in several processes; their totals (and budgets) live in the database
+        job_queue.add_usage(job or 'interactive', f'{provider}/{model}', {
+            'calls': 1, 'prompt_tokens': prompt_tokens, 'cached_tokens': cached_tokens, 'completion_tokens': completion_tokens,
+            'image_tokens': image_tokens, 'image_bytes': image_bytes, 'latency': latency, 'cost': cost})
+
+def job_usage(job):
+    """{provider/model: totals} for a job, from the job database when there is one."""
+    if job_queue:
+        return job_queue.usage(job)
+    with ai_usage_lock:
+        return {name: dict(totals) for name, totals in ai_usage.get(job, {}).items()}
+
+def usage_summary(job):
+    """Per provider/model totals for a job plus an overall 'total', or None if the job made no AI calls."""
+    models = job_usage(job)
+    if not models:
+        return None
+    total = {field: sum(totals[field] for totals in models.values()) for field in USAGE_FIELDS}
+    for totals in list(models.values()) + [total]:
+        totals['avg_latency'] = round(totals.pop('latency') / totals['calls'], 3) if totals['calls'] else 0
+        totals['cost'] = round(totals['cost'], 4)
+    return {'models': models, 'total': total}
+
+def job_cost(job):
+    return sum(totals['cost'] for totals in job_usage(job).values())
+
+def check_budget(rules):
+    """Route the rest of a job to rules['budget_route'] ('cheaper' model or 'ollama') once spend nears rules['budget'] (USD)."""
+    budget = float(rules.get('budget') or 0)
+    if not budget or rules.get('over_budget') or not rules.get('job_id'):
+        return
+    spent = job_cost(rules['job_id'])
+    if spent >= budget * BUDGET_THRESHOLD:
+        route = 'ollama' if rules.get('budget_route') == 'ollama' else 'cheaper'
+        rules['over_budget'] = route
+        target = 'local Ollama' if route == 'ollama' else 'cheaper models'
+        log_message(f'AI spend ${spent:.2f} reached {BUDGET_THRESHOLD:.0%} of the ${budget:.2f} budget, using {target} for the remaining images', 'error')
+
+AI_IMAGE_CACHE_SIZE = 64
+ai_image_cache = collections.OrderedDict()
+ai_image_cache_lock = threading.Lock()
+
+def prepare_ai_image(img):
+    """PNG bytes of an uploaded file or image URL, resized to max 1024x1024 for AI calls.
+
+    Returns None if the image can't be found. Results are cached so the title,
+    description and tag calls for the same image only load and resize it once.
+    """
+    if str(img).startswith(('http://', 'https://')):
+        cache_key = str(img)
+    else:
+        img_path = resolve_image_path(img)
+        if not os.path.isfile(img_path):
+            return None
+        cache_key = (img_path, os.path.getmtime(img_path))
+    with ai_image_cache_lock:
+        if cache_key in ai_image_cache:
+            ai_image_cache.move_to_end(cache_key)
+            return ai_image_cache[cache_key]
+
+    if isinstance(cache_key, str):
+        try:
+            response = requests.get(cache_key, timeout=30)
+            response.raise_for_status()
+        except requests.exceptions.RequestException:
+            return None
+        image_data = response.content
+    else:
+        with open(cache_key[0], 'rb') as f:
+            image_data = f.read()
+    pil_image = Image.open(io.BytesIO(image_data))
+    # Resize to max 1024x1024 to reduce size
+    max_size = (1024, 1024)
+    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    pil_image.save(buffer, format='PNG')
+    png = buffer.getvalue()
+
+    with ai_image_cache_lock:
+        ai_image_cache[cache_key] = png
+        while len(ai_image_cache) > AI_IMAGE_CACHE_SIZE:
+            ai_image_cache.popitem(last=False)
+    return png
+
+def ai_generate(provider, key, prompt, img=None, model=None, max_tokens=None, temperature=None, timeout=None, priority='batch', job=None,
+                system=None):
+    """Send one prompt (optionally with an uploaded image) to an AI provider and return the raw text.
+
+    Every call holds a slot from the provider/model limiter while it is in flight,
+    is bounded by the provider deadline and may be hedged. Errors are raised to the
+    caller after being recorded by the limiter and the provider's circuit breaker.
+    priority is 'interactive' for preview routes and 'batch' for jobs; job identifies
+    the batch so concurrent jobs share the limiter fairly. system holds instructions
+    shared by many calls, sent as the system prompt (see call_provider).
+    """
+    if provider not in DEFAULT_AI_MODELS:
+        raise ValueError(f'Unknown AI provider: {provider}')
+    model = model or DEFAULT_AI_MODELS[provider]
+    png = None
+    if img:
+        png = prepare_ai_image(img)
+        if png is None:
+            raise FileNotFoundError(f'Image not found: {image_name(img)}')
+    # Decode/encode outside the limiter slot so the slot only covers the provider round trip
+    image = None
+    if png and provider == 'gemini':
+        image = Image.open(io.BytesIO(png))
+        image.load()  # decode now; hedged copies of the call share this image
+    image_b64 = base64.b64encode(png).decode('utf-8') if png and provider != 'gemini' else None
+    # PNG header: width and height are the big-endian ints at bytes 16-24
+    image_tokens = image_token_estimate(provider, int.from_bytes(png[16:20], 'big'), int.from_bytes(png[20:24], 'big')) if png else 0
+
+    breaker = get_breaker(provider, key)
+    if not breaker.allow():
+        raise CircuitOpenError(f'{provider} circuit breaker is open')
+    deadline = timeout or AI_DEADLINES[provider]
+
+    def call():
+        start = time.monotonic()
+        text, usage = call_provider(provider, key, model, prompt, image, image_b64, max_tokens, temperature, deadline, system)
+        record_usage(job, provider, model, usage, image_tokens, len(png) if png else 0, time.monotonic() - start)
+        return text
+    try:
+        text = hedged_call(get_limiter(provider, model, key), call, deadline, priority, job)
+    except Exception as e:
+        breaker.record(False if is_transient_ai_error(e) else None)
+        raise
+    breaker.record(True)
+    return text
+
+# Shared pool for provider round trips so a slow call can be hedged or abandoned. It has
+# room for every slot the limiters can grant at their maximum, plus a hedge for each.
+ai_call_pool = ThreadPoolExecutor(max_workers=2 * sum(maximum for _, _, maximum in AI_CONCURRENCY.values()),
+                                  thread_name_prefix='ai-call')
+
+def hedged_call(limiter, call, deadline, priority='batch', job=None):
+    """Run call under the limiter, hedging once past the p95 latency and giving up at the deadline.
+
+    The deadline starts once the call is running, so time spent queued for a pool
+    thread (with several API keys in use) isn't mistaken for a slow provider.
+    """
+    limiter.acquire(priority, job)
+    started = threading.Event()
+    futures = [ai_call_pool.submit(limited_call, limiter, call, started)]
+    started.wait()
+    start = time.monotonic()
+    hedge_delay = limiter.hedge_delay() if AI_HEDGING else None
+    if hedge_delay is not None and hedge_delay < deadline:
+        done, _ = wait(futures, timeout=hedge_delay)
+        # Only hedge when the limiter has a spare slot; never queue behind other work
+        if not done and limiter.try_acquire():
+            futures.append(ai_call_pool.submit(limited_call, limiter, call))
+    error = None
+    try:
+        for future in as_completed(futures, timeout=max(0, deadline - (time.monotonic() - start))):
+            try:
+                return future.result()
             except Exception as e:
-                ai_title = img.rsplit('.', 1)[0]  # Fallback
+                error = e
+    except FuturesTimeoutError:
+        raise TimeoutError(f'AI call exceeded {deadline}s deadline')
+    raise error
+
+def limited_call(limiter, call, started=None):
+    """Run call in a slot the caller already acquired, recording the outcome with the limiter."""
+    if started:
+        started.set()
+    start = time.monotonic()
+    outcome = 'ok'
+    try:
+        return call()
+    except Exception as e:
+        outcome = classify_ai_error(e)
+        raise
+    finally:
+        limiter.release(time.monotonic() - start, outcome)
+
+def call_provider(provider, key, model, prompt, image, image_b64, max_tokens, temperature, timeout, system=None):
+    """Single provider round trip returning (text, usage).
+
+    image is a PIL image for Gemini, image_b64 a PNG for the others. usage has the
+    prompt_tokens, completion_tokens and cached_tokens the provider reported (None if
+    it didn't). The system instructions are sent as the provider's system prompt.
+    """
+    if provider == 'gemini':
+        genai = load_backend('gemini')
+        generation_config = None
+        if max_tokens or temperature is not None:
+            generation_config = genai.types.GenerationConfig(max_output_tokens=max_tokens, temperature=temperature)
+        gemini_model = genai.GenerativeModel(model, generation_config=generation_config, system_instruction=system)
+        gemini_model._client = gemini_client(key)  # never the SDK's process-wide client, which holds one key
+        response = gemini_model.generate_content([prompt, image] if image is not None else prompt, request_options={'timeout': timeout})
+        metadata = getattr(response, 'usage_metadata', None)
+        usage = {'prompt_tokens': getattr(metadata, 'prompt_token_count', None),
+                 'completion_tokens': getattr(metadata, 'candidates_token_count', None),
+                 'cached_tokens': getattr(metadata, 'cached_content_token_count', None)}
+        return response.text.strip(), usage
+    elif provider == 'openai':
+        client = openai_client(key)
+        content = prompt
+        if image_b64:
+            content = [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_b64}"}}
+            ]
+        messages = [{"role": "user", "content": content}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7 if temperature is None else temperature,
+            timeout=timeout,
+        )
+        details = getattr(response.usage, 'prompt_tokens_details', None)
+        usage = {'prompt_tokens': getattr(response.usage, 'prompt_tokens', None),
+                 'completion_tokens': getattr(response.usage, 'completion_tokens', None),
+                 'cached_tokens': getattr(details, 'cached_tokens', None)}
+        return response.choices[0].message.content.strip(), usage
+    else:
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "images": [image_b64] if image_b64 else [],
+            "stream": False,
+            "keep_alive": OLLAMA_KEEP_ALIVE
+        }
+        if system:
+            payload["system"] = system
+        response = requests.post(f'{OLLAMA_URL}/api/generate', json=payload, timeout=timeout)
+        response.raise_for_status()
+        data = response.json()
+        usage = {'prompt_tokens': data.get('prompt_eval_count'), 'completion_tokens': data.get('eval_count')}
+        return data.get('response', 'No response').strip(), usage
+
+# Provider SDKs are imported on first use rather than at startup:
+# google.generativeai pulls in gRPC/protobuf, which shops using only OpenAI or
+# Ollama never need. AI_WARMUP (comma-separated providers) imports them at boot.
+AI_BACKENDS = {'openai': 'openai', 'gemini': 'google.generativeai', 'ollama': None}
+AI_WARMUP = [p.strip() for p in os.environ.get('AI_WARMUP', '').split(',') if p.strip()]
+ai_backends = {}
+ai_backends_lock = threading.Lock()
+openai_clients = {}
+gemini_clients = {}
+
+def load_backend(provider):
+    """Import and cache the SDK module for a provider (None for plain-HTTP providers)."""
+    if provider in ai_backends:
+        return ai_backends[provider]
+    with ai_backends_lock:
+        if provider not in ai_backends:
+            module_name = AI_BACKENDS[provider]
+            ai_backends[provider] = importlib.import_module(module_name) if module_name else None
+        return ai_backends[provider]
+
+def openai_client(key):
+    # Reuse one client per key so its HTTP connection pool survives between calls
+    client = openai_clients.get(key)
+    if client is None:
+        client = openai_clients.setdefault(key, load_backend('openai').OpenAI(api_key=key))
+    return client
+
+def gemini_client(key):
+    # genai.configure() sets one key for the whole process, so concurrent calls with
+    # different keys would race; each key gets its own client, configured the same way
+    client = gemini_clients.get(key)
+    if client is None:
+        load_backend('gemini')
+        manager = importlib.import_module('google.generativeai.client')._ClientManager()
+        manager.configure(api_key=key)
+        client = gemini_clients.setdefault(key, manager.make_client('generative'))
+    return client
+
+def warm_up_providers(providers):
+    for provider in providers:
+        try:
+            start = time.perf_counter()
+            load_backend(provider)
+            print(f"Loaded {provider} backend in {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            print(f"Could not load {provider} backend: {e}")
+
+# Warm up in every process that serves requests or runs jobs: python app.py with or
+# without the reloader, WSGI workers, and jobqueue.py workers. Only the debug
+# reloader's file-watching parent, which never handles a request, is skipped.
+reloader_parent = (__name__ == '__main__' and os.environ.get('FLASK_DEBUG', '1') == '1'
+                   and os.environ.get('WERKZEUG_RUN_MAIN') != 'true')
+if AI_WARMUP and not reloader_parent:
+    threading.Thread(target=warm_up_providers, args=(AI_WARMUP,), daemon=True).start()
+
+def provider_model(provider, rules):
+    if provider == 'ollama':
+        return rules.get('ollama_model') or DEFAULT_AI_MODELS['ollama']
+    if rules.get('over_budget') == 'cheaper' and provider in CHEAPER_AI_MODELS:
+        return CHEAPER_AI_MODELS[provider]
+    return DEFAULT_AI_MODELS.get(provider)
+
+# Batch prompts are split into stable instructions, identical for every image of
+# a batch and sent as the system prompt, and a short per-image part that
+# accompanies the image itself.
+IMAGE_PROMPT = "Here is the design for this product."
+ANALYZE_INSTRUCTIONS = "Describe this image in detail, focusing on the main subject, colors, style, and any text or elements that would be relevant for creating a print-on-demand product."
+
+def content_instructions(type, provider, rules):
+    """Instructions for generating one kind of copy, the system prompt of every call in a batch."""
+    if type == 'title':
+        if provider == 'gemini':
+            return "Generate exactly one creative title for a print-on-demand product based on this image. Keep it under 60 characters. Make it catchy and appealing. If there is text in the design, try to use that in the title. Return only the title, nothing else."
+        if provider == 'openai':
+            return "Generate a creative title for a print-on-demand product based on this image. Keep it under 60 characters. Make it catchy and appealing. If there is text in the design, try to use that in the title."
+        return "If there is text in the image, describe only that text in 1-3 words. If there is no text, describe the image in 1-3 words. Return only the description, nothing else."
+    if type == 'description':
+        prompt = "Generate a compelling product description for a print-on-demand item based on this image. Make it engaging and highlight the unique take on the product. If there is text in the design, try to incorporate that information into the description. Output in valid HTML format using <p> for paragraphs, <strong> for bold text, <em> for italic text, and other basic HTML tags as appropriate. Do not include <html>, <head>, or <body> tags - just the content. Do not use any markdown syntax such as **, *, _, or any other non-HTML formatting."
+        if rules.get('influencer_phrases'):
+            prompt += f" Incorporate the following style or perspective: {rules['influencer_phrases']}."
+        return prompt
+    if provider == 'openai':
+        return "Generate 10 relevant tags for a custom print-on-demand product based on this image and its description. Make them SEO-friendly and appealing. Return as a comma-separated list."
+    return "Generate 10 relevant tags for a custom print-on-demand product based on this image. Make them SEO-friendly and appealing. Return as a comma-separated list."
+
+def generate_content(type, rules, key, img, provider='openai'):
+    use_ai = type in SOURCE_RULES and rules[SOURCE_RULES[type]] == 'ai' and (key or provider == 'ollama')
+    model = provider_model(provider, rules)
+    job = rules.get('job_id')
+    instructions = content_instructions(type, provider, rules) if use_ai else None
+
+    # Use AI if key provided and source is AI
+    if use_ai and type == 'title':
+        try:
+            if provider == 'gemini':
+                ai_title = ai_generate(provider, key, IMAGE_PROMPT, img, model, job=job, max_tokens=60, temperature=0.7, system=instructions)
+                # Ensure it's under 60 chars and take first line if multiple
+                ai_title = ai_title.split('\n')[0].strip()
+            elif provider == 'openai':
+                ai_title = ai_generate(provider, key, IMAGE_PROMPT, img, model, job=job, max_tokens=50, temperature=0.7, system=instructions)
+            else:
+                ai_title = ai_generate(provider, key, IMAGE_PROMPT, img, model, job=job, system=instructions)
+                ai_title = ai_title.replace('\n', ' ').strip()
+            if provider != 'openai':
+                # Remove quotation marks
+                ai_title = ai_title.strip('"').strip("'")
+        except Exception as e:
+            failover = failover_provider(rules, provider, e)
+            if failover:
+                return generate_content(type, rules, failover[1], img, failover[0])
+            if rules.get('raise_ai_errors'):
+                raise
+            log_message(f'AI title failed for {image_name(img)} ({provider}): {e}', 'error')
+            ai_title = image_name(img).rsplit('.', 1)[0]  # Fallback
         # Apply template and custom text
         template = rules.get('title_template', '[AI-Generated Title]')
         custom_text = rules.get('custom_title_text', '')
         title = template.replace('[AI-Generated Title]', ai_title).replace('[Custom Text]', custom_text)
         title = title[:60]  # Ensure the final title is under 60 characters
         return title
-    elif type == 'description' and rules['desc_source'] == 'ai' and (key or provider == 'ollama'):
-        prompt = "Generate a compelling product description for a print-on-demand item based on this image. Make it engaging and highlight the unique take on the product. If there is text in the design, try to incorporate that information into the description. Output in valid HTML format using <p> for paragraphs, <strong> for bold text, <em> for italic text, and other basic HTML tags as appropriate. Do not include <html>, <head>, or <body> tags - just the content. Do not use any markdown syntax such as **, *, _, or any other non-HTML formatting."
-        if rules.get('influencer_phrases'):
-            prompt += f" Incorporate the following style or perspective: {rules['influencer_phrases']}."
-        if provider == 'gemini':
-            try:
-                genai.configure(api_key=key)
-                generation_config = genai.types.GenerationConfig(
-                    max_output_tokens=400,
-                    temperature=0.7,
-                )
-                model = genai.GenerativeModel('models/gemini-2.0-flash', generation_config=generation_config)
-                secure_img = secure_filename(img)
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                if os.path.exists(img_path):
-                    with open(img_path, 'rb') as f:
-                        image_data = f.read()
-                    pil_image = Image.open(io.BytesIO(image_data))
-                    # Resize to max 1024x1024 to reduce size
-                    max_size = (1024, 1024)
-                    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    response = model.generate_content([prompt, pil_image])
-                    ai_desc = response.text.strip()
-                else:
-                    ai_desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
-            except Exception as e:
-                ai_desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
-            desc = clean_ai_response(ai_desc)
-            custom_html = rules.get('custom_html', '')
-            return desc + custom_html
-        elif provider == 'openai':
-            try:
-                import openai
-                client = openai.OpenAI(api_key=key)
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": prompt},
-                                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{get_image_base64(img)}"}}
-                            ]
-                        }
-                    ],
-                    max_tokens=200,
-                    temperature=0.7,
-                    timeout=30,
-                )
-                ai_desc = response.choices[0].message.content.strip()
+    elif use_ai and type == 'description':
+        try:
+            if provider == 'gemini':
+                ai_desc = ai_generate(provider, key, IMAGE_PROMPT, img, model, job=job, max_tokens=400, temperature=0.7, system=instructions)
+            elif provider == 'openai':
+                ai_desc = ai_generate(provider, key, IMAGE_PROMPT, img, model, job=job, max_tokens=200, temperature=0.7, timeout=30, system=instructions)
                 # Enforce paragraph count
                 paragraphs = rules.get('paragraphs', 1)
                 ai_desc = '\n\n'.join(ai_desc.split('\n\n')[:paragraphs])
-                desc = clean_ai_response(ai_desc)
-            except Exception as e:
-                desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
-            custom_html = rules.get('custom_html', '')
-            return desc + custom_html
-        elif provider == 'ollama':
-            try:
-                secure_img = secure_filename(img)
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                if os.path.exists(img_path):
-                    with open(img_path, 'rb') as f:
-                        image_data = f.read()
-                    pil_image = Image.open(io.BytesIO(image_data))
-                    # Resize to max 1024x1024 to reduce size
-                    max_size = (1024, 1024)
-                    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    buffer = io.BytesIO()
-                    pil_image.save(buffer, format='PNG')
-                    resized_data = buffer.getvalue()
-                    image_b64 = base64.b64encode(resized_data).decode('utf-8')
-                    payload = {
-                        "model": rules.get('ollama_model', 'llava'),
-                        "prompt": prompt,
-                        "images": [image_b64],
-                        "stream": False
-                    }
-                    response = requests.post('http://localhost:11434/api/generate', json=payload, timeout=120)
-                    if response.status_code == 200:
-                        desc = clean_ai_response(response.json().get('response', 'No response').strip())
-                    else:
-                        desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
-                else:
-                    desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
-            except Exception as e:
-                desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
-            custom_html = rules.get('custom_html', '')
-            return desc + custom_html
-    elif type == 'tags' and rules['tag_source'] == 'ai' and (key or provider == 'ollama'):
-        if provider == 'gemini':
-            try:
-                genai.configure(api_key=key)
-                model = genai.GenerativeModel('models/gemini-2.0-flash')
-                secure_img = secure_filename(img)
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                if os.path.exists(img_path):
-                    with open(img_path, 'rb') as f:
-                        image_data = f.read()
-                    pil_image = Image.open(io.BytesIO(image_data))
-                    # Resize to max 1024x1024 to reduce size
-                    max_size = (1024, 1024)
-                    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    prompt = "Generate 10 relevant tags for a custom print-on-demand product based on this image. Make them SEO-friendly and appealing. Return as a comma-separated list."
-                    response = model.generate_content([prompt, pil_image])
-                    tags_str = response.text.strip()
-                    return [tag.strip() for tag in tags_str.split(',') if tag.strip()]
-                else:
-                    return ['custom', 'print-on-demand', 'artwork']  # Fallback
-            except Exception as e:
-                return ['custom', 'print-on-demand', 'artwork']  # Fallback
-        elif provider == 'openai':
-            try:
-                import openai
-                client = openai.OpenAI(api_key=key)
-                prompt = f"Generate 10 relevant tags for a custom print-on-demand product based on this image description: {image_description}. Make them SEO-friendly and appealing. Return as a comma-separated list."
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": prompt},
-                                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{get_image_base64(img)}"}}
-                            ]
-                        }
-                    ],
-                    max_tokens=100,
-                    temperature=0.7,
-                )
-                tags_str = response.choices[0].message.content.strip()
-                return [tag.strip() for tag in tags_str.split(',') if tag.strip()]
-            except Exception as e:
-                return ['custom', 'print-on-demand', 'artwork']  # Fallback
-        elif provider == 'ollama':
-            try:
-                secure_img = secure_filename(img)
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                if os.path.exists(img_path):
-                    with open(img_path, 'rb') as f:
-                        image_data = f.read()
-                    pil_image = Image.open(io.BytesIO(image_data))
-                    # Resize to max 1024x1024 to reduce size
-                    max_size = (1024, 1024)
-                    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    buffer = io.BytesIO()
-                    pil_image.save(buffer, format='PNG')
-                    resized_data = buffer.getvalue()
-                    image_b64 = base64.b64encode(resized_data).decode('utf-8')
-                    payload = {
-                        "model": rules.get('ollama_model', 'llava'),
-                        "prompt": "Generate 10 relevant tags for a custom print-on-demand product based on this image. Make them SEO-friendly and appealing. Return as a comma-separated list.",
-                        "images": [image_b64],
-                        "stream": False
-                    }
-                    response = requests.post('http://localhost:11434/api/generate', json=payload, timeout=120)
-                    if response.status_code == 200:
-                        tags_str = response.json().get('response', 'No response').strip()
-                        # Clean up tags by removing quotes and extra spaces
-                        tags_str = tags_str.replace('"', '').replace("'", '').strip()
-                        tags = [tag.strip() for tag in tags_str.split(',') if tag.strip()]
-                        return tags[:10]  # Limit to 10 tags
-                    else:
-                        return ['custom', 'print-on-demand', 'artwork']  # Fallback
-                else:
-                    return ['custom', 'print-on-demand', 'artwork']  # Fallback
-            except Exception as e:
-                return ['custom', 'print-on-demand', 'artwork']  # Fallback
+            else:
+                ai_desc = ai_generate(provider, key, IMAGE_PROMPT, img, model, job=job, system=instructions)
+            desc = clean_ai_response(ai_desc)
+        except Exception as e:
+            failover = failover_provider(rules, provider, e)
+            if failover:
+                return generate_content(type, rules, failover[1], img, failover[0])
+            if rules.get('raise_ai_errors'):
+                raise
+            log_message(f'AI description failed for {image_name(img)} ({provider}): {e}', 'error')
+            desc = DESCRIPTION_FALLBACK
+        custom_html = rules.get('custom_html', '')
+        return desc + custom_html
+    elif use_ai and type == 'tags':
+        try:
+            if provider == 'gemini':
+                tags_str = ai_generate(provider, key, IMAGE_PROMPT, img, model, job=job, system=instructions)
+            elif provider == 'openai':
+                # Only the OpenAI tag prompt uses the separate image analysis
+                image_description = analyze_image(img, key, provider, rules)
+                tags_str = ai_generate(provider, key, f"{IMAGE_PROMPT} Image description: {image_description}", img, model, job=job,
+                                       max_tokens=100, temperature=0.7, system=instructions)
+            else:
+                tags_str = ai_generate(provider, key, IMAGE_PROMPT, img, model, job=job, system=instructions)
+                # Clean up tags by removing quotes and extra spaces
+                tags_str = tags_str.replace('"', '').replace("'", '').strip()
+        except Exception as e:
+            failover = failover_provider(rules, provider, e)
+            if failover:
+                return generate_content(type, rules, failover[1], img, failover[0])
+            if rules.get('raise_ai_errors'):
+                raise
+            log_message(f'AI tags failed for {image_name(img)} ({provider}): {e}', 'error')
+            return list(TAGS_FALLBACK)
+        tags = [tag.strip() for tag in tags_str.split(',') if tag.strip()]
+        if provider == 'ollama':
+            tags = tags[:10]  # Limit to 10 tags
+        return tags
 
     # Local fallback: use example product content
     if type == 'title':
         if rules['title_source'] == 'filename':
-            return img.rsplit('.', 1)[0]
+            return image_name(img).rsplit('.', 1)[0]
         else:
-            return rules.get('example_title', img.rsplit('.', 1)[0])
+            return rules.get('example_title', image_name(img).rsplit('.', 1)[0])
     elif type == 'description':
         if rules['desc_source'] == 'copy':
             return rules.get('example_desc', '')
         else:
-            return rules.get('example_desc', "A unique print-on-demand product featuring custom artwork.")
+            return rules.get('example_desc', DESCRIPTION_FALLBACK)
     elif type == 'tags':
         if rules['tag_source'] == 'copy':
             return rules.get('example_tags', [])
         else:
-            return rules.get('example_tags', ['custom', 'print-on-demand', 'artwork'])
+            return rules.get('example_tags', list(TAGS_FALLBACK))
     return ''
 
-def analyze_image(img, key, provider):
+def analyze_image(img, key, provider, rules=None):
     """Analyze the image and return a description."""
-    secure_img = secure_filename(str(img))
-    img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-    if not os.path.exists(img_path):
-        return "Image not found"
-
+    rules = rules or {}
     try:
-        if provider == 'gemini':
-            genai.configure(api_key=key)
-            model = genai.GenerativeModel('models/gemini-2.0-flash')
-            with open(img_path, 'rb') as f:
-                image_data = f.read()
-            image = Image.open(io.BytesIO(image_data))
-            prompt = "Describe this image in detail, focusing on the main subject, colors, style, and any text or elements that would be relevant for creating a print-on-demand product."
-            response = model.generate_content([prompt, image])
-            return response.text.strip()
-        elif provider == 'openai':
-            import openai
-            client = openai.OpenAI(api_key=key)
-            with open(img_path, 'rb') as f:
-                image_data = f.read()
-            pil_image = Image.open(io.BytesIO(image_data))
-            # Resize to max 1024x1024 to reduce size
-            max_size = (1024, 1024)
-            pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-            buffer = io.BytesIO()
-            pil_image.save(buffer, format='PNG')
-            resized_data = buffer.getvalue()
-            image_data = base64.b64encode(resized_data).decode('utf-8')
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "Describe this image in detail, focusing on the main subject, colors, style, and any text or elements that would be relevant for creating a print-on-demand product."},
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}}
-                        ]
-                    }
-                ],
-                max_tokens=200,
-                temperature=0.7,
-                timeout=30,
-            )
-            return response.choices[0].message.content.strip()
-    except Exception as e:
-        return "Custom artwork image"
-
-def analyze_image_ollama(img, rules):
-    """Analyze the image using Ollama local model."""
-    secure_img = secure_filename(str(img))
-    img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-    if not os.path.exists(img_path):
+        if provider == 'openai':
+            return ai_generate(provider, key, IMAGE_PROMPT, img, provider_model(provider, rules), max_tokens=200, temperature=0.7, timeout=30,
+                               job=rules.get('job_id'), system=ANALYZE_INSTRUCTIONS)
+        return ai_generate(provider, key, IMAGE_PROMPT, img, provider_model(provider, rules), job=rules.get('job_id'), system=ANALYZE_INSTRUCTIONS)
+    except FileNotFoundError:
         return "Image not found"
-
-    try:
-        with open(img_path, 'rb') as f:
-            image_data = f.read()
-        pil_image = Image.open(io.BytesIO(image_data))
-        # Resize to max 1024x1024 to reduce size
-        max_size = (1024, 1024)
-        pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format='PNG')
-        resized_data = buffer.getvalue()
-        image_b64 = base64.b64encode(resized_data).decode('utf-8')
-        payload = {
-            "model": rules.get('ollama_model', 'llava'),
-            "prompt": "Describe this image in detail, focusing on the main subject, colors, style, and any text or elements that would be relevant for creating a print-on-demand product.",
-            "images": [image_b64],
-            "stream": False
-        }
-        response = requests.post('http://localhost:11434/api/generate', json=payload, timeout=120)
-        if response.status_code == 200:
-            return response.json().get('response', 'No response')
-        else:
-            return "Error analyzing image with Ollama"
     except Exception as e:
         return "Custom artwork image"
 
-def get_image_base64(img):
-    """Get base64 encoded image for OpenAI API."""
-    secure_img = secure_filename(str(img))
-    img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-    if not os.path.exists(img_path):
-        return ""
-    with open(img_path, 'rb') as f:
-        return base64.b64encode(f.read()).decode('utf-8')
-
 @app.route('/api/progress', methods=['GET'])
 def get_progress():
-    return jsonify(progress)
+    job_id = request.args.get('job_id')
+    if job_id:
+        local = job_id == progress.get('job_id')
+    else:
+        # Catalogue updates and publishes run in this process; queued batches default to the latest job
+        local = progress.get('mode') in ('update', 'publish') and progress['status'] == 'working'
+    if job_queue and not local:
+        status = job_queue.progress(job_id)
+        # Limiters and breakers belong to the worker processes; show each one's latest snapshot
+        workers = job_queue.live_workers()
+        status['ai_limits'] = {f'{name} ({worker})': limiter for worker, snapshot in workers.items() if snapshot
+                               for name, limiter in snapshot['ai_limits'].items()}
+        status['ai_breakers'] = {f'{name} ({worker})': breaker for worker, snapshot in workers.items() if snapshot
+                                 for name, breaker in snapshot['ai_breakers'].items()}
+        status['ai_workers'] = len(workers)
+        status['ai_usage'] = usage_summary(status.get('job_id'))
+        return jsonify(status)
+    status = dict(progress, ai_limits=limiter_snapshot(), ai_breakers=breaker_snapshot(), ai_usage=usage_summary(progress.get('job_id')))
+    if progress['status'] == 'working' and progress.get('started'):
+        elapsed = time.time() - progress['started']
+        status['throughput'] = round(progress['current'] / elapsed * 60, 1) if elapsed else 0  # per minute
+    return jsonify(status)
+
+@app.route('/api/usage', methods=['GET'])
+def get_usage():
+    """AI usage and estimated cost for one job (?job_id=, 'interactive' for previews) or every job kept in memory."""
+    job_id = request.args.get('job_id')
+    if job_id:
+        return jsonify(usage_summary(job_id) or {'error': 'Unknown job'})
+    if job_queue:
+        jobs = job_queue.usage_jobs(AI_USAGE_JOBS)
+    else:
+        with ai_usage_lock:
+            jobs = list(ai_usage)
+    return jsonify({job: usage_summary(job) for job in jobs})
 
 @app.route('/api/cancel', methods=['POST'])
 def cancel_operation():
     global cancel_operation
     cancel_operation = True
+    if job_queue:
+        job_id = (request.get_json(silent=True) or {}).get('job_id') or job_queue.latest_job_id()
+        job_queue.cancel(job_id)
+        result_store.finish_run(job_id, 'cancelled')
     log_message('Cancel operation requested by user', 'info')
     return jsonify({'message': 'Operation cancelled'})
 
-@app.route('/api/generate_title', methods=['POST'])
-def generate_title():
-    data = request.json
+# Previews run off the request thread: the routes answer 202 with a task id
+# and the result is polled from /api/preview/<task_id> (which can wait briefly
+# with ?wait=). Identical requests in flight share one provider call. With
+# JOB_DB, tasks and results live in the database, so any web worker can answer
+# the poll and identical requests are shared across workers.
+PREVIEW_WORKERS = 8
+PREVIEW_TASK_TTL = 600  # seconds a finished preview stays retrievable
+PREVIEW_MAX_WAIT = 5
+PREVIEW_STALE = 2 * max(AI_DEADLINES.values())  # a shared task pending this long lost its process
+preview_pool = ThreadPoolExecutor(max_workers=PREVIEW_WORKERS, thread_name_prefix='preview')
+preview_tasks = {}  # task id -> (Future, created)
+preview_inflight = {}  # request fingerprint -> Future
+preview_lock = threading.RLock()
+
+def submit_preview(build, data):
     provider = data.get('provider', 'openai')
-    key = data.get(f'{provider}_key')
-    if provider != 'ollama' and not key:
+    if provider != 'ollama' and not data.get(f'{provider}_key'):
         return jsonify({'error': f'{provider.capitalize()} API key required'}), 400
-
+    # Same route, image, provider, key and prompt settings -> same fingerprint
+    fingerprint = hashlib.sha256(json.dumps([build.__name__, data], sort_keys=True, default=str).encode()).hexdigest()
+    if job_queue:
+        task_id, coalesced = job_queue.create_preview_task(uuid.uuid4().hex[:12], fingerprint, PREVIEW_TASK_TTL, PREVIEW_STALE)
+        if not coalesced:
+            preview_pool.submit(run_shared_preview, task_id, build, data)
+        return jsonify({'task_id': task_id, 'status': 'pending', 'coalesced': coalesced}), 202
+    now = time.time()
+    with preview_lock:
+        for task_id, (future, created) in list(preview_tasks.items()):
+            if future.done() and now - created > PREVIEW_TASK_TTL:
+                del preview_tasks[task_id]
+        future = preview_inflight.get(fingerprint)
+        coalesced = future is not None
+        if not coalesced:
+            future = preview_pool.submit(build, data)
+            preview_inflight[fingerprint] = future
+            future.add_done_callback(functools.partial(forget_preview, fingerprint))
+        task_id = uuid.uuid4().hex[:12]
+        preview_tasks[task_id] = (future, now)
+    return jsonify({'task_id': task_id, 'status': 'pending', 'coalesced': coalesced}), 202
+
+def run_shared_preview(task_id, build, data):
     try:
-        mode = data.get('mode', 'simple')
-        segments = data.get('segments', 1)
-        custom_text = data.get('custom_title_text', '')
-        template = data.get('template', '[AI-Generated Title] [Custom Text]')
-        image_path = data.get('image_path', '')
-
-        if mode == 'simple':
-            prompt = "Generate a creative title for a custom print-on-demand product. Keep it under 60 characters. Make it catchy and appealing."
-        else:
-            prompt = f"Generate a compound title with {segments} segments for a custom print-on-demand product. Make it creative and appealing."
+        result = build(data)
+    except Exception as e:
+        job_queue.finish_preview_task(task_id, error=str(e))
+        return
+    job_queue.finish_preview_task(task_id, result)
+
+def forget_preview(fingerprint, future):
+    # Later identical requests start a fresh call once this one has finished
+    with preview_lock:
+        if preview_inflight.get(fingerprint) is future:
+            del preview_inflight[fingerprint]
+
+@app.route('/api/preview/<task_id>', methods=['GET'])
+def get_preview(task_id):
+    """Result of a preview task: 200 with the result, 202 while pending. ?wait=N blocks up to N seconds (at most 5)."""
+    wait_seconds = min(request.args.get('wait', 0, type=float), PREVIEW_MAX_WAIT)
+    if job_queue:
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            task = job_queue.preview_task(task_id)
+            if task is None:
+                return jsonify({'error': 'Unknown preview task'}), 404
+            if task['status'] != 'pending' or time.monotonic() >= deadline:
+                break
+            time.sleep(0.2)
+        if task['status'] == 'pending' and time.time() - task['created'] > PREVIEW_STALE:
+            return jsonify({'task_id': task_id, 'status': 'error', 'error': 'Preview task was lost; try again'}), 500
+        if task['status'] == 'pending':
+            return jsonify({'task_id': task_id, 'status': 'pending'}), 202
+        if task['status'] == 'error':
+            return jsonify({'task_id': task_id, 'status': 'error', 'error': task['error']}), 500
+        return jsonify(dict(task['result'], task_id=task_id, status='done'))
+    task = preview_tasks.get(task_id)
+    if task is None:
+        return jsonify({'error': 'Unknown preview task'}), 404
+    future = task[0]
+    try:
+        result = future.result(timeout=wait_seconds)
+    except FuturesTimeoutError:
+        return jsonify({'task_id': task_id, 'status': 'pending'}), 202
+    except Exception as e:
+        return jsonify({'task_id': task_id, 'status': 'error', 'error': str(e)}), 500
+    return jsonify(dict(result, task_id=task_id, status='done'))
 
-        if image_path:
-            if provider == 'gemini':
-                genai.configure(api_key=key)
-                model = genai.GenerativeModel('models/gemini-2.0-flash')
-                secure_img = secure_filename(str(image_path))
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                if os.path.exists(img_path):
-                    with open(img_path, 'rb') as f:
-                        image_data = f.read()
-                    pil_image = Image.open(io.BytesIO(image_data))
-                    # Resize to max 1024x1024 to reduce size
-                    max_size = (1024, 1024)
-                    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    response = model.generate_content([prompt, pil_image])
-                    ai_title = response.text.strip()
-                else:
-                    ai_title = "Image not found"
-            elif provider == 'openai':
-                import openai
-                client = openai.OpenAI(api_key=key)
-                secure_img = secure_filename(str(image_path))
-                img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                if os.path.exists(img_path):
-                    with open(img_path, 'rb') as f:
-                        image_data = f.read()
-                    pil_image = Image.open(io.BytesIO(image_data))
-                    # Resize to max 1024x1024 to reduce size
-                    max_size = (1024, 1024)
-                    pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                    buffer = io.BytesIO()
-                    pil_image.save(buffer, format='PNG')
-                    resized_data = buffer.getvalue()
-                    image_data = base64.b64encode(resized_data).decode('utf-8')
-                    response = client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": prompt},
-                                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}}
-                                ]
-                            }
-                        ],
-                        max_tokens=50,
-                        temperature=0.7,
-                        timeout=30,
-                    )
-                    ai_title = response.choices[0].message.content.strip()
-                    # Remove quotation marks
-                    ai_title = ai_title.strip('"').strip("'")
-                else:
-                    ai_title = "Image not found"
-            elif provider == 'ollama':
-                try:
-                    secure_img = secure_filename(image_path)
-                    img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                    if secure_img and os.path.isfile(img_path):
-                        with open(img_path, 'rb') as f:
-                            image_data = f.read()
-                        pil_image = Image.open(io.BytesIO(image_data))
-                        # Resize to max 1024x1024 to reduce size
-                        max_size = (1024, 1024)
-                        pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                        buffer = io.BytesIO()
-                        pil_image.save(buffer, format='PNG')
-                        resized_data = buffer.getvalue()
-                        image_b64 = base64.b64encode(resized_data).decode('utf-8')
-                        payload = {
-                            "model": rules.get('ollama_model', 'llava'),
-                            "prompt": prompt,
-                            "images": [image_b64],
-                            "stream": False
-                        }
-                        response = requests.post('http://localhost:11434/api/generate', json=payload, timeout=120)
-                        if response.status_code == 200:
-                            ai_title = response.json().get('response', 'No response').strip()
-                            # Clean up title
-                            ai_title = ai_title.replace('\n', ' ').strip()
-                            ai_title = ai_title.strip('"').strip("'")
-                        else:
-                            ai_title = "Image not found"
-                    else:
-                        ai_title = "Image not found"
-                except Exception as e:
-                    ai_title = "Ollama error"
-        else:
-            # Fallback to text-only
-            if provider == 'gemini':
-                genai.configure(api_key=key)
-                model = genai.GenerativeModel('models/gemini-2.0-flash')
-                response = model.generate_content(prompt)
-                ai_title = response.text.strip()
-            elif provider == 'openai':
-                import openai
-                client = openai.OpenAI(api_key=key)
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=50,
-                    temperature=0.7,
-                )
-                ai_title = response.choices[0].message.content.strip()
+@app.route('/api/generate_title', methods=['POST'])
+def generate_title():
+    return submit_preview(preview_title, request.json)
+
+@app.route('/api/generate_description', methods=['POST'])
+def generate_description():
+    return submit_preview(preview_description, request.json)
+
+@app.route('/api/generate_tags', methods=['POST'])
+def generate_tags():
+    return submit_preview(preview_tags, request.json)
+
+def preview_title(data):
+    provider = data.get('provider', 'openai')
+    key = data.get(f'{provider}_key')
+    mode = data.get('mode', 'simple')
+    segments = data.get('segments', 1)
+    custom_text = data.get('custom_title_text', '')
+    template = data.get('template', '[AI-Generated Title] [Custom Text]')
+    image_path = secure_filename(str(data.get('image_path') or '')) or None
+
+    if mode == 'simple':
+        prompt = "Generate a creative title for a custom print-on-demand product. Keep it under 60 characters. Make it catchy and appealing."
+    else:
+        prompt = f"Generate a compound title with {segments} segments for a custom print-on-demand product. Make it creative and appealing."
+
+    # Previews are interactive: they are scheduled ahead of any running batch
+    if provider == 'ollama':
+        try:
+            ai_title = ai_generate(provider, key, prompt, image_path, provider_model(provider, data), priority='interactive')
+            # Clean up title
+            ai_title = ai_title.replace('\n', ' ').strip()
+            ai_title = ai_title.strip('"').strip("'")
+        except FileNotFoundError:
+            ai_title = "Image not found"
+        except Exception as e:
+            ai_title = "Ollama error"
+    else:
+        try:
+            if provider == 'openai':
+                # Fallback to text-only model when there is no image
+                model = 'gpt-4o' if image_path else 'gpt-3.5-turbo'
+                ai_title = ai_generate(provider, key, prompt, image_path, model, max_tokens=50, temperature=0.7, timeout=30 if image_path else None, priority='interactive')
                 # Remove quotation marks
                 ai_title = ai_title.strip('"').strip("'")
-            elif provider == 'ollama':
-                try:
-                    secure_img = secure_filename(image_path)
-                    img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                    if secure_img and os.path.isfile(img_path):
-                        with open(img_path, 'rb') as f:
-                            image_data = f.read()
-                        pil_image = Image.open(io.BytesIO(image_data))
-                        # Resize to max 1024x1024 to reduce size
-                        max_size = (1024, 1024)
-                        pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                        buffer = io.BytesIO()
-                        pil_image.save(buffer, format='PNG')
-                        resized_data = buffer.getvalue()
-                        image_b64 = base64.b64encode(resized_data).decode('utf-8')
-                        payload = {
-                            "model": rules.get('ollama_model', 'llava'),
-                            "prompt": prompt,
-                            "images": [image_b64],
-                            "stream": False
-                        }
-                        response = requests.post('http://localhost:11434/api/generate', json=payload, timeout=120)
-                        if response.status_code == 200:
-                            ai_title = response.json().get('response', 'No response').strip()
-                            # Clean up title
-                            ai_title = ai_title.replace('\n', ' ').strip()
-                            ai_title = ai_title.strip('"').strip("'")
-                        else:
-                            ai_title = "Image not found"
-                    else:
-                        ai_title = "Image not found"
-                except Exception as e:
-                    ai_title = "Ollama error"
+            else:
+                ai_title = ai_generate(provider, key, prompt, image_path, priority='interactive')
+        except FileNotFoundError:
+            ai_title = "Image not found"
 
-        title = template.replace('[AI-Generated Title]', ai_title).replace('[Custom Text]', custom_text)
-        title = title[:60]  # Ensure the final title is under 60 characters
-        return jsonify({'title': title})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    title = template.replace('[AI-Generated Title]', ai_title).replace('[Custom Text]', custom_text)
+    title = title[:60]  # Ensure the final title is under 60 characters
+    return {'title': title}
 
-@app.route('/api/generate_description', methods=['POST'])
-def generate_description():
-    data = request.json
+def preview_description(data):
     provider = data.get('provider', 'openai')
     key = data.get(f'{provider}_key')
-    if not key:
-        return jsonify({'error': f'{provider.capitalize()} API key required'}), 400
+    paragraphs = data.get('paragraphs', 1)
+    custom_html = data.get('custom_html', '')
+    influencer_phrases = data.get('influencer_phrases', '')
+    image_path = secure_filename(str(data.get('image_path') or '')) or None
+
+    prompt = f"Generate a compelling product description based on this image. Write {paragraphs} paragraph(s). Tap into the emotional or thematic message behind the design. Use intriguing, appealing language and incorporate any text from the design. Output in valid HTML format using <p> for paragraphs, <strong> for bold text, <em> for italic text, and other basic HTML tags as appropriate. Do not include <html>, <head>, or <body> tags - just the content. Do not use any markdown syntax such as **, *, _, or any other non-HTML formatting."
+    if influencer_phrases:
+        prompt += f" Incorporate the following style or perspective: {influencer_phrases}."
 
     try:
-        paragraphs = data.get('paragraphs', 1)
-        custom_html = data.get('custom_html', '')
-        influencer_phrases = data.get('influencer_phrases', '')
-        image_path = data.get('image_path', '')
-
-        prompt = f"Generate a compelling product description based on this image. Write {paragraphs} paragraph(s). Tap into the emotional or thematic message behind the design. Use intriguing, appealing language and incorporate any text from the design. Output in valid HTML format using <p> for paragraphs, <strong> for bold text, <em> for italic text, and other basic HTML tags as appropriate. Do not include <html>, <head>, or <body> tags - just the content. Do not use any markdown syntax such as **, *, _, or any other non-HTML formatting."
-        if influencer_phrases:
-            prompt += f" Incorporate the following style or perspective: {influencer_phrases}."
-
-        if image_path:
-            secure_img = secure_filename(image_path)
-            img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-            if os.path.exists(img_path):
-                with open(img_path, 'rb') as f:
-                    image_data = f.read()
-                pil_image = Image.open(io.BytesIO(image_data))
-                # Resize to max 1024x1024 to reduce size
-                max_size = (1024, 1024)
-                pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                if provider == 'gemini':
-                    genai.configure(api_key=key)
-                    model = genai.GenerativeModel('models/gemini-2.0-flash')
-                    response = model.generate_content([prompt, pil_image])
-                    ai_desc = response.text.strip()
-                    # Enforce paragraph count
-                    paragraphs = data.get('paragraphs', 1)
-                    ai_desc = '\n\n'.join(ai_desc.split('\n\n')[:paragraphs])
-                elif provider == 'openai':
-                    import openai
-                    client = openai.OpenAI(api_key=key)
-                    buffer = io.BytesIO()
-                    pil_image.save(buffer, format='PNG')
-                    resized_data = buffer.getvalue()
-                    image_data = base64.b64encode(resized_data).decode('utf-8')
-                    response = client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {
-                                "role": "user",
-                                "content": [
-                                    {"type": "text", "text": prompt},
-                                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_data}"}}
-                                ]
-                            }
-                        ],
-                        max_tokens=200,
-                        temperature=0.7,
-                        timeout=30,
-                    )
-                    ai_desc = clean_ai_response(response.choices[0].message.content.strip())
-            else:
-                ai_desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
+        if provider == 'openai':
+            model = 'gpt-4o' if image_path else 'gpt-3.5-turbo'
+            ai_desc = ai_generate(provider, key, prompt, image_path, model, max_tokens=200, temperature=0.7, timeout=30, priority='interactive')
+        elif provider == 'gemini':
+            ai_desc = ai_generate(provider, key, prompt, image_path, priority='interactive')
+            # Enforce paragraph count
+            ai_desc = '\n\n'.join(ai_desc.split('\n\n')[:paragraphs])
         else:
-            if provider == 'gemini':
-                genai.configure(api_key=key)
-                model = genai.GenerativeModel('models/gemini-2.0-flash')
-                response = model.generate_content(prompt)
-                ai_desc = response.text.strip()
-                # Enforce paragraph count
-                paragraphs = data.get('paragraphs', 1)
-                ai_desc = '\n\n'.join(ai_desc.split('\n\n')[:paragraphs])
-            elif provider == 'openai':
-                import openai
-                client = openai.OpenAI(api_key=key)
-                response = client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=200,
-                    temperature=0.7,
-                    timeout=30,
-                )
-                ai_desc = clean_ai_response(response.choices[0].message.content.strip())
-            elif provider == 'ollama':
-                try:
-                    secure_img = secure_filename(image_path)
-                    img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-                    if os.path.exists(img_path):
-                        with open(img_path, 'rb') as f:
-                            image_data = f.read()
-                        pil_image = Image.open(io.BytesIO(image_data))
-                        # Resize to max 1024x1024 to reduce size
-                        max_size = (1024, 1024)
-                        pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                        buffer = io.BytesIO()
-                        pil_image.save(buffer, format='PNG')
-                        resized_data = buffer.getvalue()
-                        image_b64 = base64.b64encode(resized_data).decode('utf-8')
-                        payload = {
-                            "model": rules.get('ollama_model', 'llava'),
-                            "prompt": prompt,
-                            "images": [image_b64],
-                            "stream": False
-                        }
-                        response = requests.post('http://localhost:11434/api/generate', json=payload, timeout=120)
-                        if response.status_code == 200:
-                            ai_desc = clean_ai_response(response.json().get('response', 'No response').strip())
-                        else:
-                            ai_desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
-                    else:
-                        ai_desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
-                except Exception as e:
-                    ai_desc = "A unique print-on-demand product featuring custom artwork."  # Fallback
+            try:
+                ai_desc = ai_generate(provider, key, prompt, image_path, provider_model(provider, data), priority='interactive')
+            except Exception as e:
+                ai_desc = DESCRIPTION_FALLBACK
+    except FileNotFoundError:
+        ai_desc = DESCRIPTION_FALLBACK
 
-        desc = clean_ai_response(ai_desc) + custom_html
-        return jsonify({'description': desc})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    desc = clean_ai_response(ai_desc) + custom_html
+    return {'description': desc}
 
-@app.route('/api/generate_tags', methods=['POST'])
-def generate_tags():
-    data = request.json
+def preview_tags(data):
     provider = data.get('provider', 'openai')
     key = data.get(f'{provider}_key')
-    if not key:
-        return jsonify({'error': f'{provider.capitalize()} API key required'}), 400
+    max_tags = int(data.get('max_tags', 10))
+    evergreen = data.get('evergreen', '').split(',')
 
-    try:
-        max_tags = int(data.get('max_tags', 10))
-        evergreen = data.get('evergreen', '').split(',')
+    prompt = f"Generate {max_tags} relevant tags for a custom print-on-demand product. Make them SEO-friendly and appealing. Return as a comma-separated list."
 
-        prompt = f"Generate {max_tags} relevant tags for a custom print-on-demand product. Make them SEO-friendly and appealing. Return as a comma-separated list."
-
-        if provider == 'gemini':
-            genai.configure(api_key=key)
-            model = genai.GenerativeModel('models/gemini-2.0-flash')
-            response = model.generate_content(prompt)
-            ai_tags_str = response.text.strip()
-        elif provider == 'openai':
-            import openai
-            client = openai.OpenAI(api_key=key)
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=100,
-                temperature=0.7,
-            )
-            ai_tags_str = response.choices[0].message.content.strip()
-        elif provider == 'ollama':
-            secure_img = secure_filename(data.get('image_path', ''))
-            img_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_img)
-            if os.path.exists(img_path):
-                with open(img_path, 'rb') as f:
-                    image_data = f.read()
-                pil_image = Image.open(io.BytesIO(image_data))
-                # Resize to max 1024x1024 to reduce size
-                max_size = (1024, 1024)
-                pil_image.thumbnail(max_size, Image.Resampling.LANCZOS)
-                buffer = io.BytesIO()
-                pil_image.save(buffer, format='PNG')
-                resized_data = buffer.getvalue()
-                image_b64 = base64.b64encode(resized_data).decode('utf-8')
-                payload = {
-                    "model": data.get('ollama_model', 'llava'),
-                    "prompt": prompt,
-                    "images": [image_b64],
-                    "stream": False
-                }
-                response = requests.post('http://localhost:11434/api/generate', json=payload, timeout=120)
-                if response.status_code == 200:
-                    ai_tags_str = response.json().get('response', 'No response').strip()
-                else:
-                    ai_tags_str = "custom, print-on-demand, artwork"  # Fallback
-            else:
-                ai_tags_str = "custom, print-on-demand, artwork"  # Fallback
+    if provider == 'gemini':
+        ai_tags_str = ai_generate(provider, key, prompt, priority='interactive')
+    elif provider == 'openai':
+        ai_tags_str = ai_generate(provider, key, prompt, model='gpt-3.5-turbo', max_tokens=100, temperature=0.7, priority='interactive')
+    else:
+        try:
+            image_path = secure_filename(str(data.get('image_path') or '')) or None
+            ai_tags_str = ai_generate(provider, key, prompt, image_path, provider_model(provider, data), priority='interactive')
+        except Exception as e:
+            ai_tags_str = ', '.join(TAGS_FALLBACK)
 
-        ai_tags = [tag.strip() for tag in ai_tags_str.split(',') if tag.strip()]
-        tags = ai_tags[:max_tags] + evergreen
-        return jsonify({'tags': tags})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    ai_tags = [tag.strip() for tag in ai_tags_str.split(',') if tag.strip()]
+    tags = ai_tags[:max_tags] + evergreen
+    return {'tags': tags}
 
 @app.route('/api/set_keys', methods=['POST'])
 def set_keys():
@@ -1075,7 +2307,7 @@ def get_product_details():
         return jsonify({'error': 'API key required'}), 401
     headers = {'Authorization': f'Bearer {api_key}'}
     try:
-        response = requests.get(f'https://api.printify.com/v1/shops/{store_id}/products/{product_id}.json', headers=headers)
+        response = requests.get(f'{PRINTIFY_API}/shops/{store_id}/products/{product_id}.json', headers=headers)
         if response.status_code == 200:
             product = response.json()
             return jsonify({
@@ -1109,8 +2341,162 @@ def get_ollama_models():
     except Exception as e:
         return jsonify({'error': 'An unexpected error occurred.'}), 500
 
+# On-demand sampling profiler for live jobs. A background thread samples every
+# thread's stack at a fixed interval (no tracing hooks, so jobs run at full
+# speed) and aggregates them into collapsed stacks for flamegraph.pl/speedscope.
+# The admin endpoints are disabled unless ADMIN_TOKEN is set. With JOB_DB, profiles
+# are requested through the job database and sampled by the queue workers that
+# run the job, and their stacks are stored there for any web worker to serve.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_INTERVAL = 0.01  # seconds between samples
+PROFILE_MAX_SECONDS = 600
+profiles = collections.OrderedDict()  # profile id -> SamplingProfiler, most recent last
+profiles_lock = threading.Lock()
+
+class SamplingProfiler:
+    """Samples all thread stacks for a window of seconds or until a job stops working."""
+
+    def __init__(self, seconds=None, job_id=None, interval=PROFILE_INTERVAL, memory=False):
+        self.seconds = min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        self.job_id = job_id
+        self.interval = interval
+        self.memory = memory
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.allocations = None
+        self.running = True
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='profiler')
+        self.thread.start()
+
+    def job_running(self):
+        if job_queue and self.job_id != progress.get('job_id'):
+            return job_queue.progress(self.job_id)['status'] == 'working'
+        return progress.get('job_id') == self.job_id and progress['status'] == 'working'
+
+    def run(self):
+        import sys
+        import tracemalloc
+
+        started_tracing = self.memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(10)
+        own = threading.get_ident()
+        end = time.monotonic() + self.seconds
+        try:
+            while not self.stop_event.wait(self.interval) and time.monotonic() < end:
+                if self.job_id and not self.job_running():
+                    break
+                # Strip pool indexes so e.g. all ai-call_N threads aggregate together
+                names = {thread.ident: re.sub(r'[-_]\d+$', '', thread.name) for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                        frame = frame.f_back
+                    stack.append(names.get(ident, 'thread'))
+                    self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+            if self.memory:
+                statistics = tracemalloc.take_snapshot().statistics('lineno')[:25]
+                self.allocations = [{'site': str(stat.traceback[0]), 'size_kb': round(stat.size / 1024, 1), 'count': stat.count}
+                                    for stat in statistics]
+        finally:
+            if started_tracing:
+                tracemalloc.stop()
+            self.running = False
+
+    def collapsed(self):
+        stacks = dict(self.stacks)  # copy first: the sampling thread may still be adding stacks
+        return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items(), key=lambda item: -item[1]))
+
+def admin_authorized():
+    token = request.headers.get('X-Admin-Token') or request.args.get('token')
+    return bool(ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, ADMIN_TOKEN)
+
+@app.route('/api/admin/profile', methods=['POST'])
+def start_profile():
+    """Start sampling for `seconds` or for as long as `job_id` is running; returns the profile id."""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    data = request.get_json(silent=True) or {}
+    if not data.get('seconds') and not data.get('job_id'):
+        return jsonify({'error': 'seconds or job_id required'}), 400
+    seconds = min(float(data.get('seconds') or 0) or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+    options = {'interval': float(data.get('interval') or PROFILE_INTERVAL), 'memory': bool(data.get('memory'))}
+    profile_id = uuid.uuid4().hex[:12]
+    if job_queue:
+        job_queue.create_profile(profile_id, data.get('job_id'), seconds, options)
+        return jsonify({'profile_id': profile_id}), 202
+    profiler = SamplingProfiler(seconds, data.get('job_id'), options['interval'], options['memory'])
+    with profiles_lock:
+        profiles[profile_id] = profiler
+        while len(profiles) > 10:
+            profiles.popitem(last=False)
+    return jsonify({'profile_id': profile_id}), 202
+
+@app.route('/api/admin/profile/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Collapsed stacks as text/plain once the profile has finished (202 while running).
+
+    ?allocations=1 returns the tracemalloc top allocation sites as JSON instead.
+    """
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    if job_queue:
+        return shared_profile_response(profile_id)
+    profiler = profiles.get(profile_id)
+    if profiler is None:
+        return jsonify({'error': 'Unknown profile'}), 404
+    if profiler.running:
+        return jsonify({'status': 'running', 'samples': profiler.samples}), 202
+    if request.args.get('allocations'):
+        return jsonify({'samples': profiler.samples, 'allocations': profiler.allocations})
+    return app.response_class(profiler.collapsed(), mimetype='text/plain')
+
+def shared_profile_response(profile_id, stopping=False):
+    """get_profile/stop_profile for a profile kept in the job database, merging every worker's stacks."""
+    deadline = time.monotonic() + (5 if stopping else 0)  # workers save within a second of a stop
+    profile = job_queue.profile(profile_id)
+    while profile is not None and profile['running'] and time.monotonic() < deadline:
+        time.sleep(0.25)
+        profile = job_queue.profile(profile_id)
+    if profile is None:
+        return jsonify({'error': 'Unknown profile'}), 404
+    samples = sum(part['samples'] for part in profile['workers'])
+    if stopping:
+        return jsonify({'status': 'stopped' if not profile['running'] else 'stopping', 'samples': samples})
+    if profile['running']:
+        return jsonify({'status': 'running', 'samples': samples}), 202
+    if request.args.get('allocations'):
+        allocations = [dict(allocation, worker=part['worker']) for part in profile['workers'] for allocation in part['allocations'] or []]
+        return jsonify({'samples': samples, 'allocations': sorted(allocations, key=lambda allocation: -allocation['size_kb'])[:25]})
+    stacks = collections.Counter()
+    for part in profile['workers']:
+        for line in (part['stacks'] or '').splitlines():
+            stack, count = line.rsplit(' ', 1)
+            stacks[f"{part['worker']};{stack}"] += int(count)
+    return app.response_class(''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()), mimetype='text/plain')
+
+@app.route('/api/admin/profile/<profile_id>/stop', methods=['POST'])
+def stop_profile(profile_id):
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    if job_queue:
+        job_queue.stop_profile(profile_id)
+        return shared_profile_response(profile_id, stopping=True)
+    profiler = profiles.get(profile_id)
+    if profiler is None:
+        return jsonify({'error': 'Unknown profile'}), 404
+    profiler.stop_event.set()
+    profiler.thread.join()
+    return jsonify({'status': 'stopped', 'samples': profiler.samples})
+
 if __name__ == '__main__':
     if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
         print("🎬 BHTools Bulk POD Product Uploader")
         print("Starting server at http://127.0.0.1:5000/")
-    app.run(debug=True)
+    app.run(debug=os.environ.get('FLASK_DEBUG', '1') == '1')
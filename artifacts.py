@@ -0,0 +1,62 @@
+"""Signed, expiring links to stored uploads, and a server that serves nothing else.
+
+With ARTIFACT_BASE_URL set, images are registered with Printify by URL and
+Printify downloads them through these links. Printify must reach the host in
+ARTIFACT_BASE_URL, but the app itself (key management, batch creation) must not
+be public. Run this server on the public address instead of exposing app.py:
+
+    ARTIFACT_SECRET=... python artifacts.py --host 0.0.0.0 --port 5002
+    ARTIFACT_SECRET=... ARTIFACT_BASE_URL=https://files.example.com python app.py
+
+It reads the same upload store as the app and answers only /artifacts/ links
+signed with ARTIFACT_SECRET, which must be set to the same value everywhere.
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import time
+
+from flask import Flask, jsonify, request, send_file
+from PIL import Image
+
+import uploadstore
+
+ARTIFACT_SECRET = os.environ.get('ARTIFACT_SECRET') or os.environ.get('FLASK_SECRET_KEY') or None
+
+def signature(secret, file_id, expires):
+    return hmac.new(secret.encode(), f'{file_id}:{expires}'.encode(), hashlib.sha256).hexdigest()
+
+def serve(store, secret, file_id):
+    """Response for GET /artifacts/<file_id>/<name>. The name is only there for Printify's file name."""
+    expires = request.args.get('expires', 0, type=int)
+    given = request.args.get('signature', '')
+    if (not secret or not store.is_id(file_id) or expires < time.time()
+            or not hmac.compare_digest(given, signature(secret, file_id, expires))):
+        return jsonify({'error': 'Invalid or expired link'}), 403
+    record = store.get(file_id)
+    if record is None or not os.path.exists(store.path(file_id)):
+        return jsonify({'error': 'File not found'}), 404
+    return send_file(store.path(file_id), mimetype=Image.MIME.get(record['format'], 'application/octet-stream'))
+
+def create_app(store, secret):
+    server = Flask(__name__)
+
+    @server.route('/artifacts/<file_id>/<name>', methods=['GET'])
+    def artifact(file_id, name):
+        return serve(store, secret, file_id)
+
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve signed links to stored uploads, and nothing else.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5002)
+    parser.add_argument('--uploads', default='uploads', help='upload folder of the app')
+    args = parser.parse_args(argv)
+    if ARTIFACT_SECRET in (None, 'your_secret_key_here'):
+        parser.error('set ARTIFACT_SECRET (or FLASK_SECRET_KEY) to the value the app signs links with')
+    create_app(uploadstore.UploadStore(args.uploads), ARTIFACT_SECRET).run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
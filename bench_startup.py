@@ -0,0 +1,63 @@
+"""Startup benchmark: cold start time and RSS of app.py for each provider configuration.
+
+Each configuration runs in a fresh interpreter that imports the app and loads the
+listed provider backends, so module caches from earlier runs don't skew results.
+
+    python bench_startup.py [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CONFIGURATIONS = {
+    'none': [],
+    'openai': ['openai'],
+    'gemini': ['gemini'],
+    'ollama': ['ollama'],
+    'all': ['openai', 'gemini', 'ollama'],
+}
+
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+app_loaded = time.perf_counter()
+for provider in sys.argv[1:]:
+    app.load_backend(provider)
+done = time.perf_counter()
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == 'darwin':
+    rss_kb //= 1024
+print(json.dumps({'import_app': app_loaded - start, 'total': done - start, 'rss_mb': rss_kb / 1024}))
+"""
+
+def run_once(providers):
+    result = subprocess.run(
+        [sys.executable, '-c', CHILD] + providers,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'config':<8} {'import app (s)':>15} {'cold start (s)':>15} {'max RSS (MB)':>13}")
+    for name, providers in CONFIGURATIONS.items():
+        try:
+            runs = [run_once(providers) for _ in range(args.runs)]
+        except subprocess.CalledProcessError as e:
+            print(f"{name:<8} failed: {e.stderr.strip().splitlines()[-1] if e.stderr.strip() else e}")
+            continue
+        import_app = statistics.median(r['import_app'] for r in runs)
+        total = statistics.median(r['total'] for r in runs)
+        rss = statistics.median(r['rss_mb'] for r in runs)
+        print(f"{name:<8} {import_app:>15.3f} {total:>15.3f} {rss:>13.1f}")
+
+if __name__ == '__main__':
+    main()
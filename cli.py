@@ -0,0 +1,218 @@
+"""Headless batch runner: create products from a CSV or JSONL manifest without the web UI.
+
+Each manifest row names an image and, optionally, the shop/template to use and
+copy overrides:
+
+    image,store_id,product_id,title,description,tags
+    designs/cat.png,123,abc,,,"cats, cute"
+
+JSONL rows use the same keys (tags may be a list). Image paths are relative to
+the manifest. The manifest is read row by row and results are written as each
+product finishes, so memory stays flat regardless of manifest size:
+
+    python cli.py manifest.csv --results results.jsonl --store-id 123 --product-id abc
+
+Add --check to validate the manifest (files, print resolution, keys, templates)
+without creating anything.
+"""
+import argparse
+import collections
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+RESULT_FIELDS = ['row', 'image', 'store_id', 'template_id', 'image_id', 'product_id', 'title', 'error', 'timings']
+
+def read_manifest(path):
+    """Yield manifest rows as dicts, one at a time."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+def row_overrides(row):
+    overrides = {}
+    if row.get('title'):
+        overrides['title'] = row['title']
+    if row.get('description'):
+        overrides['description'] = row['description']
+    tags = row.get('tags')
+    if isinstance(tags, str):
+        tags = [tag.strip() for tag in tags.split(',') if tag.strip()]
+    if tags:
+        overrides['tags'] = tags
+    return overrides
+
+class ResultWriter:
+    """Thread-safe streamed CSV or JSONL results file."""
+
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.jsonl = not path.endswith('.csv')
+        self.lock = threading.Lock()
+        if not self.jsonl:
+            self.writer = csv.DictWriter(self.file, fieldnames=RESULT_FIELDS)
+            self.writer.writeheader()
+
+    def write(self, result):
+        with self.lock:
+            if self.jsonl:
+                self.file.write(json.dumps(result) + '\n')
+            else:
+                self.writer.writerow(dict(result, timings=json.dumps(result['timings'])))
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def build_rules(args):
+    rules = {}
+    if args.rules:
+        with open(args.rules, encoding='utf-8') as f:
+            rules = json.load(f)
+    for name in ('ai_provider', 'fallback_provider', 'ollama_model', 'title_source', 'desc_source', 'tag_source',
+                 'budget', 'budget_route'):
+        if getattr(args, name) is not None:
+            rules[name] = getattr(args, name)
+    rules.setdefault('ai_provider', 'openai')
+    rules.setdefault('title_source', 'filename')
+    rules.setdefault('desc_source', 'copy')
+    rules.setdefault('tag_source', 'copy')
+
+    saved = app.load_keys()
+    rules['api_key'] = os.environ.get('PRINTIFY_API_KEY') or saved.get('printify_key')
+    rules['openai_key'] = os.environ.get('OPENAI_API_KEY') or saved.get('openai_key')
+    rules['gemini_key'] = os.environ.get('GEMINI_API_KEY') or saved.get('gemini_key')
+    rules['job_id'] = uuid.uuid4().hex[:12]
+    return rules
+
+def check(args, rules):
+    """Validate every manifest row, one report per shop/template. Returns the exit status."""
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+    batches = collections.defaultdict(list)
+    for row in read_manifest(args.manifest):
+        batches[(row.get('store_id') or args.store_id, row.get('product_id') or args.product_id)].append(
+            os.path.join(manifest_dir, row['image']))
+    ok = True
+    for (store_id, template_id), images in batches.items():
+        report, _ = app.validate_batch(images, store_id, template_id, rules)
+        ok = ok and report['ok']
+        print(f"Template {template_id} in shop {store_id}: {report['checked']} images checked in {report['seconds']}s, "
+              f"{report['failed']} with errors", file=sys.stderr)
+        for message in report['errors']:
+            print(f'  error: {message}', file=sys.stderr)
+        for message in report['warnings']:
+            print(f'  warning: {message}', file=sys.stderr)
+        for image in report['images']:
+            for message in image['errors']:
+                print(f"  error: {image['name']}: {message}", file=sys.stderr)
+            for message in image['warnings']:
+                print(f"  warning: {image['name']}: {message}", file=sys.stderr)
+    return 0 if ok else 1
+
+def run(args):
+    rules = build_rules(args)
+    if args.check:
+        return check(args, rules)
+    api_key = rules['api_key']
+    if not api_key:
+        sys.exit('Printify API key required (PRINTIFY_API_KEY or saved keys)')
+    manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+
+    # Templates are fetched once each; every template gets its own copy of the
+    # rules because the example title/description/tags live there.
+    templates = {}
+    templates_lock = threading.Lock()
+
+    def template_for(store_id, template_id):
+        with templates_lock:
+            if (store_id, template_id) not in templates:
+                example_product = app.fetch_example_product(store_id, template_id, api_key)
+                template_rules = dict(rules)
+                app.apply_example_product(template_rules, example_product)
+                templates[(store_id, template_id)] = (example_product, template_rules)
+            return templates[(store_id, template_id)]
+
+    writer = ResultWriter(args.results)
+    app.result_store.start_run(rules['job_id'], 'cli', args.store_id, args.product_id)
+    counts = {'done': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+    # Bound the rows in flight so reading never runs ahead of processing
+    in_flight = threading.BoundedSemaphore(args.workers * 2)
+    started = time.monotonic()
+
+    def process(number, row):
+        try:
+            store_id = row.get('store_id') or args.store_id
+            template_id = row.get('product_id') or args.product_id
+            image = os.path.join(manifest_dir, row['image'])
+            result = {'row': number, 'image': row['image'], 'store_id': store_id, 'template_id': template_id,
+                      'image_id': None, 'product_id': None, 'title': None, 'error': None, 'timings': {}}
+            created = {}
+            try:
+                if not store_id or not template_id:
+                    raise ValueError('No store_id/product_id for row')
+                example_product, template_rules = template_for(store_id, template_id)
+                created = app.create_single_product(image, example_product, store_id, api_key, template_rules, row_overrides(row))
+                result.update({key: created[key] for key in ('image_id', 'product_id', 'title', 'error', 'timings')})
+            except Exception as e:
+                result['error'] = str(e)
+            writer.write(result)
+            app.result_store.add(rules['job_id'], {**created, **result}, os.path.basename(row['image']))
+            with counts_lock:
+                counts['done'] += 1
+                counts['failed'] += bool(result['error'])
+                if counts['done'] % args.report_every == 0:
+                    elapsed = time.monotonic() - started
+                    print(f"{counts['done']} rows, {counts['failed']} failed, {counts['done'] / elapsed * 60:.1f}/min", file=sys.stderr)
+        finally:
+            in_flight.release()
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for number, row in enumerate(read_manifest(args.manifest), start=1):
+            in_flight.acquire()
+            pool.submit(process, number, row)
+    writer.close()
+    app.result_store.finish_run(rules['job_id'], 'completed')
+
+    elapsed = time.monotonic() - started
+    print(f"Finished {counts['done']} rows in {elapsed:.1f}s, {counts['failed']} failed. Results: {args.results} (run {rules['job_id']})", file=sys.stderr)
+    usage = app.usage_summary(rules['job_id'])
+    if usage:
+        total = usage['total']
+        print(f"AI usage: {total['calls']} calls, {total['prompt_tokens']} prompt + {total['completion_tokens']} completion tokens, "
+              f"~${total['cost']:.2f}", file=sys.stderr)
+    return 1 if counts['failed'] else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create Printify products from a CSV/JSONL manifest.')
+    parser.add_argument('manifest', help='CSV or .jsonl manifest with an image column')
+    parser.add_argument('--results', default='results.jsonl', help='results file (.jsonl or .csv)')
+    parser.add_argument('--store-id', help='default shop for rows without store_id')
+    parser.add_argument('--product-id', help='default template product for rows without product_id')
+    parser.add_argument('--rules', help='JSON file with content rules, same keys as the web UI')
+    parser.add_argument('--provider', dest='ai_provider', choices=['openai', 'gemini', 'ollama'])
+    parser.add_argument('--fallback-provider', dest='fallback_provider', choices=['openai', 'gemini', 'ollama'])
+    parser.add_argument('--ollama-model', dest='ollama_model')
+    parser.add_argument('--title-source', dest='title_source', choices=['ai', 'filename', 'copy'])
+    parser.add_argument('--desc-source', dest='desc_source', choices=['ai', 'copy'])
+    parser.add_argument('--tag-source', dest='tag_source', choices=['ai', 'copy'])
+    parser.add_argument('--budget', type=float, help='estimated AI spend in USD after which remaining rows use --budget-route')
+    parser.add_argument('--budget-route', dest='budget_route', choices=['cheaper', 'ollama'])
+    parser.add_argument('--workers', type=int, default=app.BATCH_WORKERS)
+    parser.add_argument('--report-every', type=int, default=100, help='print a progress line every N rows')
+    parser.add_argument('--check', action='store_true', help='validate the manifest without creating products')
+    return run(parser.parse_args(argv))
+
+if __name__ == '__main__':
+    sys.exit(main())
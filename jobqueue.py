@@ -0,0 +1,496 @@
+"""Durable SQLite job queue: batches survive restarts and run on any number of worker processes.
+
+With JOB_DB set, the web app only enqueues batches and reads their progress from
+the database, so it can run under a WSGI server with several workers. Worker
+processes claim one image at a time under a lease, keep the lease alive with
+heartbeats and record the result:
+
+    JOB_DB=jobs.db gunicorn -w 4 -b 127.0.0.1:5000 app:app
+    JOB_DB=jobs.db python jobqueue.py --threads 16
+
+Run as many worker processes as the provider limits allow, on one machine or
+several sharing the database file. A task whose worker dies is claimed again
+once its lease expires (up to MAX_ATTEMPTS times).
+
+The database also coordinates what the processes share: Printify requests draw
+from one token bucket per API key, AI usage and spend are tallied per job (so
+budgets hold across workers), and each worker's AI concurrency limits are its
+share of the provider maximum, divided by the number of live workers. Profiles
+requested from /api/admin/profile are sampled by the workers running the job and
+stored here, so any web worker can serve them.
+"""
+import argparse
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+LEASE_SECONDS = int(os.environ.get('JOB_LEASE', 120))
+MAX_ATTEMPTS = 3
+HEARTBEAT_SECONDS = min(10, LEASE_SECONDS / 3)
+USAGE_COLUMNS = ('calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'image_tokens', 'image_bytes', 'latency', 'cost')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    store_id TEXT,
+    example TEXT,
+    rules TEXT,
+    total INTEGER NOT NULL,
+    message TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    item TEXT NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS previews (
+    preview_id TEXT NOT NULL,
+    image TEXT NOT NULL,
+    copy TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (preview_id, image)
+);
+CREATE TABLE IF NOT EXISTS preview_tasks (
+    task_id TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS preview_tasks_fingerprint ON preview_tasks (fingerprint, status);
+CREATE TABLE IF NOT EXISTS usage (
+    job_id TEXT NOT NULL,
+    model TEXT NOT NULL,
+    calls INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    cached_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    image_tokens INTEGER NOT NULL DEFAULT 0,
+    image_bytes INTEGER NOT NULL DEFAULT 0,
+    latency REAL NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    updated REAL NOT NULL,
+    PRIMARY KEY (job_id, model)
+);
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS workers (
+    name TEXT PRIMARY KEY,
+    seen REAL NOT NULL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    id TEXT PRIMARY KEY,
+    job_id TEXT,
+    options TEXT NOT NULL,
+    deadline REAL NOT NULL,
+    stopped INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS profile_samples (
+    profile_id TEXT NOT NULL,
+    worker TEXT NOT NULL,
+    running INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+    stacks TEXT,
+    allocations TEXT,
+    PRIMARY KEY (profile_id, worker)
+);
+CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (status, lease_until);
+CREATE INDEX IF NOT EXISTS tasks_job ON tasks (job_id, status);
+"""
+
+class JobQueue:
+    """Jobs and their per-image tasks in one SQLite database (WAL mode, one connection per thread)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.db().executescript(SCHEMA)
+
+    def db(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front so two workers can't claim the same task
+        conn = self.db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def create_job(self, job_id, store_id, example_product, rules, items):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO jobs (id, status, store_id, example, rules, total, message, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (job_id, 'working', store_id, json.dumps(example_product), json.dumps(rules), len(items),
+                          f'Queued {len(items)} images', now))
+            conn.executemany('INSERT INTO tasks (job_id, item, status, updated) VALUES (?, ?, ?, ?)',
+                             ((job_id, item, 'pending', now) for item in items))
+
+    def job(self, job_id):
+        row = self.db().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(row, example=json.loads(row['example']), rules=json.loads(row['rules']))
+
+    def claim(self, worker):
+        """Lease the next pending (or abandoned) task of a running job. Returns the task row or None."""
+        now = time.time()
+        with self.transaction() as conn:
+            # Tasks whose lease ran out too often are failed rather than retried forever
+            conn.execute("UPDATE tasks SET status = 'failed', error = 'Worker lease expired', updated = ? "
+                         "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, MAX_ATTEMPTS))
+            conn.execute("UPDATE jobs SET status = 'error', message = 'Worker lease expired' WHERE status = 'working' "
+                         "AND id IN (SELECT job_id FROM tasks WHERE status = 'failed' AND error = 'Worker lease expired')")
+            task = conn.execute("SELECT tasks.* FROM tasks JOIN jobs ON jobs.id = tasks.job_id "
+                                "WHERE jobs.status = 'working' AND (tasks.status = 'pending' "
+                                "OR (tasks.status = 'leased' AND tasks.lease_until < ?)) "
+                                "ORDER BY tasks.id LIMIT 1", (now,)).fetchone()
+            if task is None:
+                return None
+            conn.execute("UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? "
+                         "WHERE id = ?", (worker, now + LEASE_SECONDS, now, task['id']))
+        return task
+
+    def heartbeat(self, worker, task_ids):
+        """Extend the leases this worker still holds."""
+        if not task_ids:
+            return
+        placeholders = ','.join('?' * len(task_ids))
+        with self.transaction() as conn:
+            conn.execute(f"UPDATE tasks SET lease_until = ? WHERE worker = ? AND status = 'leased' AND id IN ({placeholders})",
+                         (time.time() + LEASE_SECONDS, worker, *task_ids))
+
+    def complete(self, task, worker, result):
+        """Record a task's result. The first failed image stops its job, as with in-process batches.
+
+        Returns False if the lease was lost and the result discarded.
+        """
+        now = time.time()
+        error = result.get('error')
+        with self.transaction() as conn:
+            updated = conn.execute("UPDATE tasks SET status = ?, result = ?, error = ?, lease_until = NULL, updated = ? "
+                                   "WHERE id = ? AND worker = ? AND status = 'leased'",
+                                   ('failed' if error else 'done', json.dumps(result), error, now, task['id'], worker)).rowcount
+            if not updated:
+                return False  # lease was lost and the task handed to another worker
+            if error:
+                conn.execute("UPDATE jobs SET status = 'error', message = ? WHERE id = ? AND status = 'working'",
+                             (error, task['job_id']))
+                return True
+            conn.execute("UPDATE jobs SET message = ? WHERE id = ? AND status = 'working'",
+                         (f"Created product for {task['item']}", task['job_id']))
+            remaining = conn.execute("SELECT COUNT(*) FROM tasks WHERE job_id = ? AND status IN ('pending', 'leased')",
+                                     (task['job_id'],)).fetchone()[0]
+            if not remaining:
+                conn.execute("UPDATE jobs SET status = 'completed', message = 'All products created successfully!' "
+                             "WHERE id = ? AND status = 'working'", (task['job_id'],))
+        return True
+
+    def cancel(self, job_id):
+        with self.transaction() as conn:
+            conn.execute("UPDATE jobs SET status = 'cancelled', message = 'Operation cancelled' WHERE id = ? AND status = 'working'",
+                         (job_id,))
+
+    def save_preview(self, preview_id, image, copy):
+        """Store the reviewed copy of one image of a bulk preview (see /api/bulk_preview)."""
+        with self.transaction() as conn:
+            conn.execute('INSERT OR REPLACE INTO previews (preview_id, image, copy, created) VALUES (?, ?, ?, ?)',
+                         (preview_id, image, json.dumps(copy), time.time()))
+
+    def load_preview(self, preview_id):
+        rows = self.db().execute('SELECT image, copy FROM previews WHERE preview_id = ?', (preview_id,)).fetchall()
+        return {row['image']: json.loads(row['copy']) for row in rows}
+
+    def create_preview_task(self, task_id, fingerprint, ttl, stale_after):
+        """Start a preview task, or join a pending identical one (same fingerprint) started by any process.
+
+        Returns (task_id, coalesced). Pending tasks older than stale_after seconds are assumed
+        lost with their process and never joined; finished tasks are dropped after ttl.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM preview_tasks WHERE created < ?', (now - ttl,))
+            row = conn.execute("SELECT task_id FROM preview_tasks WHERE fingerprint = ? AND status = 'pending' AND created > ?",
+                               (fingerprint, now - stale_after)).fetchone()
+            if row:
+                return row['task_id'], True
+            conn.execute("INSERT INTO preview_tasks (task_id, fingerprint, status, created) VALUES (?, ?, 'pending', ?)",
+                         (task_id, fingerprint, now))
+        return task_id, False
+
+    def finish_preview_task(self, task_id, result=None, error=None):
+        self.db().execute('UPDATE preview_tasks SET status = ?, result = ?, error = ? WHERE task_id = ?',
+                          ('error' if error else 'done', json.dumps(result), error, task_id))
+
+    def preview_task(self, task_id):
+        row = self.db().execute('SELECT * FROM preview_tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(row, result=json.loads(row['result'] or 'null'))
+
+    def unpublished(self, job_id):
+        """Ids of products a job created but failed to publish."""
+        rows = self.db().execute("SELECT json_extract(result, '$.product_id') FROM tasks "
+                                 "WHERE job_id = ? AND json_extract(result, '$.published') = 0", (job_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def set_published(self, job_id, product_id, published, error=None, attempts=0):
+        """Record a publish retry of one of a job's products: published is True, False or 'pending'."""
+        self.db().execute("UPDATE tasks SET result = json_set(result, '$.published', json(?), '$.publish_error', ?, "
+                          "'$.publish_attempts', COALESCE(json_extract(result, '$.publish_attempts'), 0) + ?) "
+                          "WHERE job_id = ? AND json_extract(result, '$.product_id') = ?",
+                          (json.dumps(published), error, attempts, job_id, product_id))
+
+    def publish_records(self, job_id, status=None):
+        """Publish state of each product a job created, shaped like app.publish_results records."""
+        rows = self.db().execute("SELECT item, json_extract(result, '$.product_id'), json_extract(result, '$.published'), "
+                                 "json_extract(result, '$.publish_error'), json_extract(result, '$.publish_attempts') FROM tasks "
+                                 "WHERE job_id = ? AND json_extract(result, '$.published') IS NOT NULL ORDER BY id", (job_id,))
+        records = [{'product_id': product_id, 'image': item, 'error': error, 'attempts': attempts or 0,
+                    'status': {1: 'published', 0: 'failed'}.get(published, 'pending')}
+                   for item, product_id, published, error, attempts in rows]
+        return [record for record in records if not status or record['status'] == status]
+
+    def status(self, job_id):
+        row = self.db().execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return row['status'] if row else None
+
+    def add_usage(self, job_id, model, totals):
+        """Add one AI call's usage (keys of USAGE_COLUMNS) to a job's running totals."""
+        columns = ', '.join(USAGE_COLUMNS)
+        updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in USAGE_COLUMNS)
+        self.db().execute(f'INSERT INTO usage (job_id, model, {columns}, updated) VALUES (?, ?, {", ".join("?" * len(USAGE_COLUMNS))}, ?) '
+                          f'ON CONFLICT (job_id, model) DO UPDATE SET {updates}, updated = excluded.updated',
+                          (job_id, model, *(totals[column] for column in USAGE_COLUMNS), time.time()))
+
+    def usage(self, job_id):
+        """{model: totals} for one job, across every process that worked on it."""
+        rows = self.db().execute(f"SELECT model, {', '.join(USAGE_COLUMNS)} FROM usage WHERE job_id = ?", (job_id,)).fetchall()
+        return {row['model']: {column: row[column] for column in USAGE_COLUMNS} for row in rows}
+
+    def usage_jobs(self, limit=50):
+        rows = self.db().execute('SELECT job_id FROM usage GROUP BY job_id ORDER BY MAX(updated) DESC LIMIT ?', (limit,)).fetchall()
+        return [row['job_id'] for row in rows]
+
+    def take_token(self, name, rate, burst):
+        """Take a token from a token bucket shared by every process. Returns 0, or seconds to wait before trying again.
+
+        rate is tokens per second; the bucket starts full.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (name,)).fetchone()
+            tokens = burst if row is None else min(burst, row['tokens'] + (now - row['updated']) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)', (name, tokens, now))
+        return wait
+
+    def register_worker(self, worker, status=None):
+        """Mark a worker process alive, with its limiter and breaker snapshot for /api/progress."""
+        self.db().execute('INSERT OR REPLACE INTO workers (name, seen, status) VALUES (?, ?, ?)',
+                          (worker, time.time(), json.dumps(status)))
+
+    def live_workers(self):
+        """Worker processes seen within the last lease period: {name: status}."""
+        rows = self.db().execute('SELECT name, status FROM workers WHERE seen > ?', (time.time() - LEASE_SECONDS,)).fetchall()
+        return {row['name']: json.loads(row['status'] or 'null') for row in rows}
+
+    def create_profile(self, profile_id, job_id, seconds, options, keep=10):
+        """Ask the workers to sample their processes (those running job_id, if given) for up to seconds."""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('INSERT INTO profiles (id, job_id, options, deadline, created) VALUES (?, ?, ?, ?, ?)',
+                         (profile_id, job_id, json.dumps(options), now + seconds, now))
+            old = [row[0] for row in conn.execute('SELECT id FROM profiles ORDER BY created DESC LIMIT -1 OFFSET ?', (keep,))]
+            for old_id in old:
+                conn.execute('DELETE FROM profile_samples WHERE profile_id = ?', (old_id,))
+                conn.execute('DELETE FROM profiles WHERE id = ?', (old_id,))
+
+    def active_profiles(self):
+        rows = self.db().execute('SELECT * FROM profiles WHERE stopped = 0 AND deadline > ?', (time.time(),)).fetchall()
+        return [dict(row, options=json.loads(row['options'])) for row in rows]
+
+    def stop_profile(self, profile_id):
+        self.db().execute('UPDATE profiles SET stopped = 1 WHERE id = ?', (profile_id,))
+
+    def save_profile_samples(self, profile_id, worker, running, samples, stacks, allocations=None):
+        """Store one worker's collapsed stacks for a profile (replacing its previous save)."""
+        self.db().execute('INSERT OR REPLACE INTO profile_samples (profile_id, worker, running, samples, stacks, allocations) '
+                          'VALUES (?, ?, ?, ?, ?, ?)', (profile_id, worker, int(running), samples, stacks, json.dumps(allocations)))
+
+    def profile(self, profile_id):
+        """A profile with each worker's samples, or None. running is true until every live sampling worker has finished."""
+        row = self.db().execute('SELECT * FROM profiles WHERE id = ?', (profile_id,)).fetchone()
+        if row is None:
+            return None
+        live = self.live_workers()
+        parts = [dict(part, allocations=json.loads(part['allocations'] or 'null')) for part in
+                 self.db().execute('SELECT * FROM profile_samples WHERE profile_id = ?', (profile_id,)).fetchall()]
+        ended = row['stopped'] or row['deadline'] <= time.time() or (row['job_id'] and self.status(row['job_id']) != 'working')
+        running = not ended or any(part['running'] and part['worker'] in live for part in parts)
+        return dict(row, options=json.loads(row['options']), running=bool(running), workers=parts)
+
+    def latest_job_id(self):
+        row = self.db().execute('SELECT id FROM jobs ORDER BY created DESC LIMIT 1').fetchone()
+        return row['id'] if row else None
+
+    def progress(self, job_id=None):
+        """Progress of a job (the latest one by default) in the same shape as app.progress."""
+        job_id = job_id or self.latest_job_id()
+        job = self.db().execute('SELECT id, status, total, message, created FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return {'status': 'idle', 'current': 0, 'total': 0, 'message': ''}
+        counts = dict(self.db().execute('SELECT status, COUNT(*) FROM tasks WHERE job_id = ? GROUP BY status', (job_id,)).fetchall())
+        published, publish_failed, publishing = self.db().execute(
+            "SELECT COUNT(*) FILTER (WHERE json_extract(result, '$.published') = 1), "
+            "COUNT(*) FILTER (WHERE json_extract(result, '$.published') = 0), "
+            "COUNT(*) FILTER (WHERE json_extract(result, '$.published') = 'pending') FROM tasks WHERE job_id = ?", (job_id,)).fetchone()
+        status, message = job['status'], job['message']
+        if publishing and status == 'completed':
+            status, message = 'working', f'Publishing {publishing} products...'  # a retry from /api/publish
+        return {'status': status, 'current': counts.get('done', 0), 'total': job['total'], 'message': message,
+                'job_id': job['id'], 'started': job['created'], 'mode': 'create', 'failed': counts.get('failed', 0),
+                'queued': counts.get('pending', 0), 'in_progress': counts.get('leased', 0),
+                'published': published, 'publish_failed': publish_failed}
+
+def run_worker(queue, threads, poll=1.0):
+    """Claim and process tasks on several threads until interrupted."""
+    import app
+
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    held = set()
+    held_lock = threading.Lock()
+    jobs = {}  # job id -> (example product, rules), shared by this process's threads
+    jobs_lock = threading.Lock()
+
+    def register():
+        # Every worker's AI limits are its share of the provider maximums
+        app.share_ai_limits(max(1, len(queue.live_workers())))
+        queue.register_worker(worker, {'ai_limits': app.limiter_snapshot(), 'ai_breakers': app.breaker_snapshot()})
+
+    def heartbeat():
+        while True:
+            time.sleep(HEARTBEAT_SECONDS)
+            with held_lock:
+                task_ids = list(held)
+            try:
+                queue.heartbeat(worker, task_ids)
+                register()
+            except sqlite3.Error as e:
+                print(f'Heartbeat failed: {e}', file=sys.stderr)
+
+    def sample_profiles():
+        """Run the profiles requested through the database on this process, saving samples every second."""
+        sampling = {}  # profile id -> app.SamplingProfiler
+        finished = set()
+        while True:
+            time.sleep(1)
+            try:
+                active = {profile['id']: profile for profile in queue.active_profiles()}
+                with jobs_lock:
+                    known_jobs = set(jobs)
+                for profile_id, profile in active.items():
+                    if profile_id not in sampling and profile_id not in finished and (not profile['job_id'] or profile['job_id'] in known_jobs):
+                        options = profile['options']
+                        sampling[profile_id] = app.SamplingProfiler(profile['deadline'] - time.time(), profile['job_id'],
+                                                                    options['interval'], options['memory'])
+                for profile_id, profiler in list(sampling.items()):
+                    if profile_id not in active:
+                        profiler.stop_event.set()
+                        profiler.thread.join()
+                    running = profiler.running
+                    queue.save_profile_samples(profile_id, worker, running, profiler.samples, profiler.collapsed(), profiler.allocations)
+                    if not running:
+                        del sampling[profile_id]
+                        finished.add(profile_id)
+            except sqlite3.Error as e:
+                print(f'Profile update failed: {e}', file=sys.stderr)
+
+    def job_for(job_id):
+        with jobs_lock:
+            if job_id not in jobs:
+                job = queue.job(job_id)
+                jobs[job_id] = (job['store_id'], job['example'], job['rules'])
+            return jobs[job_id]
+
+    def loop():
+        while True:
+            task = queue.claim(worker)
+            if task is None:
+                time.sleep(poll)
+                continue
+            with held_lock:
+                held.add(task['id'])
+            try:
+                store_id, example_product, rules = job_for(task['job_id'])
+                result = app.create_single_product(task['item'], example_product, store_id, rules['api_key'], rules,
+                                                   rules.get('copy_overrides', {}).get(task['item']))
+                if rules.get('publish') and result.get('product_id'):
+                    # A failed publish is recorded but doesn't fail the task; retry it via /api/publish
+                    result['published'], result['publish_error'], result['publish_attempts'] = app.publish_product(
+                        store_id, result['product_id'], rules['api_key'])
+            except Exception as e:
+                result = {'image': task['item'], 'error': str(e)}
+            if queue.complete(task, worker, result):
+                app.result_store.add(task['job_id'], result, app.image_name(task['item']))
+                status = queue.status(task['job_id'])
+                if status != 'working':
+                    app.result_store.finish_run(task['job_id'], status)
+            with held_lock:
+                held.discard(task['id'])
+
+    queue.register_worker(worker)
+    register()
+    threading.Thread(target=heartbeat, daemon=True).start()
+    threading.Thread(target=sample_profiles, daemon=True, name='profiles').start()
+    for number in range(threads):
+        threading.Thread(target=loop, daemon=True, name=f'task-{number}').start()
+    print(f'Worker {worker} processing jobs from {queue.path} on {threads} threads', file=sys.stderr)
+    while True:
+        time.sleep(60)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Process queued product-creation jobs.')
+    parser.add_argument('--db', default=os.environ.get('JOB_DB', 'jobs.db'), help='queue database (JOB_DB)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('BATCH_WORKERS', 16)))
+    args = parser.parse_args(argv)
+    try:
+        run_worker(JobQueue(args.db), args.threads)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
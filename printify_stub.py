@@ -0,0 +1,155 @@
+"""Local stand-in for the parts of the Printify API this app uses, for testing without a shop.
+
+    python printify_stub.py --port 5001
+    ARTIFACT_SECRET=change-me python artifacts.py --port 5002
+    PRINTIFY_API=http://127.0.0.1:5001/v1 ARTIFACT_SECRET=change-me ARTIFACT_BASE_URL=http://127.0.0.1:5002 python app.py
+
+Any API key is accepted. The stub has one shop with one template product, keeps
+created products in memory, and fetches images registered by URL just as Printify
+does, so signed artifact links are exercised end to end. GET /stats reports how
+many images arrived inline (base64) and by URL, and the request bytes of each.
+"""
+import argparse
+import base64
+import binascii
+import io
+import itertools
+import threading
+import time
+
+import requests
+from flask import Flask, jsonify, request, send_file
+from PIL import Image
+
+SHOP_ID = 1
+PRINT_AREA = (4500, 5400)  # front placeholder size in pixels
+TEMPLATE = {
+    'id': 'template', 'title': 'Stub Template', 'description': '<p>Template description</p>', 'tags': ['stub'],
+    'blueprint_id': 6, 'print_provider_id': 99, 'visible': False,
+    'variants': [{'id': 12100, 'price': 2000, 'is_enabled': True}],
+    'print_areas': [{'variant_ids': [12100], 'placeholders': [{'position': 'front', 'images': []}]}],
+    'images': [],
+}
+
+stub = Flask(__name__)
+lock = threading.Lock()
+ids = itertools.count(1)
+products = {TEMPLATE['id']: dict(TEMPLATE)}
+uploads = {}  # id -> (metadata, bytes)
+stats = {'inline': 0, 'inline_bytes': 0, 'url': 0, 'url_bytes': 0, 'fetch_failed': 0}
+
+def error(message, status=400):
+    return jsonify({'status': 'error', 'code': status, 'message': message}), status
+
+@stub.before_request
+def require_key():
+    if request.path.startswith('/v1/') and not request.headers.get('Authorization', '').startswith('Bearer '):
+        return error('Unauthenticated', 401)
+
+@stub.route('/v1/shops.json')
+def shops():
+    return jsonify([{'id': SHOP_ID, 'title': 'Stub Shop', 'sales_channel': 'custom_integration'}])
+
+@stub.route('/v1/shops/<int:shop_id>/products.json', methods=['GET'])
+def list_products(shop_id):
+    page = request.args.get('page', 1, type=int)
+    limit = request.args.get('limit', 10, type=int)
+    with lock:
+        items = list(products.values())
+    return jsonify({'data': items[(page - 1) * limit:page * limit], 'current_page': page,
+                    'last_page': max(1, -(-len(items) // limit)), 'total': len(items)})
+
+@stub.route('/v1/shops/<int:shop_id>/products.json', methods=['POST'])
+def create_product(shop_id):
+    data = request.get_json()
+    for area in data.get('print_areas', []):
+        for placeholder in area.get('placeholders', []):
+            for image in placeholder.get('images', []):
+                if image['id'] not in uploads:
+                    return error(f"Unknown image {image['id']}")
+    product_id = f'stub-{next(ids)}'
+    with lock:
+        products[product_id] = dict(data, id=product_id, visible=False, images=[])
+    return jsonify(products[product_id])
+
+@stub.route('/v1/shops/<int:shop_id>/products/<product_id>.json', methods=['GET', 'PUT'])
+def product(shop_id, product_id):
+    with lock:
+        if product_id not in products:
+            return error('Product not found', 404)
+        if request.method == 'PUT':
+            products[product_id].update(request.get_json())
+        return jsonify(products[product_id])
+
+@stub.route('/v1/shops/<int:shop_id>/products/<product_id>/publish.json', methods=['POST'])
+def publish(shop_id, product_id):
+    with lock:
+        if product_id not in products:
+            return error('Product not found', 404)
+        products[product_id]['visible'] = True
+    return jsonify({})
+
+@stub.route('/v1/catalog/blueprints/<int:blueprint_id>/print_providers/<int:provider_id>/variants.json')
+def catalog_variants(blueprint_id, provider_id):
+    return jsonify({'id': blueprint_id, 'title': 'Stub Blueprint', 'variants': [
+        {'id': variant['id'], 'title': 'One size', 'options': {}, 'placeholders': [{'position': 'front', 'width': PRINT_AREA[0], 'height': PRINT_AREA[1]}]}
+        for variant in TEMPLATE['variants']]})
+
+@stub.route('/v1/uploads/images.json', methods=['POST'])
+def upload_image():
+    data = request.get_json()
+    if data.get('url'):
+        # Printify downloads the file itself; an expired or forged link fails the upload
+        try:
+            response = requests.get(data['url'], timeout=30)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            with lock:
+                stats['fetch_failed'] += 1
+            return error(f'Could not fetch {data["url"]}: {e}')
+        content, mode = response.content, 'url'
+    else:
+        try:
+            content, mode = base64.b64decode(data.get('contents', ''), validate=True), 'inline'
+        except binascii.Error:
+            return error('Invalid base64 contents')
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            width, height, mime_type = image.width, image.height, Image.MIME.get(image.format)
+    except OSError:
+        return error('Not an image')
+    upload_id = f'img-{next(ids)}'
+    metadata = {'id': upload_id, 'file_name': data.get('file_name'), 'height': height, 'width': width, 'size': len(content),
+                'mime_type': mime_type, 'preview_url': f'{request.host_url}files/{upload_id}', 'upload_time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    with lock:
+        uploads[upload_id] = (metadata, content)
+        stats[mode] += 1
+        stats[f'{mode}_bytes'] += request.content_length or 0
+    return jsonify(metadata)
+
+@stub.route('/v1/uploads/<upload_id>.json')
+def get_upload(upload_id):
+    if upload_id not in uploads:
+        return error('Upload not found', 404)
+    return jsonify(uploads[upload_id][0])
+
+@stub.route('/files/<upload_id>')
+def upload_file(upload_id):
+    if upload_id not in uploads:
+        return error('Upload not found', 404)
+    metadata, content = uploads[upload_id]
+    return send_file(io.BytesIO(content), mimetype=metadata['mime_type'])
+
+@stub.route('/stats')
+def get_stats():
+    return jsonify(dict(stats, products=len(products) - 1, uploads=len(uploads)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Printify API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args(argv)
+    stub.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
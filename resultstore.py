@@ -0,0 +1,176 @@
+"""Persistent history of creation runs: one row per image with what was created from it.
+
+Every batch (web UI, queued, cli.py or watch.py) is recorded in RESULTS_DB (default
+results.db) as a run plus one result per image: the Printify upload and product
+ids, the generated copy, stage timings, publish state and any error. Runs and
+results are read a page at a time and exported as a stream, so runs of tens of
+thousands of products can be audited without loading them into memory:
+
+    GET /api/history                      runs, newest first
+    GET /api/history/<job_id>             a run's results, in order
+    GET /api/history/<job_id>/export?format=csv
+    python resultstore.py <job_id> --format jsonl > results.jsonl
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    job_id TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    store_id TEXT,
+    template_id TEXT,
+    total INTEGER,
+    status TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    image TEXT NOT NULL,
+    name TEXT,
+    image_id TEXT,
+    product_id TEXT,
+    title TEXT,
+    description TEXT,
+    tags TEXT,
+    timings TEXT,
+    error TEXT,
+    published INTEGER,
+    publish_error TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started, job_id);
+CREATE INDEX IF NOT EXISTS results_job ON results (job_id, id);
+CREATE INDEX IF NOT EXISTS results_product ON results (product_id);
+"""
+EXPORT_FIELDS = ['job_id', 'image', 'name', 'image_id', 'product_id', 'title', 'description', 'tags', 'timings',
+                 'error', 'published', 'publish_error', 'created']
+
+class ResultStore:
+    """Runs and their per-image results in one SQLite database (WAL mode, one connection per thread)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.db().executescript(SCHEMA)
+
+    def db(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def start_run(self, job_id, source, store_id=None, template_id=None, total=None):
+        self.db().execute('INSERT OR IGNORE INTO runs (job_id, source, store_id, template_id, total, status, started) '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?)', (job_id, source, store_id, template_id, total, 'working', time.time()))
+
+    def finish_run(self, job_id, status):
+        self.db().execute("UPDATE runs SET status = ?, finished = ? WHERE job_id = ? AND status = 'working'",
+                          (status, time.time(), job_id))
+
+    def add(self, job_id, result, name=None):
+        """Record the result dict of one create_single_product call."""
+        published = result.get('published')
+        self.db().execute('INSERT INTO results (job_id, image, name, image_id, product_id, title, description, tags, timings, '
+                          'error, published, publish_error, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                          (job_id, str(result.get('image')), name, result.get('image_id'), result.get('product_id'),
+                           result.get('title'), result.get('description'), json.dumps(result.get('tags')),
+                           json.dumps(result.get('timings', {})), result.get('error'),
+                           None if published is None else int(published), result.get('publish_error'), time.time()))
+
+    def mark_published(self, product_id, published, error=None):
+        self.db().execute('UPDATE results SET published = ?, publish_error = ? WHERE product_id = ?',
+                          (int(published), error, product_id))
+
+    def runs(self, limit=50, cursor=None):
+        """One page of runs, newest first, with created/failed counts. cursor is the previous page's next_cursor."""
+        query = 'SELECT * FROM runs'
+        params = []
+        if cursor:
+            started, job_id = cursor.split(':', 1)
+            query += ' WHERE (started, job_id) < (?, ?)'
+            params += [float(started), job_id]
+        query += ' ORDER BY started DESC, job_id DESC LIMIT ?'
+        params.append(limit)
+        items = [dict(row, created=0, failed=0) for row in self.db().execute(query, params).fetchall()]
+        # Count results only for this page's runs, through the per-run index
+        by_id = {item['job_id']: item for item in items}
+        counts = self.db().execute(
+            'SELECT job_id, COUNT(*) FILTER (WHERE error IS NULL), COUNT(*) FILTER (WHERE error IS NOT NULL) '
+            f'FROM results WHERE job_id IN ({", ".join("?" * len(by_id))}) GROUP BY job_id', list(by_id)).fetchall() if by_id else []
+        for job_id, created, failed in counts:
+            by_id[job_id].update(created=created, failed=failed)
+        next_cursor = f"{items[-1]['started']!r}:{items[-1]['job_id']}" if len(items) == limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+
+    def run(self, job_id):
+        row = self.db().execute('SELECT * FROM runs WHERE job_id = ?', (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def iter_results(self, job_id, after=0, limit=None, status=None):
+        """Results of a run in order, read lazily. status is 'created' or 'failed' to filter."""
+        query = 'SELECT * FROM results WHERE job_id = ? AND id > ?'
+        if status == 'created':
+            query += ' AND error IS NULL'
+        elif status == 'failed':
+            query += ' AND error IS NOT NULL'
+        query += ' ORDER BY id'
+        params = [job_id, after]
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        for row in self.db().execute(query, params):
+            yield dict(row, tags=json.loads(row['tags'] or 'null'), timings=json.loads(row['timings'] or '{}'))
+
+    def results(self, job_id, limit=100, after=0, status=None):
+        """One page of a run's results. after is the previous page's next_after."""
+        items = list(self.iter_results(job_id, after, limit, status))
+        return {'items': items, 'next_after': items[-1]['id'] if len(items) == limit else None}
+
+    def export(self, job_id, format='jsonl', status=None):
+        """Yield a run's results as CSV or JSONL text, a row at a time."""
+        if format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for row in self.iter_results(job_id, status=status):
+                writer.writerow(dict(row, tags=', '.join(row['tags'] or []), timings=json.dumps(row['timings'])))
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            yield buffer.getvalue()
+            return
+        for row in self.iter_results(job_id, status=status):
+            yield json.dumps({field: row[field] for field in EXPORT_FIELDS}) + '\n'
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the results of a run, or list recent runs.')
+    parser.add_argument('job_id', nargs='?', help='run to export (omit to list runs)')
+    parser.add_argument('--db', default=os.environ.get('RESULTS_DB', 'results.db'), help='results database (RESULTS_DB)')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--status', choices=['created', 'failed'], help='only export created or failed images')
+    args = parser.parse_args(argv)
+    store = ResultStore(args.db)
+    if not args.job_id:
+        for run in store.runs(limit=20)['items']:
+            print(f"{run['job_id']}  {time.strftime('%Y-%m-%d %H:%M', time.localtime(run['started']))}  {run['source']:<5} "
+                  f"{run['status']:<10} {run['created']} created, {run['failed']} failed")
+        return
+    for chunk in store.export(args.job_id, args.format, args.status):
+        sys.stdout.write(chunk)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Content-addressed upload store with a SQLite metadata index.
+
+Uploaded images are stored once per content under uploads/objects/<2>/<2>/<sha256>
+and referred to by their SHA-256 hash, so files with the same name never overwrite
+each other and re-uploading a file costs nothing. The index (uploads/index.db)
+keeps each image's original name, size, dimensions, format, upload time and
+whether a product has been created from it.
+
+Files uploaded before the store existed live directly in uploads/ and are still
+found by name. To move them into the store:
+
+    python uploadstore.py --import-legacy
+"""
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    sha256 TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    uploaded REAL NOT NULL,
+    processed INTEGER NOT NULL DEFAULT 0,
+    product_id TEXT
+);
+CREATE INDEX IF NOT EXISTS files_uploaded ON files (uploaded, sha256);
+"""
+ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+class UploadStore:
+    """Sharded content-addressed image files plus their metadata index."""
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        self.local = threading.local()
+        self.db().executescript(SCHEMA)
+
+    def db(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.root, 'index.db'), timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def is_id(value):
+        return bool(ID_PATTERN.match(str(value)))
+
+    def path(self, file_id):
+        """Location of a stored file, computed from its hash without touching the index."""
+        return os.path.join(self.objects, file_id[:2], file_id[2:4], file_id)
+
+    def save(self, stream, name):
+        """Store an uploaded file, returning its metadata. Content already stored is not written again."""
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.objects)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(1 << 20), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+            file_id = digest.hexdigest()
+            existing = self.get(file_id)
+            if existing and os.path.exists(self.path(file_id)):
+                return dict(existing, duplicate=True)
+            try:
+                with Image.open(temp_path) as image:
+                    width, height = image.size
+                    image_format = image.format
+            except OSError:
+                raise ValueError(f'{name} is not a readable image') from None
+            os.makedirs(os.path.dirname(self.path(file_id)), exist_ok=True)
+            os.replace(temp_path, self.path(file_id))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        record = {'sha256': file_id, 'name': name, 'size': os.path.getsize(self.path(file_id)), 'width': width,
+                  'height': height, 'format': image_format, 'uploaded': time.time(), 'processed': 0, 'product_id': None}
+        self.db().execute('INSERT OR IGNORE INTO files (sha256, name, size, width, height, format, uploaded) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (file_id, name, record['size'], width, height, image_format, record['uploaded']))
+        return dict(self.get(file_id), duplicate=False)
+
+    def get(self, file_id):
+        row = self.db().execute('SELECT * FROM files WHERE sha256 = ?', (file_id,)).fetchone()
+        return dict(row) if row else None
+
+    def name(self, file_id):
+        row = self.db().execute('SELECT name FROM files WHERE sha256 = ?', (file_id,)).fetchone()
+        return row['name'] if row else None
+
+    def delete(self, file_id):
+        """Remove a stored file and its index entry. Returns False if it wasn't stored."""
+        deleted = self.db().execute('DELETE FROM files WHERE sha256 = ?', (file_id,)).rowcount
+        if os.path.exists(self.path(file_id)):
+            os.remove(self.path(file_id))
+            return True
+        return bool(deleted)
+
+    def mark_processed(self, file_id, product_id):
+        self.db().execute('UPDATE files SET processed = 1, product_id = ? WHERE sha256 = ?', (product_id, file_id))
+
+    def listing(self, limit=50, cursor=None, processed=None):
+        """One page of files, newest first. cursor is the next_cursor of the previous page."""
+        query = 'SELECT * FROM files WHERE 1 = 1'
+        params = []
+        if processed is not None:
+            query += ' AND processed = ?'
+            params.append(int(processed))
+        if cursor:
+            # Keyset pagination: cheap at any depth, unlike OFFSET
+            uploaded, file_id = cursor.split(':', 1)
+            query += ' AND (uploaded, sha256) < (?, ?)'
+            params += [float(uploaded), file_id]
+        query += ' ORDER BY uploaded DESC, sha256 DESC LIMIT ?'
+        params.append(limit)
+        items = [dict(row) for row in self.db().execute(query, params).fetchall()]
+        next_cursor = f"{items[-1]['uploaded']!r}:{items[-1]['sha256']}" if len(items) == limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+
+    def import_legacy(self, allowed_extensions):
+        """Move files stored directly in the root folder into the store. Returns how many were imported."""
+        imported = 0
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.rsplit('.', 1)[-1].lower() in allowed_extensions:
+                with open(entry.path, 'rb') as f:
+                    self.save(f, entry.name)
+                os.remove(entry.path)
+                imported += 1
+        return imported
+
+def main(argv=None):
+    import app
+
+    parser = argparse.ArgumentParser(description='Manage the upload store.')
+    parser.add_argument('--import-legacy', action='store_true', help='move files from the flat uploads folder into the store')
+    args = parser.parse_args(argv)
+    if args.import_legacy:
+        print(f'Imported {app.upload_store.import_legacy(app.ALLOWED_EXTENSIONS)} files into {app.upload_store.root}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""Watch-folder daemon: create a product for every finished image dropped into a directory.
+
+    python watch.py designs/ --store-id 123 --product-id abc --title-source ai
+
+New files are picked up with inotify on Linux (polling elsewhere, or with
+--poll). A file is processed once its size and modification time have been
+stable for --debounce seconds, so half-copied files are left alone. Files are
+identified by content hash; hashes of created products are appended to an
+index file, so restarts, renames and copies never create the same design twice,
+while an edited file is treated as new. Images already in the folder at startup
+are processed too. A file that fails (e.g. during a Printify or AI outage) is
+queued again after --retry-delay seconds, doubling up to 30 minutes, for up to
+--max-retries attempts. Keys and content rules are taken as in cli.py. Each
+session of the watcher is recorded as one run in the results store (RESULTS_DB),
+with a result for every attempt.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import os
+import queue
+import select
+import struct
+import sys
+import threading
+import time
+
+import app
+import cli
+
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+INDEX_FILE = '.watch_index.jsonl'
+RETRY_MAX_DELAY = 1800
+
+def load_index(path):
+    """Content hashes already turned into products."""
+    hashes = set()
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    hashes.add(json.loads(line)['sha256'])
+    return hashes
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_image(name):
+    return not name.startswith('.') and app.allowed_file(name)
+
+def inotify_events(directory):
+    """Yield names of files written or moved into directory, or return None if inotify is unavailable."""
+    libc_name = ctypes.util.find_library('c')
+    libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name else None
+    if libc is None or not hasattr(libc, 'inotify_init1'):
+        return None
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0 or libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        return None
+
+    def events():
+        while True:
+            select.select([fd], [], [])
+            data = os.read(fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                # struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+                _, _, _, length = struct.unpack_from('iIII', data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                offset += 16 + length
+                yield os.fsdecode(name)
+    return events()
+
+class FolderWatcher:
+    """Finds stable new images in a directory and feeds them to a bounded queue."""
+
+    def __init__(self, directory, index_path, debounce=2.0, poll_interval=2.0, queue_size=100, use_inotify=True,
+                 retry_delay=30.0, max_retries=8):
+        self.directory = directory
+        self.index_path = index_path
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.queue = queue.Queue(maxsize=queue_size)  # put() blocks when the workers fall behind
+        self.use_inotify = use_inotify
+        self.done = load_index(index_path)
+        self.in_flight = set()
+        self.pending = {}  # path -> ((size, mtime), first seen unchanged)
+        self.seen = {}  # path -> (size, mtime) when last hashed, so rescans skip unchanged files
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.failures = {}  # content hash -> failed attempts
+        self.lock = threading.Lock()
+
+    def touch(self, name):
+        if is_image(name):
+            with self.lock:
+                self.pending.setdefault(os.path.join(self.directory, name), (None, 0))
+
+    def retry(self, path):
+        """Offer a failed file again; it goes through the usual stability check first."""
+        with self.lock:
+            self.seen.pop(path, None)
+            self.pending.setdefault(path, (None, 0))
+
+    def scan(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                self.touch(entry.name)
+
+    def watch(self):
+        """Feed change notifications to touch(); runs forever."""
+        events = inotify_events(self.directory) if self.use_inotify else None
+        if events is None:
+            while True:
+                time.sleep(self.poll_interval)
+                self.scan()
+        for name in events:
+            self.touch(name)
+
+    def settle(self):
+        """Move files whose size and mtime stopped changing into the queue; runs forever."""
+        while True:
+            time.sleep(min(0.5, self.debounce))
+            now = time.monotonic()
+            ready = []
+            with self.lock:
+                for path, (signature, since) in list(self.pending.items()):
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        del self.pending[path]
+                        continue
+                    current = (stat.st_size, stat.st_mtime_ns)
+                    if current == self.seen.get(path):
+                        del self.pending[path]
+                    elif current != signature:
+                        self.pending[path] = (current, now)
+                    elif now - since >= self.debounce and stat.st_size:
+                        del self.pending[path]
+                        self.seen[path] = current
+                        ready.append(path)
+            for path in ready:
+                self.offer(path)
+
+    def offer(self, path):
+        try:
+            digest = file_hash(path)
+        except OSError:
+            return
+        with self.lock:
+            if digest in self.done or digest in self.in_flight:
+                return
+            self.in_flight.add(digest)
+        self.queue.put((path, digest))
+
+    def finish(self, path, digest, result):
+        """Record a processed file. Returns the seconds until a failed file is retried, or None."""
+        with self.lock:
+            self.in_flight.discard(digest)
+            if result.get('error'):
+                attempts = self.failures[digest] = self.failures.get(digest, 0) + 1
+                if attempts > self.max_retries:
+                    return None  # retried only if the file changes or the watcher restarts
+                delay = min(RETRY_MAX_DELAY, self.retry_delay * 2 ** (attempts - 1))
+                timer = threading.Timer(delay, self.retry, (path,))
+                timer.daemon = True
+                timer.start()
+                return delay
+            self.failures.pop(digest, None)
+            self.done.add(digest)
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'sha256': digest, 'image': os.path.basename(path), 'product_id': result.get('product_id'),
+                                    'time': time.time()}) + '\n')
+
+def run(args):
+    rules = cli.build_rules(args)
+    api_key = rules['api_key']
+    if not api_key:
+        sys.exit('Printify API key required (PRINTIFY_API_KEY or saved keys)')
+    if not args.store_id or not args.product_id:
+        sys.exit('--store-id and --product-id are required')
+    example_product = app.fetch_example_product(args.store_id, args.product_id, api_key)
+    app.apply_example_product(rules, example_product)
+
+    directory = os.path.abspath(args.directory)
+    watcher = FolderWatcher(directory, args.index or os.path.join(directory, INDEX_FILE), args.debounce,
+                            args.poll_interval, args.queue_size, not args.poll, args.retry_delay, args.max_retries)
+    writer = cli.ResultWriter(args.results) if args.results else None
+    app.result_store.start_run(rules['job_id'], 'watch', args.store_id, args.product_id)
+
+    def worker():
+        while True:
+            path, digest = watcher.queue.get()
+            try:
+                result = app.create_single_product(path, example_product, args.store_id, api_key, rules)
+            except Exception as e:
+                result = {'image': path, 'error': str(e)}
+            app.result_store.add(rules['job_id'], result, os.path.basename(path))
+            retry_in = watcher.finish(path, digest, result)
+            if result.get('error'):
+                retry = f' (retrying in {retry_in:.0f}s)' if retry_in else ' (giving up until the file changes)'
+                print(f"Failed {os.path.basename(path)}: {result['error']}{retry}", file=sys.stderr)
+            else:
+                print(f"Created {result['product_id']} from {os.path.basename(path)}", file=sys.stderr)
+            if writer:
+                writer.write({'row': None, 'image': os.path.basename(path), 'store_id': args.store_id, 'template_id': args.product_id,
+                              **{field: result.get(field) for field in ('image_id', 'product_id', 'title', 'error')},
+                              'timings': result.get('timings', {})})
+
+    for _ in range(args.workers):
+        threading.Thread(target=worker, daemon=True).start()
+    threading.Thread(target=watcher.settle, daemon=True).start()
+    watcher.scan()
+    print(f'Watching {directory} ({len(watcher.done)} designs already processed, run {rules["job_id"]})', file=sys.stderr)
+    try:
+        watcher.watch()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        app.result_store.finish_run(rules['job_id'], 'completed')
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create Printify products from images dropped into a folder.')
+    parser.add_argument('directory', help='folder to watch')
+    parser.add_argument('--store-id', help='shop to create products in')
+    parser.add_argument('--product-id', help='template product to copy')
+    parser.add_argument('--index', help=f'processed-files index (default: {INDEX_FILE} in the folder)')
+    parser.add_argument('--results', help='also append results to this .jsonl or .csv file')
+    parser.add_argument('--debounce', type=float, default=2.0, help='seconds a file must stay unchanged before it is processed')
+    parser.add_argument('--poll', action='store_true', help='poll the folder instead of using inotify')
+    parser.add_argument('--poll-interval', type=float, default=2.0)
+    parser.add_argument('--retry-delay', type=float, default=30.0, help='seconds before a failed file is first retried (doubles each time)')
+    parser.add_argument('--max-retries', type=int, default=8, help='attempts after the first failure before a file is left alone')
+    parser.add_argument('--queue-size', type=int, default=100, help='images waiting for a worker before intake pauses')
+    parser.add_argument('--rules', help='JSON file with content rules, same keys as the web UI')
+    parser.add_argument('--provider', dest='ai_provider', choices=['openai', 'gemini', 'ollama'])
+    parser.add_argument('--fallback-provider', dest='fallback_provider', choices=['openai', 'gemini', 'ollama'])
+    parser.add_argument('--ollama-model', dest='ollama_model')
+    parser.add_argument('--title-source', dest='title_source', choices=['ai', 'filename', 'copy'])
+    parser.add_argument('--desc-source', dest='desc_source', choices=['ai', 'copy'])
+    parser.add_argument('--tag-source', dest='tag_source', choices=['ai', 'copy'])
+    parser.add_argument('--budget', type=float, help='estimated AI spend in USD after which new images use --budget-route')
+    parser.add_argument('--budget-route', dest='budget_route', choices=['cheaper', 'ollama'])
+    parser.add_argument('--workers', type=int, default=4)
+    return run(parser.parse_args(argv))
+
+if __name__ == '__main__':
+    sys.exit(main())